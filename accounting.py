@@ -0,0 +1,135 @@
+'''
+Module to account for the resources used by the commands the shell runs.
+
+Every child is reaped with os.wait4, which gives its resource usage along with
+its exit status. Each reaped command is passed to record(), which:
+
+- collects it for the time built-in while a command is being timed, and
+- appends it as one JSON line to the file named by MYSH_ACCOUNTING, if set.
+'''
+import os
+import sys
+import time
+
+# Records of the commands reaped while timing, or None when nothing is timed
+_collector = None
+
+# (path, fd) of the open MYSH_ACCOUNTING file
+_accounting_file = None
+
+def _accounting_fd(path):
+    '''
+    Helper function to get an O_APPEND file descriptor for the accounting file.
+    '''
+    global _accounting_file
+    if _accounting_file is not None:
+        if _accounting_file[0] == path:
+            return _accounting_file[1]
+        os.close(_accounting_file[1])
+        _accounting_file = None
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    _accounting_file = (path, fd)
+    return fd
+
+def record(command, pid, status, rusage, real, pipeline=None):
+    '''
+    Account for one reaped command.
+
+    rusage is the resource usage from os.wait4 and real is its wall time in seconds.
+    '''
+    path = os.environ.get('MYSH_ACCOUNTING')
+    if _collector is None and not path:
+        return
+    entry = {
+        'command': command,
+        'pid': pid,
+        'status': status,
+        'real': round(real, 6),
+        'user': round(rusage.ru_utime, 6),
+        'sys': round(rusage.ru_stime, 6),
+        'maxrss_kb': rusage.ru_maxrss,
+        'nvcsw': rusage.ru_nvcsw,
+        'nivcsw': rusage.ru_nivcsw,
+    }
+    if _collector is not None:
+        _collector.append(entry)
+    if path:
+        import json
+        entry['time'] = round(time.time(), 6)
+        entry['pipeline'] = pipeline if pipeline is not None else command
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        try:
+            os.write(_accounting_fd(path), line.encode(errors='surrogateescape'))
+        except OSError as e:
+            sys.stderr.write(f'mysh: MYSH_ACCOUNTING: {path}: {e.strerror}\n')
+
+def _seconds(value):
+    '''
+    Helper function to format seconds like the time built-in of bash (0m0.000s).
+    '''
+    minutes, seconds = divmod(value, 60)
+    return f'{int(minutes)}m{seconds:.3f}s'
+
+class Timer:
+    '''
+    Context manager timing everything run inside it, for the time built-in.
+
+    On exit it writes the totals (wall, user and sys time, max RSS and context
+    switches) to stderr, followed by one line per command that was reaped.
+    The shell's own usage (built-ins run in-process) is counted as 'mysh'.
+    '''
+    def __enter__(self):
+        global _collector
+        import resource
+        self.previous = _collector
+        self.records = _collector = []
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global _collector
+        import resource
+        real = time.perf_counter() - self.start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _collector = self.previous
+        if _collector is not None:
+            # A time inside a time: the outer one reports these commands too
+            _collector.extend(self.records)
+
+        shell = {
+            'command': 'mysh',
+            'real': real,
+            'user': usage.ru_utime - self.self_usage.ru_utime,
+            'sys': usage.ru_stime - self.self_usage.ru_stime,
+            'maxrss_kb': usage.ru_maxrss,
+            'nvcsw': usage.ru_nvcsw - self.self_usage.ru_nvcsw,
+            'nivcsw': usage.ru_nivcsw - self.self_usage.ru_nivcsw,
+        }
+        stages = self.records + [shell]
+        user = sum(stage['user'] for stage in stages)
+        system = sum(stage['sys'] for stage in stages)
+        maxrss = max(stage['maxrss_kb'] for stage in stages)
+        nvcsw = sum(stage['nvcsw'] for stage in stages)
+        nivcsw = sum(stage['nivcsw'] for stage in stages)
+
+        lines = [
+            '',
+            f'real\t{_seconds(real)}',
+            f'user\t{_seconds(user)}',
+            f'sys\t{_seconds(system)}',
+            f'maxrss\t{maxrss} KiB',
+            f'ctxsw\t{nvcsw} voluntary, {nivcsw} involuntary',
+        ]
+        if self.records:
+            lines.append(f'{"command":30} {"real":>9} {"user":>9} {"sys":>9} {"maxrss":>10} {"vcsw":>7} {"ivcsw":>7}')
+            for stage in stages:
+                command = stage['command']
+                if len(command) > 30:
+                    command = command[:27] + '...'
+                lines.append(
+                    f'{command:30} {stage["real"]:8.3f}s {stage["user"]:8.3f}s {stage["sys"]:8.3f}s '
+                    f'{stage["maxrss_kb"]:7} KiB {stage["nvcsw"]:7} {stage["nivcsw"]:7}'
+                )
+        sys.stderr.write('\n'.join(lines) + '\n')
+        return False
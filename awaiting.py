@@ -0,0 +1,262 @@
+'''
+Module to wait for commands on an asyncio event loop, with deadlines.
+
+The blocking engine (jobs.wait_for_job) can only wait until a job is done.
+Here every process of a job is watched with a pidfd registered on the event
+loop, so a single loop waits on all of them at once (and on the output of a
+var -s capture at the same time) and the whole job can be given a deadline.
+When it passes, the job's process group gets SIGTERM, then SIGKILL if it is
+still running KILL_AFTER seconds later.
+
+The timeout built-in always uses this engine. Setting MYSH_ASYNC=1 makes every
+foreground command use it too, with MYSH_TIMEOUT (e.g. 30, 10m) as a deadline
+for each of them. Job control isn't supported by this engine yet: a stopped
+job is waited for until its deadline passes.
+
+asyncio takes longer to import than the rest of the shell together, so it is
+only imported once something is waited for here.
+'''
+import os
+import sys
+import _signal
+import jobs
+import tracing
+from jobs import Job, restore_terminal, give_terminal
+
+# Seconds between the signal sent at the deadline and SIGKILL
+KILL_AFTER = 5.0
+
+# Exit status of a command that was stopped at its deadline, like GNU timeout
+TIMEOUT_STATUS = 124
+
+# Seconds between checks on processes that couldn't get a pidfd
+POLL_INTERVAL = 0.01
+
+# Bytes asked for per read of a captured output
+CHUNK_SIZE = 1 << 16
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# The event loop of the main thread and the pid it was made in
+_loop = None
+_loop_pid = None
+
+def enabled():
+    '''
+    Helper function to test if MYSH_ASYNC selects this engine for every command.
+    '''
+    return os.environ.get('MYSH_ASYNC', '0') not in ('', '0')
+
+def parse_duration(text):
+    '''
+    Get the seconds in a duration like 1.5, 30s, 10m, 2h or 1d, raising ValueError if invalid.
+    '''
+    multiplier = _UNITS.get(text[-1:], 1)
+    try:
+        seconds = float(text[:-1] if text[-1:] in _UNITS else text) * multiplier
+    except ValueError:
+        seconds = -1
+    if not 0 <= seconds < float('inf'):
+        raise ValueError(f'invalid duration: {text}')
+    return seconds
+
+def default_timeout():
+    '''
+    Helper function to read the deadline for every command from MYSH_TIMEOUT (None if unset or 0).
+    '''
+    value = os.environ.get('MYSH_TIMEOUT', '').strip()
+    if not value:
+        return None
+    try:
+        seconds = parse_duration(value)
+    except ValueError:
+        sys.stderr.write(f'mysh: MYSH_TIMEOUT: invalid duration: {value}\n')
+        return None
+    return seconds or None
+
+def _run(coroutine):
+    '''
+    Helper function to run a coroutine to completion on this thread's event loop.
+
+    The main thread keeps one loop for every command. Built-ins running as
+    pipeline stages in threads (and forked children, which must not share
+    the parent's epoll instance) get a loop of their own.
+    '''
+    global _loop, _loop_pid
+    import asyncio
+    import threading
+    if threading.current_thread() is not threading.main_thread():
+        return asyncio.run(coroutine)
+    if _loop is None or _loop_pid != os.getpid():
+        _loop = asyncio.new_event_loop()
+        _loop_pid = os.getpid()
+    return _loop.run_until_complete(coroutine)
+
+async def _readable(fd):
+    '''
+    Helper coroutine returning once fd is readable.
+    '''
+    import asyncio
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def ready():
+        if not future.done():
+            future.set_result(None)
+
+    loop.add_reader(fd, ready)
+    try:
+        await future
+    finally:
+        loop.remove_reader(fd)
+
+async def _reap(job, pid):
+    '''
+    Helper coroutine to wait for pid to exit and store its status in job.
+
+    The pidfd becomes readable when the process exits; without pidfd support
+    the process is checked every POLL_INTERVAL seconds instead.
+    '''
+    import asyncio
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    try:
+        while True:
+            finished, status, rusage = os.wait4(pid, os.WNOHANG)
+            if finished == pid:
+                job.store(pid, status, rusage)
+                return
+            if pidfd is None:
+                await asyncio.sleep(POLL_INTERVAL)
+            else:
+                await _readable(pidfd)
+    except ChildProcessError:
+        # Already reaped by someone else
+        job.statuses.setdefault(pid, 0)
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+def _signal_job(job, signal_number):
+    '''
+    Helper function to send a signal to the process group of a job.
+    '''
+    try:
+        os.killpg(job.pgid, signal_number)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+async def _wait_job(job, consumer, timeout, kill_after, signal_number, others=()):
+    '''
+    Helper coroutine to wait for the processes of a job (and the coroutines in others).
+
+    Returns None if everything finished in time, otherwise the last signal the
+    job was sent: signal_number at the deadline, or SIGKILL kill_after seconds later.
+    '''
+    import asyncio
+    reapers = {pid: asyncio.ensure_future(_reap(job, pid)) for pid in job.pids if pid not in job.statuses}
+    pending = set(reapers.values())
+    pending.update(asyncio.ensure_future(other) for other in others)
+    if consumer in reapers:
+        # Nothing reads what the other stages write once the consumer is gone (see jobs.wait_for_job)
+        reapers[consumer].add_done_callback(
+            lambda _: job.done() or _signal_job(job, _signal.SIGPIPE)
+        )
+    if not pending:
+        return None
+
+    _, pending = await asyncio.wait(pending, timeout=timeout)
+    if not pending:
+        return None
+    sent = signal_number
+    _signal_job(job, signal_number)
+    _, pending = await asyncio.wait(pending, timeout=kill_after)
+    if pending:
+        sent = _signal.SIGKILL
+        _signal_job(job, sent)
+        await asyncio.wait(pending)
+    return sent
+
+def _status(job, sent):
+    '''
+    Helper function to get the exit status of a job from the signal it was stopped with.
+    '''
+    if sent is None:
+        return job.status()
+    if sent == _signal.SIGKILL:
+        return 128 + sent
+    return TIMEOUT_STATUS
+
+def wait_for_job(job, consumer=None, timeout=None, kill_after=KILL_AFTER, signal_number=_signal.SIGTERM):
+    '''
+    Wait for a foreground job like jobs.wait_for_job, stopping it after timeout seconds.
+
+    Returns the exit status of the job, TIMEOUT_STATUS if it was stopped at its
+    deadline, or 128+9 if it had to be killed with SIGKILL.
+    '''
+    import threading
+    foreground = threading.current_thread() is threading.main_thread()
+    if job.pids and foreground:
+        give_terminal(job.pgid)
+    try:
+        sent = _run(_wait_job(job, consumer, timeout, kill_after, signal_number))
+    finally:
+        if foreground:
+            restore_terminal()
+    return _status(job, sent)
+
+def wait(job, consumer=None):
+    '''
+    Wait for a foreground job with the engine MYSH_ASYNC selects, returning its exit status.
+    '''
+    if tracing.enabled:
+        return tracing.call('wait', job.command, _wait, job, consumer)
+    return _wait(job, consumer)
+
+def _wait(job, consumer):
+    '''
+    Helper function that does the actual waiting for wait.
+    '''
+    if enabled():
+        return wait_for_job(job, consumer, default_timeout())
+    return jobs.wait_for_job(job, consumer=consumer)
+
+async def _read_all(fd, buffer, limit):
+    '''
+    Helper coroutine to read the non-blocking fd into buffer until EOF.
+
+    Returns True if anything past limit bytes had to be thrown away.
+    '''
+    truncated = False
+    while True:
+        try:
+            data = os.read(fd, CHUNK_SIZE)
+        except BlockingIOError:
+            await _readable(fd)
+            continue
+        if not data:
+            return truncated
+        if limit is not None and len(buffer) + len(data) > limit:
+            data = data[:limit - len(buffer)]
+            truncated = True
+        buffer += data
+
+def capture(pid, fd, limit, command, started):
+    '''
+    Read the output of the process pid from the pipe fd while waiting for it.
+
+    Returns (output, truncated, exit status), like capturing.capture_output.
+    The process is stopped at the MYSH_TIMEOUT deadline, keeping what it wrote.
+    '''
+    os.set_blocking(fd, False)
+    job = Job(pid, [pid], command, started=started)
+    buffer = bytearray()
+    truncated = []
+
+    async def read():
+        truncated.append(await _read_all(fd, buffer, limit))
+
+    sent = _run(_wait_job(job, None, default_timeout(), KILL_AFTER, _signal.SIGTERM, (read(),)))
+    return buffer, bool(truncated and truncated[0]), _status(job, sent)
@@ -0,0 +1,82 @@
+'''
+Parse-throughput benchmark: the single-pass parser against the old regex + shlex path.
+
+Run with: python bench/bench_parse.py [--count N]
+'''
+import argparse
+import os
+import re
+import shlex
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from parsing import parse_line, _parse
+
+LINES = [
+    'ls -l',
+    'echo "hello world" ${HOME} \\${NOT_EXPANDED}',
+    "cat /var/log/syslog | grep -v 'DEBUG | TRACE' | sort | uniq -c | sort -rn | head -20",
+    'var -s OUT "git log --oneline -n 5"',
+    ' '.join(f'arg{i}' for i in range(200)),
+    ' | '.join(['cat'] * 100),
+    '"' + 'x' * 5000 + '"',
+]
+
+# The parsing path from before the single-pass parser, kept here for comparison
+_PIPE_REGEX_PATTERN = re.compile(
+    r"\\\"" r"|\\'" r"|\"(?:\\\"|[^\"])*\"" r"|'(?:\\'|[^'])*'" r"|(\|)"
+)
+
+def old_splitting_arguments(cmd_str):
+    parsed = []
+    lexer = shlex.shlex(cmd_str, posix=True)
+    lexer.whitespace_split = True
+    lexer.quotes = "'\""
+    lexer.escape = '\\'
+    lexer.escapedquotes = "'\""
+    for token in lexer:
+        if token:
+            parsed.append(token)
+    return parsed
+
+def old_split_by_pipe_op(cmd_str):
+    indexes = [m.start() for m in _PIPE_REGEX_PATTERN.finditer(cmd_str) if m.group(1) is not None]
+    if not indexes:
+        return [cmd_str]
+    pieces = []
+    prev = 0
+    for index in indexes:
+        pieces.append(cmd_str[prev:index])
+        prev = index + 1
+    pieces.append(cmd_str[prev:])
+    return pieces
+
+def old_parse(line):
+    return [old_splitting_arguments(segment) for segment in old_split_by_pipe_op(line)]
+
+def new_parse_uncached(line):
+    return _parse(line)
+
+def lines_per_second(function, line, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        function(line)
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=2000)
+    options = parser.parse_args()
+
+    print(f'{"line":40} {"shlex":>12} {"single-pass":>12} {"cached":>12}  (lines/sec)')
+    for line in LINES:
+        old = lines_per_second(old_parse, line, options.count)
+        new = lines_per_second(new_parse_uncached, line, options.count)
+        cached = lines_per_second(parse_line, line, options.count)
+        label = line if len(line) <= 40 else line[:37] + '...'
+        print(f'{label:40} {old:12.0f} {new:12.0f} {cached:12.0f}')
+
+if __name__ == '__main__':
+    main()
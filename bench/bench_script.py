@@ -0,0 +1,69 @@
+'''
+Script-mode throughput: run a generated script through mysh.py and report lines/sec.
+
+The script is run both as `mysh.py script` (buffered, no prompts) and by piping it
+into the interactive loop, which reads it with input() one line at a time.
+
+Run with: python bench/bench_script.py [--lines N] [--external N]
+'''
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MYSH = os.path.join(ROOT, 'mysh.py')
+
+BUILTIN_LINES = [
+    'var COUNTER x${HOME}',
+    'var NAME "some value with ${HOME} in it"',
+    'cd .',
+    'var -invalid x y z',
+    'hash -r',
+]
+
+def write_script(directory, lines, external):
+    '''
+    Write a script of `lines` built-in lines followed by `external` runs of true.
+    '''
+    path = os.path.join(directory, 'bench.mysh')
+    with open(path, 'w') as f:
+        for i in range(lines):
+            f.write(BUILTIN_LINES[i % len(BUILTIN_LINES)] + '\n')
+        for _ in range(external):
+            f.write('true\n')
+    return path
+
+def timed(command, stdin=None):
+    start = time.perf_counter()
+    with open(stdin, 'rb') if stdin else open(os.devnull, 'rb') as f:
+        result = subprocess.run(command, stdin=f, stdout=subprocess.DEVNULL, env=bench_env())
+    return time.perf_counter() - start, result.returncode
+
+def bench_env():
+    env = dict(os.environ)
+    # Keep a user's .myshrc out of the measurement
+    env['MYSHDOTDIR'] = tempfile.gettempdir()
+    return env
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--external', type=int, default=0,
+                        help='also run this many external commands')
+    options = parser.parse_args()
+    total = options.lines + options.external
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_script(directory, options.lines, options.external)
+        script_time, status = timed([sys.executable, MYSH, path])
+        repl_time, _ = timed([sys.executable, MYSH], stdin=path)
+
+    print(f'{total} lines ({options.external} external commands)')
+    print(f'script mode:     {script_time:8.2f} s  {total / script_time:10.0f} lines/sec  (exit {status})')
+    print(f'interactive loop:{repl_time:8.2f} s  {total / repl_time:10.0f} lines/sec')
+
+if __name__ == '__main__':
+    main()
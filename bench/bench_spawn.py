@@ -0,0 +1,58 @@
+'''
+Microbenchmark comparing fork+exec with the posix_spawn launcher in spawning.py.
+
+Run with: python bench/bench_spawn.py [--count N] [--resident-mb MB]
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from spawning import spawn
+
+TRUE = '/bin/true'
+
+def fork_exec(path, arguments):
+    '''
+    The old way of launching a command: fork the interpreter, then exec.
+    '''
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setpgid(0, 0)
+            os.execv(path, arguments)
+        finally:
+            os._exit(127)
+    return pid
+
+def commands_per_second(launcher, count):
+    '''
+    Launch /bin/true count times, one after another, and return commands/sec.
+    '''
+    start = time.perf_counter()
+    for _ in range(count):
+        pid = launcher(TRUE, [TRUE])
+        os.waitpid(pid, 0)
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=500)
+    parser.add_argument('--resident-mb', type=int, default=0,
+                        help='grow the benchmark process by this much first, to mimic a large shell')
+    options = parser.parse_args()
+
+    ballast = bytearray(options.resident_mb * 1024 * 1024)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    before = commands_per_second(fork_exec, options.count)
+    after = commands_per_second(spawn, options.count)
+    print(f'resident ballast: {options.resident_mb} MB, {options.count} commands')
+    print(f'fork+exec:   {before:10.1f} commands/sec')
+    print(f'posix_spawn: {after:10.1f} commands/sec ({after / before:.2f}x)')
+
+if __name__ == '__main__':
+    main()
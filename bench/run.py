@@ -0,0 +1,707 @@
+'''
+Benchmark suite for the shell's hot paths.
+
+Run everything with:   python bench/run.py
+Save a baseline with:  python bench/run.py --save-baseline
+Later runs are compared against bench/baseline.json (if it exists) and the
+script exits with status 1 if any metric regressed by more than --threshold.
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, ROOT)
+
+import parsing
+import expansion
+from parsing import parse_line, splitting_arguments, split_by_pipe_op
+from built_in_commands import expanding_variables
+from executing_commands import (
+    executing_commands_with_no_escape_variables,
+    executing_piped_commands, var
+)
+from parallel import parallel_command
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Benchmarks register themselves here, in the order they run
+BENCHMARKS = {}
+
+def benchmark(function):
+    '''
+    Decorator registering a benchmark; it returns {metric: (value, unit, higher_is_better)}.
+    '''
+    BENCHMARKS[function.__name__] = function
+    return function
+
+def per_second(function, count, repeat=3):
+    '''
+    Helper function to call function count times and return calls per second.
+
+    The best of repeat rounds is kept, which is much less noisy than the mean.
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(count):
+            function()
+        best = min(best, time.perf_counter() - start)
+    return count / best
+
+class quiet_stdout:
+    '''
+    Context manager pointing fd 1 at /dev/null while commands under test run.
+    '''
+    def __enter__(self):
+        sys.stdout.flush()
+        self.saved = os.dup(1)
+        null = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null, 1)
+        os.close(null)
+
+    def __exit__(self, *exc):
+        os.dup2(self.saved, 1)
+        os.close(self.saved)
+
+def data_file(directory, megabytes):
+    '''
+    Helper function to create a file of text lines of the given size.
+    '''
+    path = os.path.join(directory, f'data_{megabytes}mb.txt')
+    line = b'2024-01-01T00:00:00 INFO request served in 12ms path=/api/v1/items\n'
+    with open(path, 'wb') as f:
+        f.write(line * (megabytes * 1024 * 1024 // len(line)))
+    return path
+
+PARSE_LINES = {
+    'simple': 'ls -l /tmp',
+    'quoted': 'echo "hello world" \'single ${X}\' \\${ESCAPED} ${HOME}/bin',
+    'pipeline': "cat /var/log/syslog | grep -v 'DEBUG | TRACE' | sort | uniq -c | sort -rn | head",
+    'many_args': ' '.join(f'--flag{i}=value{i}' for i in range(500)),
+    'long_quoted': '"' + 'x' * 20000 + '"',
+    'many_pipes': ' | '.join(['cat'] * 200),
+    'many_escapes': ' '.join(['\\$\\"\\\''] * 500),
+}
+
+@benchmark
+def parse(options):
+    results = {}
+    count = 200 if options.quick else 2000
+    for name, line in PARSE_LINES.items():
+        def split_uncached():
+            parsing._parse_cache.clear()
+            splitting_arguments(line)
+        def pipe_uncached():
+            parsing._parse_cache.clear()
+            split_by_pipe_op(line)
+        results[f'splitting_arguments.{name}'] = (per_second(split_uncached, count), 'lines/s', True)
+        results[f'split_by_pipe_op.{name}'] = (per_second(pipe_uncached, count), 'lines/s', True)
+    results['parse_line.cached'] = (
+        per_second(lambda: parse_line(PARSE_LINES['pipeline']), count * 10), 'lines/s', True
+    )
+    return results
+
+@benchmark
+def expansion_cost(options):
+    results = {}
+    count = 200 if options.quick else 2000
+    env = {f'VAR{i}': f'value{i}' for i in range(1000)}
+    for references in (1, 10, 100, 1000):
+        text = ' '.join(f'${{VAR{i}}}' for i in range(references))
+        def expand():
+            expansion._string_cache.clear()
+            expanding_variables(text, env)
+        rate = per_second(expand, count)
+        results[f'expanding_variables.{references}_refs'] = (1e6 / rate, 'us/call', False)
+    return results
+
+@benchmark
+def spawn_latency(options):
+    count = 50 if options.quick else 500
+    with quiet_stdout():
+        rate = per_second(lambda: executing_commands_with_no_escape_variables(['true']), count)
+    return {'single_command': (1e6 / rate, 'us/command', False)}
+
+@benchmark
+def async_engine(options):
+    '''
+    Waiting with the asyncio engine against the blocking one, and how long after
+    its deadline a hung command is stopped (it must be well under a second).
+    '''
+    from executing_commands import timeout_command
+    count = 50 if options.quick else 500
+    results = {}
+    commands = parse_line('true | true').commands
+    saved = os.environ.get('MYSH_ASYNC')
+    try:
+        for engine, flag in (('blocking', '0'), ('asyncio', '1')):
+            os.environ['MYSH_ASYNC'] = flag
+            rate = per_second(lambda: executing_commands_with_no_escape_variables(['true']), count)
+            results[f'{engine}.single_command'] = (1e6 / rate, 'us/command', False)
+            rate = per_second(lambda: executing_piped_commands(commands), count)
+            results[f'{engine}.2_stages'] = (1e6 / rate, 'us/pipeline', False)
+    finally:
+        if saved is None:
+            del os.environ['MYSH_ASYNC']
+        else:
+            os.environ['MYSH_ASYNC'] = saved
+    for name, line in (('sigterm', ['timeout', '0.1', 'sleep', '30']),
+                       ('sigkill', ['timeout', '-k', '0.1', '0.1', 'sh', '-c', 'trap "" TERM; sleep 30'])):
+        start = time.perf_counter()
+        status = timeout_command(line)
+        overshoot = time.perf_counter() - start - 0.1
+        if status not in (124, 137) or overshoot > 1.0:
+            raise RuntimeError(f'{" ".join(line)!r} returned {status} {overshoot:.2f}s after its deadline')
+        results[f'timeout_overshoot.{name}'] = (overshoot * 1000, 'ms', False)
+    return results
+
+@benchmark
+def tracing_overhead(options):
+    '''
+    Cost of the trace spans: parsing and running a command with tracing off and on.
+    The trace written has to load as JSON once its closing bracket is added.
+    '''
+    import tracing
+    count = 200 if options.quick else 2000
+    results = {}
+    line = PARSE_LINES['pipeline']
+    def parse_uncached():
+        parsing._parse_cache.clear()
+        parse_line(line)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'trace.json')
+        for state in ('off', 'on'):
+            if state == 'on':
+                tracing.start(path)
+            try:
+                rate = per_second(parse_uncached, count)
+                results[f'{state}.parse'] = (1e6 / rate, 'us/line', False)
+                with quiet_stdout():
+                    rate = per_second(lambda: executing_commands_with_no_escape_variables(['true']), count // 4)
+                results[f'{state}.single_command'] = (1e6 / rate, 'us/command', False)
+            finally:
+                tracing.stop()
+        with open(path) as f:
+            events = json.loads(f.read().rstrip().rstrip(',') + ']')
+    if not any(event['name'] == 'spawn' for event in events):
+        raise RuntimeError('the trace has no spawn spans')
+    return results
+
+@benchmark
+def pipeline_throughput(options):
+    results = {}
+    megabytes = 16 if options.quick else 64
+    with tempfile.TemporaryDirectory() as directory:
+        path = data_file(directory, megabytes)
+        for stages in (2, 4, 8):
+            line = ' | '.join([f'cat {path}'] + ['cat'] * (stages - 1))
+            commands = parse_line(line).commands
+            with quiet_stdout():
+                start = time.perf_counter()
+                executing_piped_commands(commands)
+                elapsed = time.perf_counter() - start
+            results[f'{stages}_stages'] = (megabytes / elapsed, 'MB/s', True)
+    return results
+
+@benchmark
+def long_pipeline(options):
+    '''
+    A 500-stage pipeline under a 128 descriptor limit: it must finish, pass every
+    byte through, and leave the shell with no extra descriptors open.
+    '''
+    import resource
+    stages = 500
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, 'out')
+        line = ' | '.join(['head -c 100000 /dev/zero'] + ['cat'] * (stages - 2) + [f'wc -c > {output}'])
+        commands = parse_line(line).commands
+        open_before = len(os.listdir('/proc/self/fd'))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(128, soft), hard))
+        try:
+            start = time.perf_counter()
+            status = executing_piped_commands(commands)
+            elapsed = time.perf_counter() - start
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        open_after = len(os.listdir('/proc/self/fd'))
+        with open(output) as f:
+            count = f.read().strip()
+    if status != 0 or count != '100000':
+        raise RuntimeError(f'{stages}-stage pipeline failed: status {status}, output {count!r}')
+    if open_after != open_before:
+        raise RuntimeError(f'{stages}-stage pipeline leaked {open_after - open_before} descriptors')
+    return {f'{stages}_stages': (elapsed * 1000, 'ms', False)}
+
+@benchmark
+def early_exit(options):
+    '''
+    Producers must stop as soon as the consumer exits: each of these pipelines
+    has to finish in well under a second, however much the producer could write.
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = data_file(directory, 16 if options.quick else 64)
+        lines = {
+            'yes_head': 'yes | head -1',
+            'yes_3_stages_head': 'yes | cat | cat | head -1',
+            'cat_file_head': f'cat {path} | head -c 1',
+            'reader_head': 'sleep 30 | head -c 0',
+        }
+        for name, line in lines.items():
+            commands = parse_line(line).commands
+            with quiet_stdout():
+                start = time.perf_counter()
+                executing_piped_commands(commands)
+                elapsed = time.perf_counter() - start
+            if elapsed > 1.0:
+                raise RuntimeError(f'{line!r} took {elapsed:.2f}s to stop after its consumer exited')
+            results[name] = (elapsed * 1000, 'ms', False)
+    return results
+
+@benchmark
+def pipe_buffer_size(options):
+    import resource
+    results = {}
+    megabytes = 16 if options.quick else 64
+    saved = os.environ.get('MYSH_PIPE_SIZE')
+    with tempfile.TemporaryDirectory() as directory:
+        path = data_file(directory, megabytes)
+        commands = parse_line(f'/bin/cat {path} | /bin/cat | /bin/cat').commands
+        for size in ('64K', '256K', '1M'):
+            os.environ['MYSH_PIPE_SIZE'] = size
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            with quiet_stdout():
+                start = time.perf_counter()
+                executing_piped_commands(commands)
+                elapsed = time.perf_counter() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            switches = (after.ru_nvcsw + after.ru_nivcsw) - (before.ru_nvcsw + before.ru_nivcsw)
+            results[f'{size}.throughput'] = (megabytes / elapsed, 'MB/s', True)
+            results[f'{size}.context_switches'] = (switches, 'switches', False)
+    if saved is None:
+        del os.environ['MYSH_PIPE_SIZE']
+    else:
+        os.environ['MYSH_PIPE_SIZE'] = saved
+    return results
+
+@benchmark
+def var_capture(options):
+    results = {}
+    sizes = (1, 8) if options.quick else (1, 16, 64)
+    with tempfile.TemporaryDirectory() as directory:
+        for megabytes in sizes:
+            path = data_file(directory, megabytes)
+            start = time.perf_counter()
+            var(['var', '-s', 'BENCH_CAPTURE', f'cat {path}'])
+            elapsed = time.perf_counter() - start
+            captured = len(os.environ.get('BENCH_CAPTURE', ''))
+            del os.environ['BENCH_CAPTURE']
+            if captured < megabytes * 1024 * 1024 * 0.99:
+                raise RuntimeError(f'var -s captured only {captured} bytes of {megabytes} MB')
+            results[f'{megabytes}_mb'] = (megabytes / elapsed, 'MB/s', True)
+    return results
+
+@benchmark
+def command_substitution(options):
+    '''
+    $(...) against the var -s then ${VAR} it replaces, $(pwd) run in-process,
+    and how fast a large substitution is captured.
+    '''
+    from executing_commands import run_commands
+    count = 50 if options.quick else 500
+    results = {}
+    with_var = [parse_line('var -s BENCH_SUB "echo x"').commands, parse_line('true ${BENCH_SUB}').commands]
+    substituted = parse_line('true $(echo x)').commands
+    builtin = parse_line('true $(pwd)').commands
+    results['var_s_then_expand'] = (1e6 / per_second(lambda: [run_commands(c) for c in with_var], count),
+                                    'us/line', False)
+    results['substitution'] = (1e6 / per_second(lambda: run_commands(substituted), count), 'us/line', False)
+    results['builtin_substitution'] = (1e6 / per_second(lambda: run_commands(builtin), count), 'us/line', False)
+    os.environ.pop('BENCH_SUB', None)
+
+    megabytes = 8 if options.quick else 64
+    with tempfile.TemporaryDirectory() as directory:
+        path = data_file(directory, megabytes)
+        commands = parse_line(f'var BENCH_SUB "$(cat {path} | cat)"').commands
+        start = time.perf_counter()
+        run_commands(commands)
+        elapsed = time.perf_counter() - start
+    captured = len(os.environ.pop('BENCH_SUB', ''))
+    if captured < megabytes * 1024 * 1024 * 0.99:
+        raise RuntimeError(f'$(...) captured only {captured} bytes of {megabytes} MB')
+    results[f'{megabytes}_mb'] = (megabytes / elapsed, 'MB/s', True)
+    return results
+
+@benchmark
+def globbing(options):
+    '''
+    Wildcards over a directory of 100k files: the first pattern scans it, the
+    next ones reuse the scan, and batch runs a command on every match although
+    together they are over ARG_MAX.
+    '''
+    import globbing
+    from executing_commands import run_commands
+    count = 20_000 if options.quick else 100_000
+    results = {}
+    saved = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            for i in range(count):
+                os.close(os.open(f'cleanup_candidate_file_{i:06}.tmp', os.O_CREAT | os.O_WRONLY))
+            words = parse_line('true *.tmp').commands[0].words
+            globbing.clear_cache()
+            start = time.perf_counter()
+            matched = expansion.expand_arguments(words)
+            results['cold'] = ((time.perf_counter() - start) * 1000, 'ms', False)
+            if len(matched) != count + 1:
+                raise RuntimeError(f'*.tmp matched {len(matched) - 1} files, expected {count}')
+            words = parse_line('true *_01*.tmp').commands[0].words
+            start = time.perf_counter()
+            expansion.expand_arguments(words)
+            results['cached'] = ((time.perf_counter() - start) * 1000, 'ms', False)
+
+            commands = parse_line('batch rm -f -- *.tmp').commands
+            globbing.clear_cache()
+            start = time.perf_counter()
+            status = run_commands(commands)
+            results['batch_rm'] = ((time.perf_counter() - start) * 1000, 'ms', False)
+            if status != 0 or os.listdir('.'):
+                raise RuntimeError(f'batch rm left {len(os.listdir("."))} files (status {status})')
+        finally:
+            os.chdir(saved)
+    return results
+
+@benchmark
+def chmod_tree(options):
+    '''
+    chmod -R over a tree of small directories: the built-in with an octal and
+    a symbolic mode, against /bin/chmod -R and a fork of /bin/chmod per directory.
+    '''
+    from changing_modes import chmod_command
+    directories = 20 if options.quick else 200
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        paths = []
+        for d in range(directories):
+            path = os.path.join(root, f'd{d}', 'sub')
+            os.makedirs(path)
+            paths += [os.path.dirname(path), path]
+            for f in range(500):
+                os.close(os.open(os.path.join(path, f'f{f}'), os.O_CREAT | os.O_WRONLY, 0o600))
+                os.close(os.open(os.path.join(path, '..', f'f{f}'), os.O_CREAT | os.O_WRONLY, 0o600))
+        files = directories * 1000
+        for name, mode in (('octal', '755'), ('symbolic', 'u+x,go-w')):
+            chmod_command(['chmod', '-R', '600', root])
+            start = time.perf_counter()
+            status = chmod_command(['chmod', '-R', mode, root])
+            elapsed = time.perf_counter() - start
+            if status != 0:
+                raise RuntimeError(f'chmod -R {mode} failed')
+            results[name] = (files / elapsed, 'files/s', True)
+        if os.stat(os.path.join(root, 'd0', 'sub', 'f0')).st_mode & 0o7777 != 0o700:
+            raise RuntimeError('chmod -R u+x,go-w did not turn 600 into 700')
+        start = time.perf_counter()
+        subprocess.run(['chmod', '-R', '644', root], check=True)
+        results['bin_chmod'] = (files / (time.perf_counter() - start), 'files/s', True)
+        start = time.perf_counter()
+        for path in paths:
+            subprocess.run(['chmod', '644'] + [os.path.join(path, f'f{f}') for f in range(500)], check=True)
+        results['fork_per_directory'] = (files / (time.perf_counter() - start), 'files/s', True)
+    return results
+
+@benchmark
+def output_cache(options):
+    '''
+    cache over a sort of a big file: the first run, a hit served from the
+    cache, and a hit for a tiny command against just running it.
+    '''
+    import struct
+    from caching import cache_command
+    count = 20 if options.quick else 200
+    megabytes = 8 if options.quick else 32
+    results = {}
+    saved = os.environ.get('MYSHDOTDIR')
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['MYSHDOTDIR'] = directory
+        try:
+            path = data_file(directory, megabytes)
+            line = ['cache', '--dep', path, 'sort', path]
+            with quiet_stdout():
+                for name in ('miss', 'hit'):
+                    start = time.perf_counter()
+                    cache_command(line)
+                    results[f'sort_{megabytes}_mb.{name}'] = ((time.perf_counter() - start) * 1000, 'ms', False)
+                rate = per_second(lambda: executing_commands_with_no_escape_variables(['echo', 'x']), count)
+                results['echo.run'] = (1e6 / rate, 'us/command', False)
+                rate = per_second(lambda: cache_command(['cache', 'echo', 'x']), count)
+                results['echo.hit'] = (1e6 / rate, 'us/command', False)
+            with open(os.path.join(directory, '.mysh_cache', 'stats'), 'rb') as f:
+                hits, misses = struct.unpack('!QQ', f.read())
+            if misses != 2 or hits != 3 * count:
+                raise RuntimeError(f'cache counted {hits} hits and {misses} misses')
+        finally:
+            if saved is None:
+                del os.environ['MYSHDOTDIR']
+            else:
+                os.environ['MYSHDOTDIR'] = saved
+    return results
+
+@benchmark
+def parallel_fanout(options):
+    count = 16 if options.quick else 64
+    arguments = ['0.05'] * count
+    start = time.perf_counter()
+    for argument in arguments:
+        executing_commands_with_no_escape_variables(['sleep', argument])
+    sequential = time.perf_counter() - start
+    start = time.perf_counter()
+    parallel_command(['parallel', '-j', '8', 'sleep', ':::'] + arguments)
+    fanned_out = time.perf_counter() - start
+    return {
+        'sequential': (count / sequential, 'jobs/s', True),
+        'parallel_j8': (count / fanned_out, 'jobs/s', True),
+    }
+
+@benchmark
+def history_search(options):
+    '''
+    Searches over a large history file: hits must come back newest first and
+    each search has to stay fast however many entries there are.
+    '''
+    import history
+    count = 100_000 if options.quick else 1_000_000
+    words = ['git', 'ls', 'make', 'grep', 'vim', 'ssh', 'docker', 'python', 'cd', 'cat']
+    results = {}
+    saved = os.environ.get('MYSHDOTDIR')
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, history.HISTORY_FILE), 'w') as f:
+            for i in range(count):
+                f.write(f'{1700000000 + i}\t{words[i % 10]} {words[i // 10 % 10]} --opt={i % 99991}\n')
+        os.environ['MYSHDOTDIR'] = directory
+        start = time.perf_counter()
+        history.latest(1)
+        results['load'] = ((time.perf_counter() - start) * 1000, 'ms', False)
+        start = time.perf_counter()
+        history.build_index()
+        results['build_index'] = ((time.perf_counter() - start) * 1000, 'ms', False)
+        searches = {
+            'substring': ('--opt=123', False),
+            'substring_miss': ('no such command', False),
+            'prefix': ('vim ssh --opt=12', True),
+            'prefix_miss': ('zzz', True),
+        }
+        for name, (text, prefix) in searches.items():
+            start = time.perf_counter()
+            for _ in range(10):
+                found = history.search(text, prefix=prefix)
+            elapsed = (time.perf_counter() - start) / 10
+            expected = [e for e in history.latest(None) if (e[1].startswith(text) if prefix else text in e[1])][:20] \
+                if options.quick else None
+            if expected is not None and found != expected:
+                raise RuntimeError(f'history search for {text!r} returned {found[:3]}..., expected {expected[:3]}...')
+            results[name] = (elapsed * 1000, 'ms', False)
+        history.add('zzz just added')
+        if [command for _, command in history.search('zzz', prefix=True)] != ['zzz just added']:
+            raise RuntimeError('a command just added was not found by a prefix search')
+    if saved is None:
+        del os.environ['MYSHDOTDIR']
+    else:
+        os.environ['MYSHDOTDIR'] = saved
+    history.latest(1)
+    return results
+
+@benchmark
+def tab_completion(options):
+    '''
+    Completing commands against a PATH holding 20k executables: the first Tab
+    builds the index, every later one has to come back in under 10 ms.
+    '''
+    import completing
+    count = 20_000
+    results = {}
+    saved = os.environ['PATH']
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(count):
+            fd = os.open(os.path.join(directory, f'tool{i:05}'), os.O_CREAT | os.O_WRONLY, 0o755)
+            os.close(fd)
+        os.environ['PATH'] = directory + os.pathsep + saved
+        try:
+            start = time.perf_counter()
+            completing.completions('tool', '')
+            results['first_tab'] = ((time.perf_counter() - start) * 1000, 'ms', False)
+            for name, (text, expected) in {'unique': ('tool12345', 1), 'range': ('tool1', 10_000),
+                                           'all': ('tool', count)}.items():
+                start = time.perf_counter()
+                for _ in range(10):
+                    found = completing.completions(text, 'ls | ')
+                elapsed = (time.perf_counter() - start) / 10
+                if len(found) < expected or not all(f.startswith(text) for f in found):
+                    raise RuntimeError(f'completing {text!r} gave {len(found)} names, expected {expected}')
+                if elapsed > 0.01:
+                    raise RuntimeError(f'completing {text!r} took {elapsed * 1000:.1f} ms')
+                results[name] = (elapsed * 1000, 'ms', False)
+            start = time.perf_counter()
+            for _ in range(10):
+                completing.completions(os.path.join(directory, 'tool1'), 'cat ')
+            results['path'] = ((time.perf_counter() - start) * 100, 'ms', False)
+        finally:
+            os.environ['PATH'] = saved
+    return results
+
+@benchmark
+def cold_startup(options):
+    count = 5 if options.quick else 30
+    env = dict(os.environ, MYSHDOTDIR=tempfile.gettempdir())
+    command = [sys.executable, os.path.join(ROOT, 'mysh.py'), '-c', '']
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {
+        'median': (times[len(times) // 2] * 1000, 'ms', False),
+        'min': (times[0] * 1000, 'ms', False),
+    }
+
+@benchmark
+def forkserver(options):
+    '''
+    Commands sent to mysh.py --serve against cold starts of mysh.py -c, and how
+    many sessions the worker pool serves at once.
+    '''
+    import serving
+    import threading
+    count = 5 if options.quick else 30
+    workers = 8
+    sessions = 32
+    env = dict(os.environ, MYSHDOTDIR=tempfile.gettempdir())
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'mysh.sock')
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'mysh.py'), '--serve', path,
+                                   '--workers', str(workers)], env=env)
+        try:
+            deadline = time.perf_counter() + 10
+            while not os.path.exists(path):
+                if time.perf_counter() > deadline:
+                    raise RuntimeError('mysh.py --serve did not start listening')
+                time.sleep(0.01)
+            commands = {
+                'cold_start': [sys.executable, os.path.join(ROOT, 'mysh.py'), '-c', 'true'],
+                'client': [sys.executable, os.path.join(ROOT, 'mysh.py'), '--client', path, '-c', 'true'],
+            }
+            for name, command in commands.items():
+                times = []
+                for _ in range(count):
+                    start = time.perf_counter()
+                    subprocess.run(command, env=env, check=True)
+                    times.append(time.perf_counter() - start)
+                times.sort()
+                results[f'{name}.median'] = (times[len(times) // 2] * 1000, 'ms', False)
+
+            rate = per_second(lambda: serving.run_remote(path, 'true'), count * 10)
+            results['request.in_process'] = (1e6 / rate, 'us/request', False)
+
+            # Every session sleeps, so the time they take shows how many ran at once
+            statuses = []
+            def session():
+                statuses.append(serving.run_remote(path, 'sleep 0.2'))
+            threads = [threading.Thread(target=session) for _ in range(sessions)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            if statuses != [0] * sessions:
+                raise RuntimeError(f'forkserver sessions failed: {statuses}')
+            results['concurrent_sessions'] = (sessions * 0.2 / elapsed, 'sessions', True)
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+def compare(results, baseline, threshold):
+    '''
+    Print each metric next to its baseline value and return the regressed ones.
+    '''
+    regressions = []
+    for bench_name, metrics in results.items():
+        for metric, entry in metrics.items():
+            old = baseline.get(bench_name, {}).get(metric)
+            line = f'  {bench_name}.{metric}: {entry["value"]:.4g} {entry["unit"]}'
+            if old is None or not old['value']:
+                print(line + '  (no baseline)')
+                continue
+            change = (entry['value'] - old['value']) / old['value']
+            worse = -change if entry['higher_is_better'] else change
+            marker = ''
+            if worse > threshold:
+                marker = '  REGRESSION'
+                regressions.append(f'{bench_name}.{metric}')
+            print(f'{line}  (baseline {old["value"]:.4g}, {change:+.1%}){marker}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='fewer iterations and smaller inputs')
+    parser.add_argument('--only', action='append', choices=list(BENCHMARKS),
+                        help='run only this benchmark (can be repeated)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative slowdown counted as a regression (default 0.10)')
+    options = parser.parse_args()
+
+    results = {}
+    for name, function in BENCHMARKS.items():
+        if options.only and name not in options.only:
+            continue
+        print(f'running {name}...', file=sys.stderr)
+        results[name] = {
+            metric: {'value': value, 'unit': unit, 'higher_is_better': higher}
+            for metric, (value, unit, higher) in function(options).items()
+        }
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': options.quick,
+        },
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'baseline saved to {options.baseline}')
+    elif os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, options.threshold)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if regressions:
+        print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
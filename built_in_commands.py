@@ -1,54 +1,27 @@
 '''
 Module to implement built-in commands.
 '''
-import signal
-import re
 import os
 import sys
+import stat
 from parsing import splitting_arguments
+from command_hash import find_command
+from expansion import valid_var_name, expanding_string
+from copying import copy_fd
 
 interrupted = False
 
-def chmod(file_path, mode):
-    '''
-    Helper function to handle the chmod command.
-    '''
-    try:
-        file_path = expanding_files(file_path)
-        current_mode = os.stat(file_path).st_mode
-
-        if mode == '+x':
-            new_mode = current_mode | 0o111 
-        elif mode == '-x':
-            new_mode = current_mode & ~0o111  
-        elif mode == '+r':
-            new_mode = current_mode | 0o444  
-        elif mode == '-r':
-            new_mode = current_mode & ~0o444  
-        elif mode == '+w':
-            new_mode = current_mode | 0o222  
-        elif mode == '-w':
-            new_mode = current_mode & ~0o222  
-        else:
-            raise ValueError(f"Invalid mode flag: {mode}")
-        os.chmod(file_path, new_mode)
-
-    except FileNotFoundError:
-        sys.stderr.write(f"mysh: chmod: cannot access '{file_path}': No such file or directory\n")
-    except PermissionError:
-        sys.stderr.write(f"mysh: chmod: permission denied for '{file_path}'\n")
-    except ValueError as e:
-        sys.stderr.write(f"mysh: chmod: {str(e)}\n")
-
-def exit(parsed_line: list):
+def exit(parsed_line: list, stdout=None):
     '''
     Implementing functionality for the exit built-in command.
     '''
 
     if len(parsed_line)<1 or len(parsed_line)>2:
         sys.stderr.write("exit: too many arguments\n")
+        return 1
     elif len(parsed_line)==2 and not parsed_line[1].isdigit():
         sys.stderr.write(f"exit: non-integer exit code provided: {parsed_line[1]}\n")
+        return 1
     elif len(parsed_line)==2 and parsed_line[1].isdigit():
         if parsed_line[1]=='0':
             sys.exit(0)
@@ -57,50 +30,51 @@ def exit(parsed_line: list):
             sys.exit(exit_code)
     else:
         sys.exit(0)
-    return
 
-def which(commands: list[str]) -> bool:
+# Names of the built-in commands, as reported by which
+BUILT_IN_COMMANDS = ['pwd','cd', 'which', 'exit', 'var', 'hash', 'jobs', 'fg', 'bg', 'wait', 'kill', 'parallel', 'time', 'timeout', 'cat', 'history', 'trace', 'batch', 'chmod', 'cache']
+
+def which(commands: list[str], stdout=None) -> int:
     '''
     Implementing functionality for the which built-in command.
-    '''
 
-    built_in_commands = ['pwd','cd', 'which', 'exit', 'var']
+    Returns 1 if any of the commands wasn't found.
+    '''
+    if stdout is None:
+        stdout = sys.stdout
     flag = False
     path_flag = False
+    status = 0
 
     for j in range(0, len(commands)):
         flag = False
         path_flag = False
 
-        for i in range(0, len(built_in_commands)):
-            if commands[j]==built_in_commands[i]:
-                sys.stdout.write(f'{commands[j]}: shell built-in command\n')
+        for i in range(0, len(BUILT_IN_COMMANDS)):
+            if commands[j]==BUILT_IN_COMMANDS[i]:
+                stdout.write(f'{commands[j]}: shell built-in command\n')
                 flag = True
                 break
         
         if not flag:
-            path = os.getenv('PATH')
-            if path is None:
-                path = os.getenv('PATH', os.defpath)
-            dirs = path.split(os.pathsep)
-            for directory in dirs:
-                path_value = os.path.join(directory, commands[j])
-                if os.path.isfile(path_value) and os.access(path_value, os.X_OK):
-                    sys.stdout.write(path_value+'\n')
-                    path_flag = True
-                    break
+            path_value = find_command(commands[j])
+            if path_value is not None:
+                stdout.write(path_value+'\n')
+                path_flag = True
 
             if not path_flag:
-                sys.stdout.write(f'{commands[j]} not found\n')
-    return 
+                stdout.write(f'{commands[j]} not found\n')
+                status = 1
+    return status
 
-def cd(parsed_line):
+def cd(parsed_line, stdout=None):
     '''
     Implementing functionality for the cd built-in command.
     '''
 
     if len(parsed_line) > 2:
         sys.stderr.write("cd: too many arguments\n")
+        return 1
     elif len(parsed_line) == 2:
         if parsed_line[1] == '..':
             try:
@@ -109,6 +83,7 @@ def cd(parsed_line):
                 os.environ['PWD'] = new_directory
             except PermissionError:
                 sys.stderr.write("cd: permission denied: ..\n")
+                return 1
         else:
             try:
                 new_directory = os.path.expanduser(parsed_line[1])
@@ -116,10 +91,13 @@ def cd(parsed_line):
                 os.environ['PWD'] = os.path.abspath(new_directory)
             except FileNotFoundError:
                 sys.stderr.write(f"cd: no such file or directory: {parsed_line[1]}\n")
+                return 1
             except NotADirectoryError:
                 sys.stderr.write(f"cd: not a directory: {parsed_line[1]}\n")
+                return 1
             except PermissionError:
                 sys.stderr.write(f"cd: permission denied: {parsed_line[1]}\n")
+                return 1
     elif len(parsed_line) == 1:
         try:
             new_directory = os.path.expanduser('~')
@@ -127,32 +105,99 @@ def cd(parsed_line):
             os.environ['PWD'] = os.path.abspath(new_directory)
         except PermissionError:
             sys.stderr.write("cd: permission denied: ~\n")
+            return 1
+    return 0
 
-def pwd(parsed_line):
+def pwd(parsed_line, stdout=None):
     '''
     Implmenting functionality for the pwd built-in command.
     '''
+    if stdout is None:
+        stdout = sys.stdout
 
     if len(parsed_line) == 2 and parsed_line[1].lower() == '-p':
         current_directory = os.path.realpath(os.getcwd())
-        sys.stdout.write(current_directory + '\n')
+        stdout.write(current_directory + '\n')
     elif len(parsed_line) == 1:
         current_directory = os.getenv("PWD", os.getcwd())
         if current_directory=='/home/docs/docs':
             os.environ['PWD'] = '/home/docs'
         current_directory = os.getenv("PWD", os.getcwd())
-        sys.stdout.write(current_directory + '\n')
+        stdout.write(current_directory + '\n')
     elif len(parsed_line) >= 2 and parsed_line[1].startswith('-'):
         element = parsed_line[1][:2]
         sys.stderr.write(f"pwd: invalid option: {element}\n")
+        return 1
     elif len(parsed_line) >= 2 and not parsed_line[1].startswith('-'):
         sys.stderr.write("pwd: not expecting any arguments\n")
+        return 1
+    return 0
 
-def for_escaped_variables(parsed_line):
+def cat_options_supported(parsed_line):
     '''
-    Helper function to replace the escaped variables.
+    Helper function to test if the cat built-in handles these arguments.
+
+    Only plain file operands, '-' and -u are handled; anything else (e.g. -n) is
+    left to the real cat.
+    '''
+    for argument in parsed_line[1:]:
+        if argument.startswith('-') and argument not in ('-', '-u'):
+            return False
+    return True
+
+def cat_reads_stdin(parsed_line):
+    '''
+    Helper function to test if cat would read its stdin.
+    '''
+    operands = [argument for argument in parsed_line[1:] if argument != '-u']
+    return not operands or '-' in operands
+
+def cat(parsed_line, stdout=None):
     '''
-    return parsed_line.replace(r'\${', r'${')
+    Implementing functionality for the cat built-in command.
+
+    The files are copied by the kernel (see copying.py) instead of exec-ing /bin/cat.
+    '''
+    if stdout is None:
+        stdout = sys.stdout
+    stdout.flush()
+    out_fd = stdout.fileno()
+
+    # A regular file as the output would grow forever if it were copied into itself
+    out_stat = os.fstat(out_fd)
+    if not stat.S_ISREG(out_stat.st_mode):
+        out_stat = None
+
+    status = 0
+    operands = [argument for argument in parsed_line[1:] if argument != '-u'] or ['-']
+    for operand in operands:
+        fd = None
+        try:
+            if operand == '-':
+                src = 0
+            else:
+                src = fd = os.open(expanding_files(operand), os.O_RDONLY | os.O_CLOEXEC)
+            if out_stat is not None and _same_file(os.fstat(src), out_stat):
+                sys.stderr.write(f'mysh: cat: {operand}: input file is output file\n')
+                status = 1
+                continue
+            copy_fd(src, out_fd)
+        except BrokenPipeError:
+            # Whatever reads our output has gone away, so there's no point going on
+            return 1
+        except OSError as e:
+            sys.stderr.write(f'cat: {operand}: {e.strerror}\n')
+            status = 1
+        finally:
+            if fd is not None:
+                os.close(fd)
+    return status
+
+def _same_file(first, second):
+    '''
+    Helper function to test if two os.stat results are of the same file.
+    '''
+    return first.st_dev == second.st_dev and first.st_ino == second.st_ino
 
 def expanding_files(path):
     '''
@@ -167,28 +212,4 @@ def expanding_variables(echoed_statement, env=None):
     '''
     Helper function to expand variables.
     '''
-    if env is None:
-        env = os.environ
-    pattern = re.compile(r'\$\{([^}]+)\}')
-
-    while True:
-        match = pattern.search(echoed_statement)
-        if not match:
-            break
-        variable_name = match.group(1)
-        variable_value = env.get(variable_name, '')  
-        echoed_statement = echoed_statement.replace(match.group(0), variable_value)  
-    
-    return echoed_statement  
-
-
-def valid_var_name(key):
-    '''
-    Helper function to test if a variable name is valid.
-    '''
-    invalid = re.compile(r'[^a-zA-Z0-9_]')
-    variable_name = key
-    if invalid.search(variable_name):
-        return False
-    else:
-        return True
+    return expanding_string(echoed_statement, env)
@@ -0,0 +1,379 @@
+'''
+Module to implement the cache built-in command, which memoizes the output of commands.
+
+cache [--ttl DURATION] [--dep FILE]... [--env NAME]... command args...
+cache --stats | --clear
+
+The stdout and exit status of the command are kept in a file under
+$MYSHDOTDIR/.mysh_cache (the home directory by default), named by a SHA-256
+key of:
+
+- the arguments and the directory the command runs in;
+- the path, mtime and size of the program (so an upgraded program runs again);
+- the path, mtime and size of each --dep file;
+- the values of LANG, LC_ALL, LC_COLLATE and TZ, and of each --env variable.
+
+The next run with the same key copies the stored output to stdout and
+returns the stored status without running anything, unless the entry is
+older than --ttl. stderr and stdin are not part of the key: a command
+reading files or stdin should name them with --dep.
+
+Entries are files whose mtime is bumped on every hit, so once the cache
+grows past MYSH_CACHE_MAX bytes (256M by default) the least recently used
+ones are removed. Statuses over 128 (a command killed by a signal) aren't stored.
+'''
+import os
+import struct
+import sys
+import time
+from capturing import size_setting
+from copying import copy_fd
+
+CACHE_DIRECTORY = '.mysh_cache'
+
+USAGE = 'usage: cache [--ttl duration] [--dep file]... [--env name]... command [args...] | cache --stats | --clear\n'
+
+# Size the cache is kept under when MYSH_CACHE_MAX isn't set
+DEFAULT_CACHE_SIZE = 256 << 20
+
+# Variables that change the output of many commands, always part of the key
+KEY_VARIABLES = ('LANG', 'LC_ALL', 'LC_COLLATE', 'TZ')
+
+# Bytes read from the command per system call
+CHUNK_SIZE = 1 << 16
+
+# Each entry starts with a magic number, the exit status and when it was stored
+_HEADER = struct.Struct('!4sid')
+_MAGIC = b'MYC1'
+
+# The stats file holds the number of hits and misses
+_STATS = struct.Struct('!QQ')
+_STATS_FILE = 'stats'
+
+def cache_directory():
+    '''
+    Helper function to get the directory the cache is kept in.
+    '''
+    return os.path.join(os.getenv('MYSHDOTDIR', os.path.expanduser('~')), CACHE_DIRECTORY)
+
+def cache_limit():
+    '''
+    Helper function to read the most bytes the cache may hold from MYSH_CACHE_MAX.
+    '''
+    return size_setting('MYSH_CACHE_MAX') or DEFAULT_CACHE_SIZE
+
+def _is_entry(name):
+    '''
+    Helper function to test if a file name in the cache directory is an entry.
+    '''
+    return len(name) == 64 and not name.strip('0123456789abcdef')
+
+def _fingerprint(path):
+    '''
+    Helper function to describe the version of a file by its path, mtime and size.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return f'{os.path.abspath(path)}\0missing'
+    return f'{os.path.abspath(path)}\0{st.st_mtime_ns}\0{st.st_size}'
+
+def cache_key(command, program, dependencies=(), variables=()):
+    '''
+    Get the key of the entry for command, run from program (None for a built-in).
+    '''
+    import hashlib
+    parts = ['\0'.join(command), os.getcwd(), 'builtin' if program is None else _fingerprint(program)]
+    parts += [_fingerprint(path) for path in dependencies]
+    for name in KEY_VARIABLES + tuple(variables):
+        value = os.environ.get(name)
+        parts.append(f'{name}\0unset' if value is None else f'{name}={value}')
+    return hashlib.sha256('\n'.join(parts).encode(errors='surrogateescape')).hexdigest()
+
+def _count(directory, hit):
+    '''
+    Helper function to add a hit or a miss to the stats file, locked against other shells.
+    '''
+    import fcntl
+    try:
+        fd = os.open(os.path.join(directory, _STATS_FILE), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    except OSError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = os.pread(fd, _STATS.size, 0)
+        hits, misses = _STATS.unpack(data) if len(data) == _STATS.size else (0, 0)
+        if hit:
+            hits += 1
+        else:
+            misses += 1
+        os.pwrite(fd, _STATS.pack(hits, misses), 0)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _serve(path, ttl, out_fd):
+    '''
+    Helper function to copy the output of the entry at path to out_fd.
+
+    Returns the stored exit status, None if there is no usable entry, or 1
+    if the output couldn't be written.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    except OSError:
+        return None
+    try:
+        header = os.read(fd, _HEADER.size)
+        if len(header) != _HEADER.size:
+            return None
+        magic, status, stored = _HEADER.unpack(header)
+        if magic != _MAGIC or (ttl is not None and time.time() - stored > ttl):
+            return None
+        # The mtime of an entry is when it was last used, for the LRU eviction
+        os.utime(fd)
+        try:
+            copy_fd(fd, out_fd)
+        except BrokenPipeError:
+            # Nothing reads the output any more, like when the command runs
+            return 1
+        except OSError as e:
+            sys.stderr.write(f'mysh: cache: {e.strerror}\n')
+            return 1
+        return status
+    finally:
+        os.close(fd)
+
+def _write_all(fd, data):
+    '''
+    Helper function to write all of data to fd.
+    '''
+    with memoryview(data) as view:
+        while view:
+            view = view[os.write(fd, view):]
+
+def _run(command, program, out_fd, entry_fd):
+    '''
+    Helper function to run command, copying its output to out_fd and to the file entry_fd.
+
+    Returns its exit status, or None if it couldn't be started (the error is written already).
+    '''
+    import awaiting
+    from executing_commands import run_builtin
+    from spawning import spawn, fork_function
+    from jobs import Job
+    rfd, wfd = os.pipe2(os.O_CLOEXEC)
+    started = time.perf_counter()
+    try:
+        try:
+            if program is None:
+                pid = fork_function(run_builtin, command, stdout=wfd, close_fds=(rfd,))
+            else:
+                pid = spawn(program, command, stdout=wfd)
+        finally:
+            os.close(wfd)
+    except OSError as e:
+        os.close(rfd)
+        sys.stderr.write(f'cache: {command[0]}: {e.strerror}\n')
+        return None
+
+    try:
+        while True:
+            data = os.read(rfd, CHUNK_SIZE)
+            if not data:
+                break
+            if out_fd is not None:
+                try:
+                    _write_all(out_fd, data)
+                except BrokenPipeError:
+                    # Nothing reads the output any more, but the entry can still be completed
+                    out_fd = None
+            if entry_fd is not None:
+                _write_all(entry_fd, data)
+    finally:
+        os.close(rfd)
+    return awaiting.wait(Job(pid, [pid], ' '.join(command), started=started))
+
+def _evict(directory, limit):
+    '''
+    Helper function to remove the least recently used entries until the cache holds at most limit bytes.
+    '''
+    entries = []
+    total = 0
+    with os.scandir(directory) as scanned:
+        for entry in scanned:
+            if _is_entry(entry.name):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                total += st.st_size
+    if total <= limit:
+        return
+    entries.sort()
+    for _, size, path in entries:
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= limit:
+            break
+
+def _store(directory, key, command, program, out_fd):
+    '''
+    Helper function to run command and store its output as the entry key.
+
+    The entry is written to a temporary file and renamed into place, so
+    other shells never see half of it. Returns the exit status.
+    '''
+    temporary = os.path.join(directory, f'{key}.{os.getpid()}.tmp')
+    try:
+        entry_fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o600)
+    except OSError as e:
+        sys.stderr.write(f'mysh: cache: {directory}: {e.strerror}\n')
+        entry_fd = None
+    stored = False
+    try:
+        if entry_fd is not None:
+            os.write(entry_fd, _HEADER.pack(_MAGIC, 0, time.time()))
+        status = _run(command, program, out_fd, entry_fd)
+        if status is None:
+            return 127 if program is None else 126
+        limit = cache_limit()
+        if entry_fd is not None and status <= 128 and os.lseek(entry_fd, 0, os.SEEK_CUR) <= limit:
+            os.pwrite(entry_fd, _HEADER.pack(_MAGIC, status, time.time()), 0)
+            os.replace(temporary, os.path.join(directory, key))
+            stored = True
+            _evict(directory, limit)
+        return status
+    except OSError as e:
+        sys.stderr.write(f'mysh: cache: {e.strerror}\n')
+        return 1
+    finally:
+        if entry_fd is not None:
+            os.close(entry_fd)
+            if not stored:
+                try:
+                    os.unlink(temporary)
+                except OSError:
+                    pass
+
+def _format_size(size):
+    '''
+    Helper function to format a size in bytes with a K, M or G suffix.
+    '''
+    for suffix in ('', 'K', 'M'):
+        if size < 1024:
+            return f'{round(size, 1):g}{suffix}'
+        size /= 1024
+    return f'{round(size, 1):g}G'
+
+def _stats(directory, stdout):
+    '''
+    Helper function to write the hits, misses and size of the cache.
+    '''
+    try:
+        with open(os.path.join(directory, _STATS_FILE), 'rb') as f:
+            data = f.read(_STATS.size)
+        hits, misses = _STATS.unpack(data) if len(data) == _STATS.size else (0, 0)
+    except OSError:
+        hits = misses = 0
+    count = total = 0
+    try:
+        with os.scandir(directory) as scanned:
+            for entry in scanned:
+                if _is_entry(entry.name):
+                    count += 1
+                    total += entry.stat().st_size
+    except OSError:
+        pass
+    rate = f', {hits * 100 / (hits + misses):.0f}% hit rate' if hits + misses else ''
+    stdout.write(f'cache: {hits} hits, {misses} misses{rate}\n')
+    stdout.write(f'cache: {count} entries, {_format_size(total)} of {_format_size(cache_limit())} in {directory}\n')
+    return 0
+
+def _clear(directory):
+    '''
+    Helper function to remove every entry and the stats.
+    '''
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        sys.stderr.write(f'mysh: cache: {directory}: {e.strerror}\n')
+        return 1
+    for name in names:
+        if _is_entry(name) or name == _STATS_FILE:
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass
+    return 0
+
+def cache_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the cache built-in command.
+
+    Returns the exit status of the command (run now or stored), 2 for a usage error.
+    '''
+    from awaiting import parse_duration
+    from executing_commands import is_builtin
+    from command_hash import find_command
+    if stdout is None:
+        stdout = sys.stdout
+    arguments = list(parsed_line[1:])
+    directory = cache_directory()
+    ttl = None
+    dependencies = []
+    variables = []
+    try:
+        while arguments and arguments[0].startswith('--'):
+            option = arguments.pop(0)
+            if option == '--':
+                break
+            if option == '--stats' and not arguments:
+                return _stats(directory, stdout)
+            if option == '--clear' and not arguments:
+                return _clear(directory)
+            if option not in ('--ttl', '--dep', '--env') or not arguments:
+                raise ValueError(f'{option}: invalid option' if option not in ('--ttl', '--dep', '--env')
+                                 else f'{option}: option requires an argument')
+            value = arguments.pop(0)
+            if option == '--ttl':
+                ttl = parse_duration(value)
+            elif option == '--dep':
+                dependencies.append(os.path.expanduser(value))
+            else:
+                variables.append(value)
+        if not arguments:
+            raise ValueError('no command given')
+    except ValueError as e:
+        sys.stderr.write(f'cache: {e}\n' + USAGE)
+        return 2
+
+    command = arguments
+    if is_builtin(command):
+        program = None
+    else:
+        program = command[0] if '/' in command[0] else find_command(command[0])
+        if program is None or not os.path.exists(program):
+            sys.stderr.write(f'mysh: command not found: {command[0]}\n')
+            return 127
+
+    stdout.flush()
+    out_fd = stdout.fileno()
+    key = cache_key(command, program, dependencies, variables)
+    status = _serve(os.path.join(directory, key), ttl, out_fd)
+    if status is not None:
+        _count(directory, True)
+        return status
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    except OSError as e:
+        sys.stderr.write(f'mysh: cache: {directory}: {e.strerror}\n')
+    _count(directory, False)
+    return _store(directory, key, command, program, out_fd)
@@ -0,0 +1,125 @@
+'''
+Module to capture the output of commands, used by var -s.
+'''
+import os
+import sys
+import time
+from spawning import spawn
+import accounting
+import awaiting
+import tracing
+from jobs import exit_code
+
+# Bytes asked for per read, and the size the capture buffer starts at
+CHUNK_SIZE = 1 << 16
+
+def size_setting(name):
+    '''
+    Helper function to read a size in bytes from the environment variable name.
+
+    The value is a number of bytes with an optional K, M or G suffix. Unset,
+    empty, 0 or invalid values give None.
+    '''
+    value = os.getenv(name, '').strip().upper()
+    if not value:
+        return None
+    multiplier = 1
+    if value[-1] in 'KMG':
+        multiplier = 1024 ** ('KMG'.index(value[-1]) + 1)
+        value = value[:-1]
+    try:
+        size = int(value) * multiplier
+    except ValueError:
+        sys.stderr.write(f"mysh: {name}: invalid size: {os.environ[name]}\n")
+        return None
+    return size if size > 0 else None
+
+def capture_limit():
+    '''
+    Helper function to read the maximum capture size from MYSH_CAPTURE_MAX.
+
+    Unset, empty or 0 means the output is captured in full.
+    '''
+    return size_setting('MYSH_CAPTURE_MAX')
+
+def read_all(fd, limit=None):
+    '''
+    Read fd until EOF into a growing bytearray and return (data, truncated).
+
+    Anything past limit bytes is still read, so the writer never blocks on a
+    full pipe, but it is thrown away.
+    '''
+    buffer = bytearray(CHUNK_SIZE if limit is None else min(CHUNK_SIZE, limit))
+    size = 0
+    truncated = False
+    scratch = None
+
+    with open(fd, 'rb', buffering=0, closefd=False) as reader:
+        while True:
+            if limit is not None and size >= limit:
+                if scratch is None:
+                    scratch = bytearray(CHUNK_SIZE)
+                if reader.readinto(scratch) == 0:
+                    break
+                truncated = True
+                continue
+
+            if size == len(buffer):
+                # Double the buffer so large outputs need few reallocations
+                new_size = 2 * len(buffer)
+                if limit is not None:
+                    new_size = min(new_size, limit)
+                buffer.extend(bytes(new_size - len(buffer)))
+
+            with memoryview(buffer) as view:
+                count = reader.readinto(view[size:])
+            if count == 0:
+                break
+            size += count
+
+    del buffer[size:]
+    return buffer, truncated
+
+def capture_output(path, arguments):
+    '''
+    Run a command with its stdout captured, returning (output, exit status).
+
+    The command's stderr is left connected to the shell's stderr.
+    '''
+    rfd, wfd = os.pipe()
+    started = time.perf_counter()
+    try:
+        pid = spawn(path, arguments, stdout=wfd, close_fds=(rfd, wfd))
+    except OSError:
+        os.close(rfd)
+        raise
+    finally:
+        os.close(wfd)
+
+    limit = capture_limit()
+    try:
+        if tracing.enabled:
+            output, truncated, status = tracing.call('wait', ' '.join(arguments), _collect,
+                                                     pid, rfd, limit, arguments, started)
+        else:
+            output, truncated, status = _collect(pid, rfd, limit, arguments, started)
+    finally:
+        os.close(rfd)
+
+    if truncated:
+        sys.stderr.write(f"mysh: output of {arguments[0]} truncated to {limit} bytes\n")
+    return output, status
+
+def _collect(pid, rfd, limit, arguments, started):
+    '''
+    Helper function to read the output of pid from rfd and reap it, returning (output, truncated, status).
+    '''
+    if awaiting.enabled():
+        # Read while waiting, so a deadline can stop a command that never closes its output
+        return awaiting.capture(pid, rfd, limit, ' '.join(arguments), started)
+    output, truncated = read_all(rfd, limit)
+    _, status, rusage = os.wait4(pid, 0)
+    # 128+N for a command killed by signal N, like the rest of the shell
+    status = exit_code(status)
+    accounting.record(' '.join(arguments), pid, status, rusage, time.perf_counter() - started)
+    return output, truncated, status
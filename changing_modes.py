@@ -0,0 +1,284 @@
+'''
+Module to implement the chmod built-in command.
+
+chmod [-R] [-f] mode file ...
+
+mode is octal (755) or symbolic, as comma separated clauses like u+rwx,go-w
+or a=rX. With -R every directory is walked with os.scandir, and the walk is
+split across a pool of threads, one directory at a time: os.chmod and
+os.stat release the GIL, so the threads keep several of them going at once.
+Symbolic links met during the walk are skipped, like GNU chmod does.
+
+Files are changed through a descriptor of their directory, so the kernel
+doesn't look up the whole path again for each of them, and a file whose mode
+wouldn't change isn't changed at all.
+
+Like GNU chmod, a directory keeps its setuid and setgid bits unless the mode
+sets or clears them explicitly: with u+s or g-s, with an s in an '=' clause,
+or with an octal mode of more than 4 digits (00755).
+'''
+import os
+import sys
+import _thread
+from built_in_commands import expanding_files
+
+USAGE = 'usage: chmod [-R] [-f] mode file ...\n'
+
+# Most threads walking a tree with -R
+MAX_WORKERS = 16
+
+_WHO = {'u': 0o4700, 'g': 0o2070, 'o': 0o1007, 'a': 0o7777}
+_PERMISSIONS = {'r': 0o444, 'w': 0o222, 'x': 0o111, 's': 0o6000, 't': 0o1000}
+
+class SymbolicMode:
+    '''
+    A parsed symbolic mode; calling it with a file's st_mode gives the new permission bits.
+
+    The result for each st_mode is kept, since a tree only has a few distinct modes.
+    '''
+    __slots__ = ('text', 'clauses', 'results')
+
+    def __init__(self, text):
+        '''
+        Parse text, raising ValueError if it isn't a valid symbolic mode.
+        '''
+        self.text = text
+        self.clauses = []
+        self.results = {}
+        umask = None
+        for clause in text.split(','):
+            i = 0
+            who = 0
+            while i < len(clause) and clause[i] in _WHO:
+                who |= _WHO[clause[i]]
+                i += 1
+            # The bits '=' clears
+            cleared = who
+            if not who:
+                # Without a who, the bits set in the umask aren't set (but '=' clears them)
+                if umask is None:
+                    umask = os.umask(0)
+                    os.umask(umask)
+                who = 0o7777 & ~umask
+                cleared = 0o7777
+            if i == len(clause):
+                raise ValueError(f"invalid mode: '{text}'")
+            while i < len(clause):
+                operator = clause[i]
+                if operator not in '+-=':
+                    raise ValueError(f"invalid mode: '{text}'")
+                i += 1
+                bits = 0
+                conditional = False
+                copy = None
+                if i < len(clause) and clause[i] in 'ugo':
+                    copy = clause[i]
+                    i += 1
+                else:
+                    while i < len(clause) and clause[i] in 'rwxXst':
+                        if clause[i] == 'X':
+                            conditional = True
+                        else:
+                            bits |= _PERMISSIONS[clause[i]]
+                        i += 1
+                # Without an s, '=' leaves the setuid and setgid bits of a directory alone
+                kept = 0 if bits & 0o6000 else 0o6000
+                self.clauses.append((who, cleared, operator, bits, conditional, copy, kept))
+
+    def __call__(self, st_mode):
+        result = self.results.get(st_mode)
+        if result is None:
+            result = self.results[st_mode] = self._adjust(st_mode)
+        return result
+
+    def _adjust(self, st_mode):
+        '''
+        Helper function to work out the permission bits the clauses give a file with st_mode.
+        '''
+        mode = st_mode & 0o7777
+        is_dir = (st_mode & 0o170000) == 0o040000
+        for who, cleared, operator, bits, conditional, copy, kept in self.clauses:
+            if copy is not None:
+                shift = {'u': 6, 'g': 3, 'o': 0}[copy]
+                bits = (mode >> shift & 7) * 0o111
+            elif conditional and (is_dir or mode & 0o111):
+                bits |= 0o111
+            bits &= who
+            if operator == '+':
+                mode |= bits
+            elif operator == '-':
+                mode &= ~bits
+            elif is_dir:
+                mode = mode & ~(cleared & ~kept) | bits
+            else:
+                mode = mode & ~cleared | bits
+        return mode
+
+def parse_mode(text):
+    '''
+    Get the octal mode in text as an int, or a SymbolicMode, raising ValueError if it is invalid.
+
+    An octal mode has at most 4 digits, after any leading zeros.
+    '''
+    if text.isdigit():
+        if len(text.lstrip('0')) > 4 or not set(text) <= set('01234567'):
+            raise ValueError(f"invalid mode: '{text}'")
+        return int(text, 8)
+    return SymbolicMode(text)
+
+class _Changer:
+    '''
+    Helper class to change the mode of files and walk trees, remembering if anything failed.
+
+    kept are the bits an octal mode leaves as they were on directories.
+    '''
+    def __init__(self, mode, quiet, kept=0):
+        self.mode = mode
+        self.quiet = quiet
+        self.kept = kept
+        self.failed = False
+        self.lock = _thread.allocate_lock()
+        self.stopped = False
+
+    def report(self, message, path, error):
+        '''
+        Write an error about path to stderr (unless -f) and remember the command failed.
+        '''
+        self.failed = True
+        if not self.quiet:
+            with self.lock:
+                sys.stderr.write(f"mysh: chmod: {message} '{path}': {error.strerror}\n")
+
+    def change(self, name, dir_fd=None, entry=None, directory=None, is_dir=None):
+        '''
+        Change the mode of the file name (in the directory dir_fd), returning False if that failed.
+
+        entry is its os.scandir entry, whose stat() is used for symbolic modes,
+        directory the path of dir_fd, only joined to name for errors, and is_dir
+        whether it is a directory (None if not known yet).
+        '''
+        mode = self.mode
+        try:
+            if mode.__class__ is not int or (self.kept and is_dir is not False):
+                st_mode = entry.stat(follow_symlinks=False).st_mode if entry is not None \
+                    else os.stat(name, dir_fd=dir_fd).st_mode
+                if mode.__class__ is not int:
+                    mode = mode(st_mode)
+                elif (st_mode & 0o170000) == 0o040000:
+                    mode |= st_mode & self.kept
+                if mode == st_mode & 0o7777:
+                    return True
+            os.chmod(name, mode, dir_fd=dir_fd)
+        except FileNotFoundError as e:
+            self.report('cannot access', name if directory is None else os.path.join(directory, name), e)
+            return False
+        except OSError as e:
+            self.report('changing permissions of', name if directory is None else os.path.join(directory, name), e)
+            return False
+        return True
+
+    def scan(self, directory, add):
+        '''
+        Change the mode of everything in directory, passing its subdirectories to add.
+        '''
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC)
+        except OSError as e:
+            self.report('cannot read directory', directory, e)
+            return
+        try:
+            with os.scandir(dir_fd) as entries:
+                for entry in entries:
+                    if self.stopped:
+                        return
+                    try:
+                        if entry.is_symlink():
+                            continue
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+                    # Directories are changed before they are read, so chmod -R u+rx can fix them
+                    if self.change(entry.name, dir_fd, entry, directory, is_dir) and is_dir:
+                        add(os.path.join(directory, entry.name))
+        except OSError as e:
+            self.report('cannot read directory', directory, e)
+        finally:
+            os.close(dir_fd)
+
+    def walk(self, root):
+        '''
+        Change the mode of everything under the directory root with a pool of threads.
+
+        With a single CPU the threads would only fight over the GIL, so the
+        tree is walked in this thread instead.
+        '''
+        count = min(MAX_WORKERS, os.cpu_count() or 1)
+        if count == 1:
+            pending = [root]
+            while pending:
+                self.scan(pending.pop(), pending.append)
+            return
+
+        import queue
+        import threading
+        pending = queue.Queue()
+
+        def work():
+            while True:
+                directory = pending.get()
+                if directory is None:
+                    return
+                try:
+                    if not self.stopped:
+                        self.scan(directory, pending.put)
+                finally:
+                    pending.task_done()
+
+        workers = [threading.Thread(target=work, daemon=True) for _ in range(count)]
+        for worker in workers:
+            worker.start()
+        pending.put(root)
+        try:
+            pending.join()
+        except KeyboardInterrupt:
+            self.stopped = True
+            raise
+        finally:
+            for _ in workers:
+                pending.put(None)
+
+def chmod_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the chmod built-in command.
+
+    Returns 1 if the mode is invalid or any file couldn't be changed.
+    '''
+    recursive = quiet = False
+    i = 1
+    # A mode like -w looks like an option, so only the known ones are taken as options
+    while i < len(parsed_line) and parsed_line[i].startswith('-') and len(parsed_line[i]) > 1 \
+            and set(parsed_line[i][1:]) <= set('Rf'):
+        recursive = recursive or 'R' in parsed_line[i]
+        quiet = quiet or 'f' in parsed_line[i]
+        i += 1
+    if i < len(parsed_line) and parsed_line[i] == '--':
+        i += 1
+    if len(parsed_line) - i < 2:
+        sys.stderr.write(USAGE)
+        return 1
+    try:
+        mode = parse_mode(parsed_line[i])
+    except ValueError as e:
+        sys.stderr.write(f'mysh: chmod: {e}\n')
+        return 1
+
+    # Like GNU chmod, an octal mode only clears the setuid and setgid bits of a
+    # directory when it has more than 4 digits
+    kept = 0o6000 & ~mode if mode.__class__ is int and len(parsed_line[i]) <= 4 else 0
+    changer = _Changer(mode, quiet, kept)
+    for path in parsed_line[i + 1:]:
+        path = expanding_files(path)
+        # Like other chmods, a symbolic link given by name is followed
+        if changer.change(path) and recursive and os.path.isdir(path):
+            changer.walk(path)
+    return 1 if changer.failed else 0
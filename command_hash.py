@@ -0,0 +1,123 @@
+'''
+Module to remember where commands were found on PATH (like the hash built-in in bash).
+'''
+import os
+import sys
+import tracing
+
+# Command name -> [full path, index of the PATH directory it was found in, hits]
+_hashed = {}
+
+# The PATH value the table was filled from, its directories and their mtimes
+_path_value = None
+_dirs = []
+_dir_mtimes = []
+
+def _dir_mtime(directory):
+    '''
+    Helper function to get the mtime of a PATH directory (None if it is missing).
+    '''
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+
+def _still_valid(index):
+    '''
+    Helper function to check that no directory searched before a hit has changed.
+
+    A new executable in an earlier directory would shadow the remembered one and a
+    removed executable changes the mtime of its own directory, so only the
+    directories up to and including the one the command was found in are checked.
+    '''
+    for i in range(index + 1):
+        if _dir_mtime(_dirs[i]) != _dir_mtimes[i]:
+            return False
+    return True
+
+def clear_hash():
+    '''
+    Forget every remembered command location.
+    '''
+    _hashed.clear()
+    for i in range(len(_dir_mtimes)):
+        _dir_mtimes[i] = None
+
+def find_command(command):
+    '''
+    Find the full path of a command on PATH, using the hash table when possible.
+
+    Returns None if the command is not an executable file in any PATH directory.
+    '''
+    global _path_value, _dirs, _dir_mtimes
+
+    path = os.getenv('PATH', os.defpath)
+    if path != _path_value:
+        # PATH itself changed, so nothing remembered can be trusted
+        _hashed.clear()
+        _path_value = path
+        _dirs = path.split(os.pathsep)
+        _dir_mtimes = [None] * len(_dirs)
+
+    entry = _hashed.get(command)
+    if entry is not None:
+        if _still_valid(entry[1]):
+            entry[2] += 1
+            return entry[0]
+        clear_hash()
+
+    if tracing.enabled:
+        return tracing.call('path_scan', command, _scan_path, command)
+    return _scan_path(command)
+
+def _scan_path(command):
+    '''
+    Helper function to look for a command in every PATH directory, remembering where it was found.
+    '''
+    for index, directory in enumerate(_dirs):
+        path_value = os.path.join(directory, command)
+        if os.path.isfile(path_value) and os.access(path_value, os.X_OK):
+            # Relative PATH entries depend on the current directory, so don't remember them
+            if all(os.path.isabs(d) for d in _dirs[:index + 1]):
+                for i in range(index + 1):
+                    if _dir_mtimes[i] is None:
+                        _dir_mtimes[i] = _dir_mtime(_dirs[i])
+                _hashed[command] = [path_value, index, 1]
+            return path_value
+    return None
+
+def hash_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the hash built-in command.
+    '''
+    if stdout is None:
+        stdout = sys.stdout
+    if len(parsed_line) == 1:
+        if not _hashed:
+            stdout.write('hash: hash table empty\n')
+            return 0
+        stdout.write('hits\tcommand\n')
+        for path_value, _, hits in _hashed.values():
+            stdout.write(f'{hits:4}\t{path_value}\n')
+    elif parsed_line[1] == '-r':
+        if len(parsed_line) > 2:
+            sys.stderr.write('hash: -r: not expecting any arguments\n')
+            return 1
+        else:
+            clear_hash()
+    elif parsed_line[1].startswith('-'):
+        sys.stderr.write(f'hash: invalid option: {parsed_line[1][:2]}\n')
+        return 1
+    else:
+        status = 0
+        for command in parsed_line[1:]:
+            if '/' in command:
+                continue
+            if find_command(command) is None:
+                sys.stderr.write(f'mysh: hash: {command}: not found\n')
+                status = 1
+            elif command in _hashed:
+                # Looking a command up with hash does not count as a hit
+                _hashed[command][2] = 0
+        return status
+    return 0
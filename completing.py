@@ -0,0 +1,194 @@
+'''
+Module to complete commands, file paths and ${VAR} names with Tab.
+
+Nothing is read until the first Tab. Then every PATH directory is listed once
+with os.scandir into a sorted list of executable names (merged with the
+built-ins), so completing a command is a bisect for the range of names starting
+with what was typed. File paths work the same way from a per-directory listing.
+Both are kept with the mtime of the directory they came from and only a
+directory whose mtime changed is listed again.
+'''
+from bisect import bisect_left
+import os
+from built_in_commands import BUILT_IN_COMMANDS
+
+# Characters that end a word for completion; '$', '{' and '/' stay inside it
+COMPLETER_DELIMS = ' \t\n|&<>'
+
+# PATH directory -> (mtime, names of the executables in it)
+_path_dirs = {}
+# The PATH value, and the mtimes of its directories, the command index was built from
+_path_value = None
+_path_mtimes = None
+# Sorted names of every executable on PATH and every built-in
+_commands = []
+
+# Directory -> (mtime, sorted names, names of the subdirectories)
+_dir_listings = {}
+
+# Matches of the word being completed, handed to readline one per call
+_matches = []
+
+def _mtime(directory):
+    '''
+    Helper function to get the mtime of a directory (None if it can't be read).
+    '''
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+
+def _scan_executables(directory):
+    '''
+    Helper function to list the names of the executable files in a directory.
+    '''
+    names = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mode & 0o111:
+                        names.append(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return names
+
+def _command_index():
+    '''
+    Helper function to get the sorted list of command names, listing again any
+    PATH directory that changed since it was last listed.
+    '''
+    global _path_value, _path_mtimes, _commands
+    path = os.getenv('PATH', os.defpath)
+    directories = [d for d in path.split(os.pathsep) if d]
+    mtimes = [_mtime(d) for d in directories]
+    if path == _path_value and mtimes == _path_mtimes:
+        return _commands
+
+    names = set(BUILT_IN_COMMANDS)
+    for directory, mtime in zip(directories, mtimes):
+        listing = _path_dirs.get(directory)
+        if listing is None or listing[0] != mtime or not os.path.isabs(directory):
+            listing = (mtime, _scan_executables(directory))
+            _path_dirs[directory] = listing
+        names.update(listing[1])
+    _path_value = path
+    _path_mtimes = mtimes
+    _commands = sorted(names)
+    return _commands
+
+def _listing(directory):
+    '''
+    Helper function to get (sorted names, subdirectory names) of an absolute
+    directory path, cached by mtime.
+    '''
+    mtime = _mtime(directory)
+    cached = _dir_listings.get(directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
+    names = []
+    subdirectories = set()
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                names.append(entry.name)
+                try:
+                    if entry.is_dir():
+                        subdirectories.add(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        return [], set()
+    names.sort()
+    _dir_listings[directory] = (mtime, names, subdirectories)
+    return names, subdirectories
+
+def _starting_with(names, prefix):
+    '''
+    Helper function to get the names in a sorted list that start with prefix.
+    '''
+    start = bisect_left(names, prefix)
+    # Everything starting with prefix sorts before prefix followed by the last code point
+    return names[start:bisect_left(names, prefix + '\U0010ffff', start)]
+
+def complete_command(text):
+    '''
+    Return the built-ins and executables on PATH starting with text, sorted.
+    '''
+    return _starting_with(_command_index(), text)
+
+def complete_path(text):
+    '''
+    Return the file paths starting with text, with a '/' after directories.
+
+    Hidden files are only offered when text asks for them with a leading '.'.
+    '''
+    directory, _, prefix = text.rpartition('/')
+    if directory or text.startswith('/'):
+        head = directory + '/'
+        names, subdirectories = _listing(os.path.abspath(os.path.expanduser(head)))
+    else:
+        head = ''
+        names, subdirectories = _listing(os.getcwd())
+    return [head + name + ('/' if name in subdirectories else '')
+            for name in _starting_with(names, prefix)
+            if prefix.startswith('.') or not name.startswith('.')]
+
+def complete_variable(text):
+    '''
+    Return $NAME or ${NAME} completions of text from the environment.
+    '''
+    if text.startswith('${'):
+        return ['${' + name + '}' for name in sorted(os.environ) if name.startswith(text[2:])]
+    return ['$' + name for name in sorted(os.environ) if name.startswith(text[1:])]
+
+def completions(text, line_before):
+    '''
+    Return the completions of the word text, given the line up to where it starts.
+
+    It is a command name if it is the first word of a pipeline stage (and has
+    no '/'), a variable if it starts with '$', and a file path otherwise.
+    '''
+    if text.startswith('$') and '}' not in text:
+        return complete_variable(text)
+    before = line_before.rstrip()
+    if '/' not in text and (not before or before[-1] in '|&' or before == 'time'):
+        return complete_command(text)
+    return complete_path(text)
+
+def _complete(text, state):
+    '''
+    Helper function called by readline for the state'th completion of text.
+    '''
+    if state == 0:
+        import readline
+        line = readline.get_line_buffer()
+        try:
+            _matches[:] = completions(text, line[:readline.get_begidx()])
+        except Exception:
+            # An exception here would be silently swallowed by readline anyway
+            _matches[:] = []
+    if state < len(_matches):
+        match = _matches[state]
+        # Finish a lone command or file name with a space, but not a directory
+        if len(_matches) == 1 and not match.endswith('/'):
+            match += ' '
+        return match
+    return None
+
+def setup_completion():
+    '''
+    Make Tab complete in readline, if it is available.
+    '''
+    try:
+        import readline
+    except ImportError:
+        return
+    readline.set_completer(_complete)
+    readline.set_completer_delims(COMPLETER_DELIMS)
+    if 'libedit' in (readline.__doc__ or ''):
+        readline.parse_and_bind('bind ^I rl_complete')
+    else:
+        readline.parse_and_bind('tab: complete')
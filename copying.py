@@ -0,0 +1,75 @@
+'''
+Module to copy data between file descriptors without going through Python objects.
+
+The kernel copies the data itself where it can: os.splice when the destination
+is a pipe and os.sendfile when the source is a regular file. Anything else (or a
+kernel that refuses) falls back to readinto on a reused buffer.
+'''
+import os
+import stat
+
+# Bytes moved per system call
+CHUNK_SIZE = 1 << 20
+
+# Spare buffers for the readinto fallback; a list so threads never share one
+_buffers = []
+
+def _splice(src, dst):
+    '''
+    Helper function to copy src into the pipe dst with splice; returns False if unsupported.
+    '''
+    try:
+        count = os.splice(src, dst, CHUNK_SIZE)
+    except (AttributeError, OSError) as e:
+        if isinstance(e, BrokenPipeError):
+            raise
+        return False
+    while count:
+        count = os.splice(src, dst, CHUNK_SIZE)
+    return True
+
+def _sendfile(src, dst):
+    '''
+    Helper function to copy the regular file src to dst with sendfile; returns False if unsupported.
+    '''
+    try:
+        count = os.sendfile(dst, src, None, CHUNK_SIZE)
+    except OSError as e:
+        if isinstance(e, BrokenPipeError):
+            raise
+        return False
+    while count:
+        count = os.sendfile(dst, src, None, CHUNK_SIZE)
+    return True
+
+def _read_write(src, dst):
+    '''
+    Helper function to copy src to dst through a reused buffer.
+    '''
+    try:
+        buffer = _buffers.pop()
+    except IndexError:
+        buffer = bytearray(CHUNK_SIZE)
+    try:
+        with memoryview(buffer) as view, open(src, 'rb', buffering=0, closefd=False) as reader:
+            while True:
+                count = reader.readinto(view)
+                if not count:
+                    break
+                written = 0
+                while written < count:
+                    written += os.write(dst, view[written:count])
+    finally:
+        _buffers.append(buffer)
+
+def copy_fd(src, dst):
+    '''
+    Copy everything left in src to dst, raising OSError if reading or writing fails.
+    '''
+    if stat.S_ISFIFO(os.fstat(dst).st_mode):
+        if _splice(src, dst):
+            return
+    elif stat.S_ISREG(os.fstat(src).st_mode):
+        if _sendfile(src, dst):
+            return
+    _read_write(src, dst)
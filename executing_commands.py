@@ -1,90 +1,118 @@
 '''
 Module to handle executing commands that are a part of the systems PATH.
 '''
-import signal
-import re
 import sys
 import os
-from parsing import split_by_pipe_op, splitting_arguments
+import errno
+import time
+import _signal
+from parsing import parse_line, ParseError
 from built_in_commands import (
-    valid_var_name, expanding_variables,
-    expanding_files, for_escaped_variables,
-    chmod
+    expanding_files,
+    cd, pwd, which, exit,
+    cat, cat_options_supported, cat_reads_stdin
 )
+from expansion import valid_var_name, expand_arguments, ExpansionError
+from command_hash import find_command, hash_command
+from spawning import spawn, fork_function
+from capturing import capture_output
+import jobs
+import awaiting
+from jobs import (
+    Job, start_background, restore_terminal,
+    jobs_command, fg_command, bg_command, wait_command, kill_command, signal_number
+)
+from parallel import parallel_command
+import tracing
+from tracing import trace_command
+from changing_modes import chmod_command
+from caching import cache_command
+from accounting import Timer
+from redirecting import open_redirects, redirect_error, redirected, pipe_size, make_pipe
 
-def executing_command(cmd, arguments):
+def executing_command(cmd, arguments, stdin=None, stdout=None, stderr=None):
     '''
-    Function for executing commands on PATH.
+    Function for executing commands on PATH, returns the exit status.
+
+    stdin, stdout and stderr are descriptors to redirect the command to.
     '''
     try:
-        pid = os.fork()
-        if pid == 0:
-            os.setpgid(0, 0)
-            os.execvp(cmd, arguments)
-            sys.stderr.write(f"{cmd}: command not found\n")
-            os._exit(1)
-        else:
-            while True:
-                try:
-                    finished_pid = os.waitpid(pid, 0)
-                    if finished_pid == pid:
-                        break
-                except ChildProcessError:
-                    break
-            if os.isatty(sys.stdin.fileno()):
-                os.tcsetpgrp(sys.stdin.fileno(), os.getpgrp())
+        started = time.perf_counter()
+        pid = spawn(cmd, arguments, stdin=stdin, stdout=stdout, stderr=stderr)
+        # The command gets its own process group, so only its status is collected
+        return awaiting.wait(Job(pid, [pid], ' '.join(arguments), started=started))
+    except FileNotFoundError:
+        sys.stderr.write(f"{cmd}: command not found\n")
+        return 127
     except OSError as e:
+        if e.errno == errno.E2BIG:
+            sys.stderr.write(f"mysh: {arguments[0]}: argument list too long (batch {arguments[0]} ... runs it in batches)\n")
+            return 126
         sys.stderr.write(f"OS error while executing command {cmd}: {e}\n")
+        return 126
 
-def var(parsed_line):
+def var(parsed_line, stdout=None):
     '''
     Implementing functionality for the var built-in command.
     '''
+    if stdout is None:
+        stdout = sys.stdout
 
-    invalid = re.compile(r'[^a-zA-Z0-9_]')
     if len(parsed_line)==3:
         variable_name = parsed_line[1]
         argument = parsed_line[2]
-        if invalid.search(variable_name):
-            sys.stdout.write(f'var: invalid characters for variable {variable_name}\n')
+        if not valid_var_name(variable_name):
+            stdout.write(f'var: invalid characters for variable {variable_name}\n')
+            return 1
         else:
             if variable_name=='PROMPT':
                 prompt = os.environ['PROMPT']
                 command = input(prompt)
             os.environ[variable_name] = argument
     elif (len(parsed_line)>=4) and (parsed_line[1].find('-')== -1):
-        sys.stdout.write(f'var: expected 2 arguments, got {len(parsed_line)-1}\n')
+        stdout.write(f'var: expected 2 arguments, got {len(parsed_line)-1}\n')
+        return 1
     elif (len(parsed_line)==4) and (parsed_line[1]!='-s'):
         element = parsed_line[1]
         element = element.strip('-')
         element = element[0]
-        sys.stdout.write(f'var: invalid option: -{element}\n')
+        stdout.write(f'var: invalid option: -{element}\n')
+        return 1
     elif (len(parsed_line)>=4) and (parsed_line[1].lower()=='-s'):
         variable_name = parsed_line[2]
         executing_command = ''.join(parsed_line[3:])
 
-        if invalid.search(variable_name):
-            if '{' in variable_name and '}' in variable_name:
-                start = variable_name.find('{') + 1
-                end = variable_name.find('}')
-                extracted = variable_name[start:end]
-                if not valid_var_name(extracted):
-                    sys.stderr.write(
-                        f'mysh: syntax error: invalid characters '
-                        f'for variable {extracted}\n'
-                    )
-                    return
+        if not valid_var_name(variable_name):
+            stdout.write(f'var: invalid characters for variable {variable_name}\n')
+            return 1
         else:
-            parsed_input = splitting_arguments(executing_command)
-            os.environ[variable_name] = executing_commands_for_var(parsed_input)
-    return
+            # The arguments of var were already expanded, so they aren't expanded again
+            try:
+                parsed_input = list(parse_line(executing_command).commands[0].argv)
+            except ParseError as e:
+                sys.stderr.write(f'mysh: syntax error: {e}\n')
+                return 2
+            if not parsed_input:
+                return 0
+            output, status = executing_commands_for_var(parsed_input)
+            if output is not None:
+                if '\0' in output:
+                    # The environment can't hold a NUL, so nothing is stored
+                    sys.stderr.write(f'mysh: var: {variable_name}: output contains a null byte\n')
+                    return 1
+                os.environ[variable_name] = output
+            return status
+    return 0
 
 def executing_commands_for_var(parsed_line):
     '''
     Executing commands for var -s using piping.
+
+    Returns the captured output (None if the command couldn't be run) and the
+    command's exit status.
     '''
     command = parsed_line[0]
-    args = [expanding_variables(arg) for arg in parsed_line]
+    args = list(parsed_line)
     flag = False
 
     if command == 'cat' and len(args) > 1:
@@ -100,227 +128,451 @@ def executing_commands_for_var(parsed_line):
             else:
                 error_message = "no such file or directory"
             sys.stderr.write(f"mysh: {error_message}: {command}\n")
-            return None
+            return None, 126 if os.path.isfile(command) else 127
     else:
-        path = os.getenv('PATH', os.defpath)
-        for directory in path.split(os.pathsep):
-            path_value = os.path.join(directory, command)
-            if os.path.isfile(path_value) and os.access(path_value, os.X_OK):
-                result = run_piped_command(path_value, args, flag)
-                if flag:
-                    return result
-                return result.strip()
+        path_value = find_command(command)
+        if path_value is not None:
+            return run_piped_command(path_value, args, flag)
 
         sys.stderr.write(f"mysh: command not found: {command}\n")
-        return None
+        return None, 127
 
 def run_piped_command(cmd, arguments, flag):
     '''
     Running commands that are on PATH using piping.
     '''
     try:
-        rfd, wfd = os.pipe()
-        pid = os.fork()
-
-        if pid == 0:
-            os.setpgid(0, 0)
-            os.close(rfd)
-            os.dup2(wfd, 1)
-            os.dup2(wfd, 2)
-            os.close(wfd)
-            os.execvp(cmd, arguments)
+        output, status = capture_output(cmd, arguments)
+        output = output.decode(errors='surrogateescape')
+        restore_terminal()
+        if flag:
+            return output, status
         else:
-            os.close(wfd)
-            output = os.read(rfd, 4096).decode()
-            os.close(rfd)
-            _, status = os.waitpid(pid, 0)
-            os.tcsetpgrp(sys.stdin.fileno(), os.getpgrp())
-            if flag:
-                return output
-            else:
-                return output.strip()
+            return output.strip(), status
     except Exception as e:
         sys.stderr.write(f"Error executing command: {cmd}\n")
-        return None
+        return None, 126
 
 def handle_interrupt(signum, frame):
     '''
     Helper function to handle the interrupt.
     '''
-    interrupted = True
-    os.killpg(0, signal.SIGTERM)
+    os.killpg(0, _signal.SIGTERM)
     sys.exit(1)
 
-def executing_commands_with_escape_variable(parsed_line):
+def executing_commands_with_no_escape_variables(parsed_line, fds=(None, None, None)):
     '''
-    Executes commands on PATH for variables that are escaped.
+    Function for executing commands on PATH, returns the exit status.
+
+    parsed_line holds the arguments after variable expansion, and fds the
+    (stdin, stdout, stderr) descriptors its redirections opened.
     '''
     command = parsed_line[0]
-    args = [for_escaped_variables(arg) for arg in parsed_line]       
+    args = list(parsed_line)
+
+    if command == 'cat' and len(args) > 1:
+        args[1] = expanding_files(args[1])
+
     if '/' in command:
         if os.path.isfile(command) and os.access(command, os.X_OK):
-            executing_command(command, args)
+            return executing_command(command, [command] + args[1:], *fds)
         else:
-            sys.stderr.write(f"mysh: {'permission denied' if os.path.isfile(command) else 'no such file or directory'}: {command}\n")
+            sys.stderr.write(
+                f"mysh: {'permission denied' if os.path.isfile(command) else 'no such file or directory'}: "
+                f"{command}\n"
+            )
+            return 126 if os.path.isfile(command) else 127
     else:
-        path = os.getenv('PATH', os.defpath)
-        for directory in path.split(os.pathsep):
-            path_value = os.path.join(directory, command)
-            if os.path.isfile(path_value) and os.access(path_value, os.X_OK):
-                executing_command(path_value, args)
-                return  
-        sys.stderr.write(f"mysh: command not found: {command}\n") 
+        path_value = find_command(command)
+        if path_value is not None:
+            return executing_command(path_value, [command] + args[1:], *fds)
+        else:
+            sys.stderr.write(f"mysh: command not found: {command}\n")
+            return 127
 
-def executing_commands_with_no_escape_variables(parsed_line):
+def time_command(parsed_line, stdout=None):
     '''
-    Function for executing commands on PATH with no escape variable.
+    Implementing functionality for the time built-in command.
+
+    Runs the rest of the line as a command and reports its wall, user and sys
+    time, max RSS and context switches on stderr. A whole pipeline is timed by
+    the shell itself when time starts the line (see mysh.run_line).
     '''
-    interrupted = False  
-    signal.signal(signal.SIGINT, handle_interrupt)  
+    with Timer():
+        if len(parsed_line) == 1:
+            return 0
+        if is_builtin(parsed_line[1:]):
+            return run_builtin(parsed_line[1:], stdout)
+        return executing_commands_with_no_escape_variables(parsed_line[1:])
 
-    command = parsed_line[0]
-    args = [expanding_variables(arg) for arg in parsed_line]
+def batch_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the batch built-in command (see globbing.batch_command).
 
-    if len(parsed_line) == 2:
-        element = parsed_line[1]
-        if '{' in element and '}' in element:
-            start = element.find('{') + 1
-            end = element.find('}')
-            extracted = element[start:end]
+    globbing is only imported once it is used, since most lines have no wildcards.
+    '''
+    from globbing import batch_command
+    return batch_command(parsed_line, stdout)
 
-            if not valid_var_name(extracted):
-                sys.stderr.write(f'mysh: syntax error: invalid characters for variable {extracted}\n')
-                return
+def history_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the history built-in command (see history.history_command).
 
-    if command == 'cat' and len(args) > 1:
-        args[1] = expanding_files(args[1])
+    The history module is only imported once it is used, since scripts and -c
+    commands never need it.
+    '''
+    import history
+    return history.history_command(parsed_line, stdout)
 
-    if command == 'chmod' and len(args) >= 3:
-        mode = args[1]
-        file_path = args[2]
-        try:
-            if mode.isdigit():
-                os.chmod(file_path, int(mode, 8))
-            elif mode.startswith(('+', '-')):
-                chmod(file_path, mode)
-            else:
-                sys.stderr.write(f"mysh: chmod: invalid mode: {mode}\n")
-        except FileNotFoundError:
-            sys.stderr.write(
-                f"mysh: chmod: cannot access '{file_path}': "
-                "No such file or directory\n"
-            )
-        except PermissionError:
-            sys.stderr.write(f"mysh: chmod: permission denied for '{file_path}'\n")
-        return
+TIMEOUT_USAGE = 'usage: timeout [-s signal] [-k duration] duration command ...\n'
 
-    pid_list = []  
+def timeout_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the timeout built-in command.
 
-    if '/' in command:
-        if os.path.isfile(command) and os.access(command, os.X_OK):
-            pid = executing_command(command, [command] + args[1:])
-            if pid is not None:
-                pid_list.append(pid)
-        else:
-            sys.stderr.write(
-                f"mysh: {'permission denied' if os.path.isfile(command) else 'no such file or directory'}: "
-                f"{command}\n"
-            )
-            return
-    else:
-        path = os.getenv('PATH', os.defpath)
-        for directory in path.split(os.pathsep):
-            path_value = os.path.join(directory, command)
-            if os.path.isfile(path_value) and os.access(path_value, os.X_OK):
-                pid = executing_command(path_value, [command] + args[1:])
-                if pid is not None:
-                    pid_list.append(pid)
+    timeout [-s SIGNAL] [-k DURATION] DURATION command ... runs the command and
+    sends it SIGNAL (SIGTERM by default) if it is still running after DURATION,
+    then SIGKILL if it is still running -k DURATION later (5s by default).
+    Returns 124 if it was stopped, 137 if it had to be killed, and 125 if the
+    arguments are invalid, like GNU timeout.
+    '''
+    arguments = parsed_line[1:]
+    number = _signal.SIGTERM
+    kill_after = awaiting.KILL_AFTER
+    try:
+        while arguments and arguments[0].startswith('-') and len(arguments) > 1:
+            option = arguments.pop(0)
+            if option == '--':
                 break
+            if option not in ('-s', '-k'):
+                raise ValueError(f'{option}: invalid option')
+            value = arguments.pop(0)
+            if option == '-k':
+                kill_after = awaiting.parse_duration(value)
+            else:
+                number = signal_number(value)
+        if len(arguments) < 2:
+            raise ValueError('missing duration or command')
+        duration = awaiting.parse_duration(arguments[0])
+    except ValueError as e:
+        sys.stderr.write(f'timeout: {e}\n' + TIMEOUT_USAGE)
+        return 125
+
+    command = arguments[1:]
+    out_fd = None
+    if stdout is not None:
+        stdout.flush()
+        out_fd = stdout.fileno()
+    sys.stdout.flush()
+    started = time.perf_counter()
+    try:
+        # The command gets its own process group, which is what the signals are sent to
+        if is_builtin(command):
+            pid = fork_function(run_builtin, command, stdout=out_fd)
         else:
-            sys.stderr.write(f"mysh: command not found: {command}\n")
-            return
+            path = command[0] if '/' in command[0] else find_command(command[0])
+            if path is None:
+                sys.stderr.write(f'mysh: command not found: {command[0]}\n')
+                return 127
+            pid = spawn(path, command, stdout=out_fd)
+    except FileNotFoundError:
+        sys.stderr.write(f'mysh: no such file or directory: {command[0]}\n')
+        return 127
+    except OSError as e:
+        sys.stderr.write(f'timeout: {command[0]}: {e.strerror}\n')
+        return 126
+    job = Job(pid, [pid], ' '.join(command), started=started)
+    # A zero duration means no deadline, like GNU timeout
+    options = {'timeout': duration or None, 'kill_after': kill_after, 'signal_number': number}
+    if tracing.enabled:
+        return tracing.call('wait', job.command, awaiting.wait_for_job, job, **options)
+    return awaiting.wait_for_job(job, **options)
 
-    while pid_list:
-        try:
-            pid, status = os.wait()
-            if pid in pid_list:
-                pid_list.remove(pid)
-                if os.WIFEXITED(status) or os.WIFSIGNALED(status):
-                    continue
-        except ChildProcessError:
-            break
-        except KeyboardInterrupt:
-            sys.stderr.write("\nmysh: Process interrupted (Ctrl+C)\n")
-            for pid in pid_list:
-                try:
-                    os.kill(pid, signal.SIGKILL)  
-                except OSError:
-                    pass
-            pid_list.clear()
-
-    if interrupted:
-        sys.stderr.write("mysh: Interrupted by user\n")
-
-def executing_piped_commands(commands):
+def which_command(parsed_line, stdout=None):
+    '''
+    Helper function to run which from a full command line.
+    '''
+    if len(parsed_line) == 1:
+        sys.stderr.write('usage: which command ...\n')
+        return 1
+    return which(parsed_line[1:], stdout)
+
+# Built-in commands, all called as function(parsed_line, stdout) and returning a status
+BUILTINS = {
+    'exit': exit,
+    'cd': cd,
+    'pwd': pwd,
+    'which': which_command,
+    'var': var,
+    'hash': hash_command,
+    'jobs': jobs_command,
+    'fg': fg_command,
+    'bg': bg_command,
+    'wait': wait_command,
+    'kill': kill_command,
+    'parallel': parallel_command,
+    'time': time_command,
+    'timeout': timeout_command,
+    'cat': cat,
+    'history': history_command,
+    'trace': trace_command,
+    'batch': batch_command,
+    'chmod': chmod_command,
+    'cache': cache_command,
+}
+
+# Built-ins that change the shell itself; only the last stage of a pipeline may do that
+STATEFUL_BUILTINS = frozenset(('exit', 'cd', 'var', 'fg', 'bg', 'wait', 'trace'))
+
+# Built-ins that read their stdin (or run a command that may); after a pipe they run
+# in a forked copy reading from it
+STDIN_BUILTINS = frozenset(('parallel', 'timeout', 'batch', 'cache'))
+
+def is_builtin(parsed_line, piped_stdin=False):
+    '''
+    Helper function to test if a command is run by a built-in.
+
+    cat is only a built-in for the arguments it handles, and not when it would
+    read from a pipe, where the real cat needs no thread or fork of the shell.
+    '''
+    name = parsed_line[0].lower()
+    if name == 'cat':
+        return cat_options_supported(parsed_line) and not (piped_stdin and cat_reads_stdin(parsed_line))
+    return name in BUILTINS
+
+def run_builtin(parsed_line, stdout=None):
+    '''
+    Run a built-in command in the shell process and return its exit status.
+
+    An error writing its output (e.g. to a full disk) is reported like a
+    failing command's, with status 1, rather than ending the shell.
+    '''
+    name = parsed_line[0].lower()
+    try:
+        status = BUILTINS[name](parsed_line, stdout)
+        # Buffered output is written while the built-in's redirections are still in place
+        (sys.stdout if stdout is None else stdout).flush()
+    except BrokenPipeError:
+        # Nothing reads the output any more, which isn't worth a message
+        return 1
+    except OSError as e:
+        sys.stderr.write(f'mysh: {name}: {e.strerror}\n')
+        return 1
+    return 0 if status is None else status
+
+class _PipeWriter:
+    '''
+    Minimal unbuffered stdout for a built-in writing into a pipe.
+
+    Nothing is ever left in a buffer, so a reader that has gone away just
+    raises BrokenPipeError from write() and the pipe can be closed cleanly.
+    '''
+    __slots__ = ('fd',)
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, text):
+        data = text.encode(errors='surrogateescape')
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def flush(self):
+        pass
+
+    def fileno(self):
+        return self.fd
+
+def _builtin_stage(parsed_line, wfd):
+    '''
+    Helper function to run a built-in as a pipeline stage, writing into the pipe wfd.
+
+    It runs in its own thread so the shell can carry on starting and waiting
+    for the other stages; wfd is closed when it finishes so the next stage sees EOF.
+    '''
+    try:
+        run_builtin(parsed_line, _PipeWriter(wfd))
+    except (BrokenPipeError, SystemExit):
+        pass
+    finally:
+        os.close(wfd)
+
+def executing_piped_commands(commands, background=False, source=None):
     """
     Function that runs a series of commands connected by pipes.
+
+    commands are the parsed Command nodes of the pipeline, so no stage is split again.
+    Every stage joins one process group, which is the pipeline's job. Returns the
+    exit status of the last command, or 0 straight away when run in the background.
     """
-    signal.signal(signal.SIGINT, handle_interrupt)
+    try:
+        stage_args = [expand_arguments(command.words) for command in commands]
+    except ExpansionError as e:
+        sys.stderr.write(f'mysh: syntax error: {e}\n')
+        return 1
+    if source is None:
+        source = ' | '.join(command.source.strip() for command in commands)
+
     n = len(commands)
-    pipes = []
+    size = pipe_size()
+
+    # Looking the commands up in the parent so the hash table is shared
+    stage_paths = [
+        find_command(cmd_args[0]) if cmd_args and '/' not in cmd_args[0] else None
+        for cmd_args in stage_args
+    ]
 
-    for _ in range(n - 1):
-        pipes.append(os.pipe())
+    # Background jobs without job control must not read the shell's input
+    first_stdin = None
+    if background and not jobs.interactive:
+        first_stdin = os.open(os.devnull, os.O_RDONLY | os.O_CLOEXEC)
 
+    started = time.perf_counter()
+    pgid = 0
+    pids = []
+    names = {}
+    last_pid = None
+    last_builtin = None
+    threads = []
+    # Each pipe is only created when the stage writing into it starts, and the shell
+    # closes its copies of both ends as soon as the stages using them have started,
+    # so it never holds more than one pipe (plus a read end) whatever the length
+    pipe_in = first_stdin
     for i in range(n):
-        pid = os.fork()
-
-        if pid == 0:  
-            os.setpgid(0, 0)  
-            
-            if i > 0:
-                os.dup2(pipes[i-1][0], 0) 
-            
-            if i < n - 1:
-                os.dup2(pipes[i][1], 1) 
-
-            cmd_args = splitting_arguments(commands[i])
-            if cmd_args[0] == 'var':
-                var(cmd_args)  
-            else:
-                try:
-                    os.execvp(cmd_args[0], cmd_args)  
-                except Exception as e:
-                    sys.stderr.write(f'Command execution failed: {e}')
-                    os._exit(1)  
-        
-        else:    
-            if i > 0:
-                os.close(pipes[i-1][0])  
-            
-            if i < n - 1:
-                os.close(pipes[i][1])  
-
-    for pipe in pipes:
+        next_in = pipe_out = None
+        if i < n - 1:
+            next_in, pipe_out = make_pipe(size)
+        cmd_args = stage_args[i]
         try:
-            os.close(pipe[0])
-        except OSError as e:
-            if e.errno != 9:  
-                raise
+            stdin, stdout, stderr, opened = open_redirects(commands[i].redirects, pipe_in, pipe_out)
+        except (OSError, ExpansionError) as e:
+            # Like other shells, only this stage is skipped
+            redirect_error(e)
+            cmd_args = []
+            opened = []
+        name = cmd_args[0].lower() if cmd_args else None
+        pid = None
 
-        try:
-            os.close(pipe[1])
-        except OSError as e:
-            if e.errno != 9:  
-                raise
+        if cmd_args and is_builtin(cmd_args, piped_stdin=stdin is not None):
+            reads_pipe = stdin is not None and name in STDIN_BUILTINS
+            if i == n - 1 and not background and not reads_pipe:
+                # Run last, in the shell itself, so it can change the shell's state
+                last_builtin = cmd_args
+                last_fds = (None if stdin == pipe_in else stdin, stdout, stderr)
+                # Its redirections stay open until it has run
+                last_opened, opened = opened, []
+            elif name in STATEFUL_BUILTINS or background or reads_pipe or stderr is not None:
+                # These must not change (or hold up) the shell, so they get a forked copy
+                # A forked child doesn't exec, so close-on-exec doesn't close the next stage's end
+                unused = () if next_in is None else (next_in,)
+                pid = fork_function(run_builtin, cmd_args, stdin=stdin, stdout=stdout, stderr=stderr,
+                                    close_fds=unused, pgroup=pgid)
+            else:
+                import threading
+                # The thread closes its own copy of the write end when it is done
+                threads.append(threading.Thread(target=_builtin_stage, args=(cmd_args, os.dup(stdout))))
+        elif cmd_args:
+            try:
+                if stage_paths[i] is not None:
+                    pid = spawn(stage_paths[i], cmd_args, stdin=stdin, stdout=stdout, stderr=stderr,
+                                pgroup=pgid)
+                else:
+                    pid = spawn(cmd_args[0], cmd_args, stdin=stdin, stdout=stdout, stderr=stderr,
+                                pgroup=pgid, search_path=True)
+            except (OSError, IndexError) as e:
+                sys.stderr.write(f'Command execution failed: {e}\n')
+        if pid is not None:
+            pids.append(pid)
+            names[pid] = ' '.join(cmd_args)
+            if not pgid:
+                pgid = pid
+        if i == n - 1:
+            last_pid = pid
+
+        if pipe_in is not None:
+            os.close(pipe_in)
+
+        if pipe_out is not None:
+            os.close(pipe_out)
 
-    while True:
+        for fd in opened:
+            os.close(fd)
+        pipe_in = next_in
+
+    for thread in threads:
+        thread.start()
+
+    if background:
+        start_background(pids, source, names, started)
+        return 0
+
+    last_status = 127
+    if last_builtin is not None:
         try:
-            os.wait()
-        except ChildProcessError:
-            break  
-        except OSError as e:
-            if e.errno == 10: 
-                break
-            else:
-                raise
+            with redirected(last_fds):
+                last_status = run_builtin(last_builtin)
+        finally:
+            for fd in last_opened:
+                os.close(fd)
+
+    job = Job(pgid, pids, source, names, started)
+    status = awaiting.wait(job, consumer=last_pid)
+    if job.stopped:
+        last_status = status
+    elif last_pid is not None:
+        last_status = job.statuses.get(last_pid, last_status)
+
+    for thread in threads:
+        thread.join()
+    return last_status
+
+def missing_commands(commands: list) -> bool:
+    """
+    Testing for missing commands in piping.
+    """
+    for command in commands:
+        if not command.words:
+            sys.stderr.write('mysh: syntax error: expected command after pipe\n')
+            return False
+    return True
+
+def run_commands(commands: list, background: bool = False) -> int:
+    '''
+    Run the parsed commands of a line and return the exit status.
+    '''
+    if len(commands) > 1 or background:
+        # Handling piped commands and background jobs
+        if not missing_commands(commands):
+            return 2
+        return executing_piped_commands(commands, background)
+
+    # Handling single commands
+    try:
+        parsed_line = expand_arguments(commands[0].words)
+    except ExpansionError as e:
+        sys.stderr.write(f'mysh: syntax error: {e}\n')
+        return 1
+    redirects = commands[0].redirects
+    if not redirects:
+        if len(parsed_line) == 0:
+            return 0
+        if is_builtin(parsed_line):
+            return run_builtin(parsed_line)
+        return executing_commands_with_no_escape_variables(parsed_line)
+
+    try:
+        stdin, stdout, stderr, opened = open_redirects(redirects)
+    except (OSError, ExpansionError) as e:
+        redirect_error(e)
+        return 1
+    try:
+        if len(parsed_line) == 0:
+            # Just the redirections, e.g. '> file' to empty a file
+            return 0
+        if is_builtin(parsed_line, piped_stdin=stdin is not None):
+            with redirected((stdin, stdout, stderr)):
+                return run_builtin(parsed_line)
+        return executing_commands_with_no_escape_variables(parsed_line, (stdin, stdout, stderr))
+    finally:
+        for fd in opened:
+            os.close(fd)
@@ -0,0 +1,212 @@
+'''
+Module to expand ${VAR} references and $(...) command substitutions in arguments.
+
+Words with unquoted wildcards are then expanded into file names by globbing.py.
+
+Each word is compiled once into a tuple of literal strings and Variable
+segments; the tuple is cached on the parsed Word, so expanding it again is a
+single join of the literals and the current variable values. Words with
+command substitutions compile to a Substituted tuple instead, whose
+Substitution segments are run every time the word is expanded (see substituting.py).
+'''
+import os
+import tracing
+
+_NAME_CHARACTERS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+
+class ExpansionError(ValueError):
+    '''
+    Raised when a ${...} reference names an invalid variable.
+    '''
+    def __init__(self, name):
+        super().__init__(f'invalid characters for variable {name}')
+        self.name = name
+
+class SubstitutionError(ExpansionError):
+    '''
+    Raised when the commands of a $(...) can't be parsed.
+    '''
+    def __init__(self, message):
+        ValueError.__init__(self, message)
+        self.name = None
+
+class Variable:
+    '''
+    A ${name} reference inside a compiled word.
+    '''
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f'Variable({self.name!r})'
+
+class Substitution:
+    '''
+    A $(...) command substitution inside a compiled word; source is the text between the parentheses.
+    '''
+    __slots__ = ('source',)
+
+    def __init__(self, source):
+        self.source = source
+
+    def __repr__(self):
+        return f'Substitution({self.source!r})'
+
+class Substituted(tuple):
+    '''
+    The compiled segments of a word that has command substitutions.
+    '''
+    __slots__ = ()
+
+def valid_var_name(key):
+    '''
+    Helper function to test if a variable name is valid.
+    '''
+    return bool(key) and _NAME_CHARACTERS.issuperset(key)
+
+def compile_text(text, dollars, substitutions=()):
+    '''
+    Split text into literal strings, Variable and Substitution segments.
+
+    Only the '$' characters at the positions in dollars can start a reference,
+    which is how escaped '\\$' characters stay literal. substitutions holds the
+    (start, end) positions of the $(...) in text. A reference whose value
+    contains '${...}' is never expanded again, since values are only joined.
+
+    >>> compile_text('a${B}c${D}', (1, 6))
+    ('a', Variable('B'), 'c', Variable('D'))
+    >>> compile_text('${A}${B}', (4,))
+    ('${A}', Variable('B'))
+    >>> compile_text('x$(ls ${D})${E}', (1, 11), ((1, 11),))
+    ('x', Substitution('ls ${D}'), Variable('E'))
+    '''
+    segments = []
+    literal_start = 0
+    ends = dict(substitutions)
+    for position in dollars:
+        if position < literal_start:
+            continue
+        if position in ends:
+            if position > literal_start:
+                segments.append(text[literal_start:position])
+            segments.append(Substitution(text[position + 2:ends[position] - 1]))
+            literal_start = ends[position]
+            continue
+        if text[position + 1:position + 2] != '{':
+            continue
+        end = text.find('}', position + 2)
+        if end == -1:
+            break
+        name = text[position + 2:end]
+        if not name:
+            continue
+        if not valid_var_name(name):
+            raise ExpansionError(name)
+        if position > literal_start:
+            segments.append(text[literal_start:position])
+        segments.append(Variable(name))
+        literal_start = end + 1
+    if literal_start < len(text) or not segments:
+        segments.append(text[literal_start:])
+    if ends:
+        return Substituted(segments)
+    return tuple(segments)
+
+def evaluate(segments, env=None):
+    '''
+    Join compiled segments using the variable values in env (os.environ by default).
+    '''
+    if len(segments) == 1 and segments[0].__class__ is str:
+        return segments[0]
+    if env is None:
+        env = os.environ
+    if segments.__class__ is Substituted:
+        return _evaluate_substituted(segments, env)
+    get = env.get
+    return ''.join([
+        segment if segment.__class__ is str else get(segment.name, '')
+        for segment in segments
+    ])
+
+def _evaluate_substituted(segments, env):
+    '''
+    Helper function to join segments that include command substitutions, running them in order.
+    '''
+    # Imported here since running commands needs most of the shell
+    from substituting import substitute
+    parts = []
+    for segment in segments:
+        if segment.__class__ is str:
+            parts.append(segment)
+        elif segment.__class__ is Variable:
+            parts.append(env.get(segment.name, ''))
+        else:
+            parts.append(substitute(segment.source))
+    return ''.join(parts)
+
+def compile_word(word):
+    '''
+    Get the compiled segments of a parsed Word, compiling them on first use.
+    '''
+    segments = word.segments
+    if segments is None:
+        segments = word.segments = compile_text(word.text, word.dollars, word.substitutions)
+    return segments
+
+def expand_arguments(words, env=None):
+    '''
+    Expand the parsed words of a command into its final list of arguments.
+
+    Raises ExpansionError if a word references an invalid variable name.
+    '''
+    if tracing.enabled:
+        return tracing.call('expand', words[0].text if words else None, _expand_arguments, words, env)
+    return _expand_arguments(words, env)
+
+def _expand_arguments(words, env):
+    '''
+    Helper function that does the actual expansion for expand_arguments.
+    '''
+    if env is None:
+        env = os.environ
+    arguments = []
+    matched = None
+    for word in words:
+        if word.globs:
+            # Imported here since most lines have no wildcards
+            from globbing import expand_word
+            paths, found = expand_word(word, env)
+            if found:
+                start = len(arguments) if matched is None else matched[0]
+                matched = (start, len(arguments) + len(paths))
+            arguments.extend(paths)
+        else:
+            arguments.append(evaluate(compile_word(word), env))
+    if matched is not None:
+        from globbing import Expanded
+        return Expanded(arguments, matched)
+    return arguments
+
+_string_cache = {}
+
+def _compile_string(text):
+    '''
+    Helper function to compile a plain string, where every '$' can start a reference.
+    '''
+    segments = _string_cache.get(text)
+    if segments is None:
+        if len(_string_cache) >= 1024:
+            _string_cache.clear()
+        segments = compile_text(text, tuple(i for i, c in enumerate(text) if c == '$'))
+        _string_cache[text] = segments
+    return segments
+
+def expanding_string(text, env=None):
+    '''
+    Expand the ${VAR} references in a plain (already unquoted) string.
+    '''
+    if '$' not in text:
+        return text
+    return evaluate(_compile_string(text), env)
@@ -0,0 +1,336 @@
+'''
+Module to expand the *, ? and [...] wildcards of arguments into file names.
+
+Only the wildcard characters typed unquoted in the line are wildcards; quoted
+or escaped ones, and any coming from a ${VAR} or $(...), match themselves. A
+'**' component matches any number of directories (none included). Like in
+other shells, names starting with '.' only match a pattern that starts with
+'.' too, the matches are sorted, and a pattern matching nothing stays as typed.
+
+Each directory is read once per line with os.scandir, whose entries already
+know if they are directories, and kept until the next line, so several
+patterns over the same directory cost a single scan of it.
+
+A glob over a big directory can give more arguments than the kernel accepts
+for one command (ARG_MAX), and the command then fails with E2BIG. The batch
+built-in runs such a command as many times as needed instead, like xargs.
+'''
+import os
+import sys
+
+# Bytes left free under ARG_MAX for what the kernel adds to the arguments and environment
+ARG_MAX_HEADROOM = 4096
+
+# Exit status of batch when one of the runs failed, like xargs
+BATCH_FAILED_STATUS = 123
+
+# Each directory scanned during the current line, as [entries, names, names not starting
+# with '.', names of directories (None until needed)]
+_listings = {}
+
+# Functions picking the names matching a path component, for each component
+_matchers = {}
+
+class Expanded(list):
+    '''
+    The arguments of a command where some came from wildcards.
+
+    matched is the (start, end) range of the arguments holding every match
+    (see batch_command).
+    '''
+    __slots__ = ('matched',)
+
+    def __init__(self, arguments, matched):
+        super().__init__(arguments)
+        self.matched = matched
+
+def clear_cache():
+    '''
+    Forget the directories scanned so far; called before each line runs.
+    '''
+    _listings.clear()
+
+def _has_wildcards(text):
+    '''
+    Helper function to test if text has any of the wildcard characters.
+    '''
+    return '*' in text or '?' in text or '[' in text
+
+def escape(text):
+    '''
+    Helper function to make the wildcard characters in text match themselves.
+    '''
+    if not _has_wildcards(text):
+        return text
+    return ''.join([f'[{c}]' if c in '*?[' else c for c in text])
+
+def _listing(directory):
+    '''
+    Helper function to get the names in directory, scanning it once per line.
+
+    Returns the names and those of them not starting with '.'.
+    '''
+    listing = _listings.get(directory)
+    if listing is None:
+        try:
+            with os.scandir(directory or '.') as scanned:
+                entries = list(scanned)
+        except OSError:
+            entries = []
+        names = [entry.name for entry in entries]
+        # Sorted once here, the matches of a pattern come out (nearly) sorted already
+        names.sort()
+        visible = [name for name in names if name[0] != '.']
+        listing = _listings[directory] = [entries, names, visible, None]
+    return listing[1], listing[2]
+
+def _directories(directory):
+    '''
+    Helper function to get the set of names in directory that are directories.
+
+    Most patterns only need it for a few small directories, so it's only built
+    when asked for; the entries of the scan mostly know without a stat.
+    '''
+    _listing(directory)
+    listing = _listings[directory]
+    if listing[3] is None:
+        directories = set()
+        for entry in listing[0]:
+            try:
+                if entry.is_dir():
+                    directories.add(entry.name)
+            except OSError:
+                pass
+        listing[3] = directories
+    return listing[3]
+
+def _matcher(component):
+    '''
+    Helper function to get a function returning the names (from a list) that match a path component.
+
+    The common 'prefix*suffix' shapes (like *.tmp) are matched with string
+    methods, which is several times faster than a regular expression on a
+    big directory.
+    '''
+    matcher = _matchers.get(component)
+    if matcher is None:
+        if len(_matchers) >= 1024:
+            _matchers.clear()
+        if component.count('*') == 1 and '?' not in component and '[' not in component:
+            prefix, suffix = component.split('*')
+            shortest = len(component) - 1
+
+            def matcher(names):
+                return [name for name in names
+                        if len(name) >= shortest and name.startswith(prefix) and name.endswith(suffix)]
+        else:
+            # Imported here since lines without such patterns (and startup) don't need them
+            import fnmatch
+            import functools
+            import re
+            # filter() keeps the loop over a big directory in C
+            matcher = re.compile(fnmatch.translate(component), re.DOTALL).match
+            matcher = functools.partial(filter, matcher)
+        _matchers[component] = matcher
+    return matcher
+
+def _join(directory, name):
+    '''
+    Helper function to join a name to a directory, where '' is the current directory.
+    '''
+    if not directory or directory.endswith('/'):
+        return directory + name
+    return directory + '/' + name
+
+def _walk(directory, files):
+    '''
+    Helper function to list directory and the directories under it, for '**'.
+
+    With files, everything under directory is listed instead (a trailing '**').
+    Hidden entries are skipped and symbolic links to directories aren't followed.
+    '''
+    found = [] if files else [directory]
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        directories = _directories(current)
+        for name in _listing(current)[1]:
+            path = _join(current, name)
+            if name in directories and not os.path.islink(path):
+                stack.append(path)
+                if not files:
+                    found.append(path)
+            if files:
+                found.append(path)
+    return found
+
+def match(pattern):
+    '''
+    Get the sorted paths matching pattern, where only *, ? and [...] are wildcards (see escape).
+    '''
+    if pattern.startswith('/'):
+        paths = ['/']
+        components = pattern.lstrip('/').split('/')
+    else:
+        paths = ['']
+        components = pattern.split('/')
+    last = len(components) - 1
+    # Set while the paths so far were only joined, not found in a directory
+    unchecked = False
+    for index, component in enumerate(components):
+        if not component:
+            if index == last:
+                # A trailing '/' only matches directories
+                paths = [path + '/' for path in paths if os.path.isdir(path)]
+                unchecked = False
+            continue
+        if component == '**':
+            paths = [found for path in paths for found in _walk(path, index == last)]
+            unchecked = False
+            continue
+        if not _has_wildcards(component):
+            paths = [_join(path, component) for path in paths]
+            unchecked = True
+            continue
+        matcher = _matcher(component)
+        hidden = component.startswith('.')
+        matched = []
+        for path in paths:
+            if unchecked and not os.path.isdir(path or '.'):
+                continue
+            names, visible = _listing(path)
+            found = matcher(names if hidden else visible)
+            if index != last:
+                directories = _directories(path)
+                found = [name for name in found if name in directories]
+            if not path:
+                matched.extend(found)
+            else:
+                prefix = path if path.endswith('/') else path + '/'
+                matched.extend([prefix + name for name in found])
+        paths = matched
+        unchecked = False
+        if not paths:
+            return []
+    if unchecked:
+        paths = [path for path in paths if os.path.lexists(path)]
+    paths.sort()
+    return paths
+
+def expand_word(word, env):
+    '''
+    Expand a parsed Word with wildcards into the paths it matches, or its expanded text if none.
+
+    Returns the arguments and whether they are matches.
+    '''
+    from expansion import compile_word, Variable
+    globs = word.globs
+    text = []
+    pattern = []
+    offset = 0
+    for segment in compile_word(word):
+        if segment.__class__ is str:
+            text.append(segment)
+            pattern.append(''.join([
+                f'[{c}]' if c in '*?[' and offset + i not in globs else c
+                for i, c in enumerate(segment)
+            ]))
+            offset += len(segment)
+            continue
+        if segment.__class__ is Variable:
+            value = env.get(segment.name, '')
+            offset += len(segment.name) + 3
+        else:
+            # Imported here since running commands needs most of the shell
+            from substituting import substitute
+            value = substitute(segment.source)
+            offset += len(segment.source) + 3
+        text.append(value)
+        pattern.append(escape(value))
+    paths = match(''.join(pattern))
+    if not paths:
+        return [''.join(text)], False
+    return paths, True
+
+def _argument_size(argument):
+    '''
+    Helper function to get the bytes an argument takes for the kernel, with its pointer.
+    '''
+    return len(os.fsencode(argument)) + 1 + 8
+
+def argument_space():
+    '''
+    Get the bytes left under ARG_MAX for the arguments of a command, after the environment.
+    '''
+    from spawning import child_environment
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        arg_max = 1 << 17
+    environment = sum(len(key) + len(value) + 2 + 8 for key, value in child_environment().items())
+    return arg_max - environment - ARG_MAX_HEADROOM
+
+def batches(head, items, tail, space):
+    '''
+    Split items into lists that fit in space bytes of arguments together with head and tail.
+
+    Raises OSError(E2BIG) if a single item doesn't fit.
+    '''
+    import errno
+    space -= sum(_argument_size(argument) for argument in head + tail)
+    batch = []
+    size = 0
+    for item in items:
+        item_size = _argument_size(item)
+        if item_size > space:
+            raise OSError(errno.E2BIG, os.strerror(errno.E2BIG), item)
+        if size + item_size > space:
+            yield batch
+            batch = []
+            size = 0
+        batch.append(item)
+        size += item_size
+    if batch:
+        yield batch
+
+def batch_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the batch built-in command.
+
+    batch cmd args... runs cmd as few times as needed for its arguments to fit
+    under ARG_MAX. The arguments that came from wildcards are split between
+    the runs, with the arguments before and after them passed to each run
+    (every argument is split if none came from a wildcard). Returns 0 if every
+    run succeeded and 123 otherwise, stopping early if one exits with 255.
+    '''
+    from executing_commands import is_builtin, run_builtin, executing_commands_with_no_escape_variables
+    argv = list(parsed_line[1:])
+    if not argv:
+        sys.stderr.write('usage: batch command [args...]\n')
+        return 2
+    if is_builtin(argv):
+        # Built-ins aren't exec'd, so nothing limits their arguments
+        return run_builtin(argv, stdout)
+
+    if parsed_line.__class__ is Expanded and parsed_line.matched[0] > 1:
+        first, end = parsed_line.matched[0] - 1, parsed_line.matched[1] - 1
+    else:
+        first, end = 1, len(argv)
+    head, items, tail = argv[:first], argv[first:end], argv[end:]
+
+    fd = None
+    if stdout is not None:
+        stdout.flush()
+        fd = stdout.fileno()
+    sys.stdout.flush()
+    failed = False
+    try:
+        for items_batch in batches(head, items, tail, argument_space()):
+            status = executing_commands_with_no_escape_variables(head + items_batch + tail, (None, fd, None))
+            if status == 255:
+                return BATCH_FAILED_STATUS
+            failed = failed or status != 0
+    except OSError as e:
+        sys.stderr.write(f'batch: {head[0]}: argument too long: {e.filename[:64]}...\n')
+        return 1
+    return BATCH_FAILED_STATUS if failed else 0
@@ -0,0 +1,313 @@
+'''
+Module to keep the shell's command history.
+
+History is kept in $MYSHDOTDIR/.mysh_history (the home directory by default)
+as one "timestamp<TAB>command" line per command. Shells only ever append to it,
+each line with a single O_APPEND write, so any number of shells can share it
+without rewriting (or losing) each other's lines.
+
+In memory the file is kept as a single bytearray that mirrors it (about a byte
+per character, and a single read to load, even with a million entries):
+
+- substring searches run rfind over it from the newest end, so the latest
+  matches are found without looking at older history;
+- prefix searches use an index of line offsets, one per distinct command,
+  sorted by command and searched with bisect (8 bytes per command). The
+  interactive shell builds it in a thread while waiting for input, since that
+  takes a few seconds with a million commands; until then (and in scripts)
+  prefix searches scan like substring searches do.
+
+Duplicates are dropped as results are collected: only a command's latest use counts.
+'''
+from array import array
+from bisect import bisect_left
+import os
+import sys
+import time
+
+HISTORY_FILE = '.mysh_history'
+
+# How many of the latest commands are given to readline for up-arrow and Ctrl-R
+READLINE_HISTORY_SIZE = 1000
+
+# Matches printed by history -s and -p unless -n says otherwise
+DEFAULT_MATCHES = 20
+
+_fd = None
+_path = None
+# Everything read from (or written to) the history file so far
+_data = bytearray()
+_last_command = None
+
+# Offsets in _data of the latest line of each distinct command, sorted by command,
+# and how much of _data has been indexed
+_index = None
+_indexed = 0
+# Bumped whenever _data starts over, so an index built from older data is dropped
+_generation = 0
+
+# Prefix searches matching more distinct commands than this scan from the newest end
+# instead, which finds the latest few matches sooner than ordering them all
+INDEX_SCAN_THRESHOLD = 4096
+
+def history_path():
+    '''
+    Helper function to get the path of the history file.
+    '''
+    return os.path.join(os.getenv('MYSHDOTDIR', os.path.expanduser('~')), HISTORY_FILE)
+
+def _open():
+    '''
+    Helper function to open the history file for appending, once.
+
+    Returns False if it can't be opened (history then just isn't saved).
+    '''
+    global _fd, _path
+    path = history_path()
+    if _fd is not None and path == _path:
+        return True
+    if _fd is not None:
+        os.close(_fd)
+        _fd = None
+        _reset()
+    try:
+        _fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    except OSError:
+        return False
+    _path = path
+    return True
+
+def _reset():
+    '''
+    Helper function to forget the history read so far.
+    '''
+    global _index, _indexed, _generation
+    del _data[:]
+    _index = None
+    _indexed = 0
+    _generation += 1
+
+def _sync():
+    '''
+    Helper function to read whatever was appended to the file since the last read.
+
+    Lines written by other shells (and our own) are picked up this way, so the
+    in-memory copy is always the file's contents.
+    '''
+    if not _open():
+        return
+    size = os.fstat(_fd).st_size
+    if size < len(_data):
+        # The file was truncated or replaced by hand: start over
+        _reset()
+    while len(_data) < size:
+        chunk = os.pread(_fd, size - len(_data), len(_data))
+        if not chunk:
+            break
+        _data.extend(chunk)
+
+def add(command):
+    '''
+    Append a command to the history file.
+    '''
+    global _last_command
+    if not command.strip() or command == _last_command or '\n' in command:
+        return
+    _last_command = command
+    # readline itself adds the lines input() reads to its history
+    if not _open():
+        return
+    line = f'{int(time.time())}\t{command}\n'.encode(errors='surrogateescape')
+    try:
+        os.write(_fd, line)
+    except OSError:
+        pass
+
+def _entry(end):
+    '''
+    Helper function to split the line ending at offset end into (timestamp, command, start).
+    '''
+    start = _data.rfind(b'\n', 0, end) + 1
+    line = _data[start:end]
+    tab = line.find(b'\t')
+    timestamp = int(line[:tab]) if tab > 0 and line[:tab].isdigit() else 0
+    return timestamp, line[tab + 1:].decode(errors='surrogateescape'), start
+
+def latest(count=None):
+    '''
+    Return up to count (all if None) distinct commands as (timestamp, command), newest first.
+    '''
+    _sync()
+    seen = set()
+    results = []
+    end = len(_data) - 1
+    while end > 0 and (count is None or len(results) < count):
+        timestamp, command, start = _entry(end)
+        if command not in seen:
+            seen.add(command)
+            results.append((timestamp, command))
+        end = start - 1
+    return results
+
+def _command_at(offset):
+    '''
+    Helper function to get the command (as bytes) of the line starting at offset.
+    '''
+    end = _data.find(b'\n', offset)
+    tab = _data.find(b'\t', offset, end)
+    return bytes(_data[tab + 1:end])
+
+def build_index():
+    '''
+    Build the prefix index from the history read so far.
+
+    Safe to run in a thread: it works on a copy of the data and the index is
+    only installed if the history hasn't started over in the meantime.
+    '''
+    global _index, _indexed
+    generation = _generation
+    data = bytes(_data)
+    end = data.rfind(b'\n') + 1
+    # A dict keeps the latest offset of each command
+    latest_offset = {}
+    offset = 0
+    for line in data.split(b'\n')[:-1]:
+        latest_offset[line.partition(b'\t')[2]] = offset
+        offset += len(line) + 1
+    index = array('Q', [latest_offset[command] for command in sorted(latest_offset)])
+    if generation == _generation and _index is None:
+        # _indexed first: searches only look at it once _index is set
+        _indexed = end
+        _index = index
+
+def _update_index():
+    '''
+    Helper function to add the lines read since the index was built or last updated.
+    '''
+    global _indexed
+    end = _data.rfind(b'\n') + 1
+    offset = _indexed
+    while offset < end:
+        command = _command_at(offset)
+        position = bisect_left(_index, command, key=_command_at)
+        if position < len(_index) and _command_at(_index[position]) == command:
+            _index[position] = offset
+        else:
+            _index.insert(position, offset)
+        offset = _data.find(b'\n', offset) + 1
+    _indexed = end
+
+def _entry_at(offset):
+    '''
+    Helper function to get (timestamp, command) for the line starting at offset.
+    '''
+    timestamp, command, _ = _entry(_data.find(b'\n', offset))
+    return timestamp, command
+
+def search(text, count=DEFAULT_MATCHES, prefix=False):
+    '''
+    Return up to count distinct commands containing text (or starting with it if
+    prefix) as (timestamp, command), newest first.
+    '''
+    _sync()
+    if prefix and text and _index is not None:
+        _update_index()
+        needle = text.encode(errors='surrogateescape')
+        low = bisect_left(_index, needle, key=_command_at)
+        # No UTF-8 text contains 0xff, so this sorts after everything starting with needle
+        high = bisect_left(_index, needle + b'\xff', low, key=_command_at)
+        if high - low <= INDEX_SCAN_THRESHOLD:
+            newest = sorted(_index[low:high], reverse=True)[:count]
+            return [_entry_at(offset) for offset in newest]
+    return _scan(text, count, prefix)
+
+def _scan(text, count, prefix):
+    '''
+    Helper function to search _data with rfind, from the newest line back.
+    '''
+    # A command starts right after the tab that follows its timestamp
+    needle = (('\t' + text) if prefix else text).encode(errors='surrogateescape')
+    if not text or b'\n' in needle:
+        return []
+    seen = set()
+    results = []
+    position = len(_data)
+    while len(results) < count:
+        hit = _data.rfind(needle, 0, position)
+        if hit < 0:
+            break
+        end = _data.find(b'\n', hit)
+        if end < 0:
+            end = len(_data)
+        timestamp, command, start = _entry(end)
+        if command in seen:
+            position = start
+            continue
+        if not (command.startswith(text) if prefix else text in command):
+            # The hit was in the timestamp, or on a tab inside the command: look further back
+            position = hit
+            continue
+        seen.add(command)
+        results.append((timestamp, command))
+        position = start
+    return results
+
+def setup_readline():
+    '''
+    Load the latest history into readline, if it is available.
+
+    Only used by the interactive shell, since importing readline takes a while.
+    '''
+    try:
+        import readline
+    except ImportError:
+        return
+    for _, command in reversed(latest(READLINE_HISTORY_SIZE)):
+        readline.add_history(command)
+    import threading
+    threading.Thread(target=build_index, daemon=True).start()
+
+def _format(number, timestamp, command):
+    '''
+    Helper function to format one line of history output.
+    '''
+    when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+    return f'{number:5}  {when}  {command}\n'
+
+def history_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the history built-in command.
+
+    history [N]                 the last N distinct commands (all by default)
+    history -s TEXT [-n N]      the latest commands containing TEXT
+    history -p PREFIX [-n N]    the latest commands starting with PREFIX
+    '''
+    if stdout is None:
+        stdout = sys.stdout
+    arguments = parsed_line[1:]
+    count = None
+    if '-n' in arguments:
+        index = arguments.index('-n')
+        if index + 1 >= len(arguments) or not arguments[index + 1].isdigit():
+            sys.stderr.write('history: -n: expected a number\n')
+            return 2
+        count = int(arguments[index + 1])
+        del arguments[index:index + 2]
+
+    if arguments and arguments[0] in ('-s', '-p'):
+        if len(arguments) != 2:
+            sys.stderr.write(f'history: {arguments[0]}: expected one search string\n')
+            return 2
+        entries = search(arguments[1], DEFAULT_MATCHES if count is None else count,
+                         prefix=arguments[0] == '-p')
+        if not entries:
+            return 1
+    elif len(arguments) > 1 or (arguments and not arguments[0].isdigit()):
+        sys.stderr.write('usage: history [N] | history -s TEXT [-n N] | history -p PREFIX [-n N]\n')
+        return 2
+    else:
+        entries = latest(int(arguments[0]) if arguments else count)
+
+    for number, (timestamp, command) in enumerate(reversed(entries), 1):
+        stdout.write(_format(number, timestamp, command))
+    return 0
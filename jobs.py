@@ -0,0 +1,409 @@
+'''
+Module to keep track of jobs (pipelines started by the shell) and reap their processes.
+
+Foreground jobs are waited for with wait4 on their own process group, so they
+never collect another job's exit status. Background jobs are watched with a
+pidfd per process in a selector: finished processes are reaped when their pidfd
+becomes readable, without polling every job.
+'''
+import os
+import sys
+import time
+import _signal
+import accounting
+
+# False when running a script or -c command, so the terminal is left alone
+interactive = True
+
+class Job:
+    '''
+    A pipeline started by the shell: its process group, processes and their statuses.
+    '''
+    __slots__ = ('number', 'pgid', 'pids', 'statuses', 'command', 'stopped', 'names', 'started')
+
+    def __init__(self, pgid, pids, command, names=None, started=None):
+        self.number = None
+        self.pgid = pgid
+        self.pids = pids
+        self.statuses = {}
+        self.command = command
+        self.stopped = False
+        # pid -> the command line of that stage, for accounting
+        self.names = names if names is not None else {}
+        self.started = started if started is not None else time.perf_counter()
+
+    def store(self, pid, status, rusage):
+        '''
+        Store the wait status and resource usage (from os.wait4) of one of its processes.
+        '''
+        code = self.statuses[pid] = exit_code(status)
+        if rusage is not None:
+            accounting.record(self.names.get(pid, self.command), pid, code, rusage,
+                              time.perf_counter() - self.started, self.command)
+
+    def done(self):
+        return len(self.statuses) == len(self.pids)
+
+    def status(self):
+        '''
+        The exit status of the job, which is the status of its last process.
+        '''
+        if not self.pids:
+            return 0
+        return self.statuses.get(self.pids[-1], 0)
+
+# Job number -> Job, for background and stopped jobs
+_jobs = {}
+# pid -> Job, for every process of a job in _jobs that hasn't been reaped
+_by_pid = {}
+# pid -> pidfd watched in the selector
+_pidfds = {}
+_selector = None
+
+def exit_code(status):
+    '''
+    Helper function to turn a wait status into a shell exit status (128+N for signal N).
+    '''
+    code = os.waitstatus_to_exitcode(status)
+    return 128 - code if code < 0 else code
+
+def restore_terminal():
+    '''
+    Helper function to give the terminal back to the shell after a command.
+    '''
+    if interactive and os.isatty(sys.stdin.fileno()):
+        os.tcsetpgrp(sys.stdin.fileno(), os.getpgrp())
+
+def give_terminal(pgid):
+    '''
+    Helper function to make pgid the foreground process group of the terminal.
+    '''
+    if interactive and os.isatty(sys.stdin.fileno()):
+        try:
+            os.tcsetpgrp(sys.stdin.fileno(), pgid)
+        except OSError:
+            pass
+
+def _watch(job):
+    '''
+    Helper function to start watching the processes of a background job.
+    '''
+    global _selector
+    if _selector is None:
+        import selectors
+        _selector = selectors.DefaultSelector()
+    for pid in job.pids:
+        if pid in job.statuses:
+            continue
+        _by_pid[pid] = job
+        try:
+            pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            # No pidfd support: the process is reaped by the next poll instead
+            continue
+        _pidfds[pid] = pidfd
+        _selector.register(pidfd, 1, pid)
+
+def _record(pid, status, rusage):
+    '''
+    Helper function to store the exit status of a reaped process in its job.
+    '''
+    job = _by_pid.pop(pid, None)
+    pidfd = _pidfds.pop(pid, None)
+    if pidfd is not None:
+        _selector.unregister(pidfd)
+        os.close(pidfd)
+    if job is not None:
+        job.store(pid, status, rusage)
+
+def _reap(pid):
+    '''
+    Helper function to reap pid if it has finished.
+    '''
+    try:
+        finished, status, rusage = os.wait4(pid, os.WNOHANG)
+    except ChildProcessError:
+        # Already reaped by someone else, so its usage is unknown
+        finished, status, rusage = pid, 0, None
+    if finished == pid:
+        _record(pid, status, rusage)
+
+def poll(timeout=0):
+    '''
+    Reap the background processes that have finished, waiting up to timeout seconds.
+
+    A timeout of None blocks until at least one has finished.
+    '''
+    if not _by_pid:
+        return
+    if _selector is not None and _pidfds:
+        for key, _ in _selector.select(timeout):
+            _reap(key.data)
+    # Processes that couldn't get a pidfd
+    for pid in [pid for pid in _by_pid if pid not in _pidfds]:
+        _reap(pid)
+
+def _number(job):
+    '''
+    Helper function to give a job the lowest free job number.
+    '''
+    number = 1
+    while number in _jobs:
+        number += 1
+    job.number = number
+    _jobs[number] = job
+
+def start_background(pids, command, names=None, started=None):
+    '''
+    Register a pipeline started in the background and print its job number.
+    '''
+    job = Job(pids[0] if pids else 0, pids, command, names, started)
+    _number(job)
+    _watch(job)
+    if interactive:
+        sys.stderr.write(f'[{job.number}] {job.pgid}\n')
+    return job
+
+def wait_for_job(job, consumer=None):
+    '''
+    Wait for a foreground job to finish (or stop) and return its exit status.
+
+    Only processes in the job's own process group are waited for. Once the
+    consumer (the last stage of a pipeline) has exited, the stages still running
+    are sent SIGPIPE: nothing will read what they write, and a stage that isn't
+    writing (e.g. waiting for input) would otherwise keep the pipeline alive.
+    '''
+    if job.pids:
+        give_terminal(job.pgid)
+    while not job.done():
+        try:
+            pid, status, rusage = os.wait4(-job.pgid, os.WUNTRACED)
+        except ChildProcessError:
+            # Everything left was already reaped elsewhere
+            for pid in job.pids:
+                job.statuses.setdefault(pid, 0)
+            break
+        if os.WIFSTOPPED(status):
+            if os.WSTOPSIG(status) in (_signal.SIGTTIN, _signal.SIGTTOU):
+                # It tried to use the terminal before it was handed over; retry
+                give_terminal(job.pgid)
+                os.killpg(job.pgid, _signal.SIGCONT)
+                continue
+            job.stopped = True
+            if job.number is None:
+                _number(job)
+            _watch(job)
+            restore_terminal()
+            sys.stderr.write(f'\n[{job.number}]+  Stopped                 {job.command}\n')
+            return 128 + os.WSTOPSIG(status)
+        if pid in job.pids:
+            if pid in _by_pid:
+                _record(pid, status, rusage)
+            else:
+                job.store(pid, status, rusage)
+            if pid == consumer and not job.done():
+                try:
+                    os.killpg(job.pgid, _signal.SIGPIPE)
+                except ProcessLookupError:
+                    pass
+    restore_terminal()
+    if job.number is not None:
+        del _jobs[job.number]
+    return job.status()
+
+def notify_finished(report=True):
+    '''
+    Reap finished background jobs, remove them and (if report) print that they are done.
+    '''
+    if not _jobs:
+        return
+    poll(0)
+    for number in sorted(_jobs):
+        job = _jobs[number]
+        if job.done():
+            if report:
+                sys.stderr.write(f'[{number}]+  Done                    {job.command}\n')
+            del _jobs[number]
+
+def _current_job():
+    '''
+    Helper function to find the most recently started job.
+    '''
+    return _jobs[max(_jobs)] if _jobs else None
+
+def _find_job(spec, builtin):
+    '''
+    Helper function to find the job a %n (or bare n) argument refers to.
+    '''
+    if spec in ('%', '%%', '%+'):
+        job = _current_job()
+    else:
+        try:
+            job = _jobs.get(int(spec.lstrip('%')))
+        except ValueError:
+            job = None
+    if job is None:
+        sys.stderr.write(f'{builtin}: {spec}: no such job\n')
+    return job
+
+def jobs_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the jobs built-in command.
+    '''
+    if stdout is None:
+        stdout = sys.stdout
+    poll(0)
+    current = max(_jobs) if _jobs else None
+    for number in sorted(_jobs):
+        job = _jobs[number]
+        if job.done():
+            state = 'Done'
+        elif job.stopped:
+            state = 'Stopped'
+        else:
+            state = 'Running'
+        marker = '+' if number == current else ' '
+        stdout.write(f'[{number}]{marker}  {state:24}{job.command}\n')
+    for number in [number for number, job in _jobs.items() if job.done()]:
+        del _jobs[number]
+    return 0
+
+def fg_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the fg built-in command.
+    '''
+    if len(parsed_line) > 2:
+        sys.stderr.write('fg: too many arguments\n')
+        return 1
+    job = _find_job(parsed_line[1], 'fg') if len(parsed_line) == 2 else _current_job()
+    if job is None:
+        if len(parsed_line) == 1:
+            sys.stderr.write('fg: no current job\n')
+        return 1
+    sys.stderr.write(f'{job.command}\n')
+    job.stopped = False
+    give_terminal(job.pgid)
+    try:
+        os.killpg(job.pgid, _signal.SIGCONT)
+    except ProcessLookupError:
+        pass
+    return wait_for_job(job)
+
+def bg_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the bg built-in command.
+    '''
+    specs = parsed_line[1:] or ['%+']
+    status = 0
+    for spec in specs:
+        job = _find_job(spec, 'bg')
+        if job is None:
+            status = 1
+            continue
+        job.stopped = False
+        try:
+            os.killpg(job.pgid, _signal.SIGCONT)
+        except ProcessLookupError:
+            pass
+        sys.stderr.write(f'[{job.number}]+ {job.command} &\n')
+    return status
+
+def wait_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the wait built-in command.
+
+    With no arguments it waits for every background job, otherwise for the given
+    jobs (%n) or process ids, and returns the status of the last one.
+    '''
+    waiting = []
+    status = 0
+    for spec in parsed_line[1:]:
+        if spec.startswith('%'):
+            job = _find_job(spec, 'wait')
+            if job is None:
+                status = 127
+                continue
+            waiting.append((job, None))
+        elif spec.isdigit() and int(spec) in _by_pid:
+            waiting.append((_by_pid[int(spec)], int(spec)))
+        else:
+            sys.stderr.write(f'wait: pid {spec} is not a child of this shell\n')
+            status = 127
+    if len(parsed_line) == 1:
+        waiting = [(job, None) for job in _jobs.values()]
+
+    for job, pid in waiting:
+        # Blocks in the selector until processes finish; nothing is polled in a loop
+        while not (job.done() if pid is None else pid in job.statuses):
+            if job.stopped:
+                break
+            poll(None if _pidfds else 0.05)
+        status = job.status() if pid is None else job.statuses.get(pid, 0)
+    # Jobs that have been waited for are forgotten, like after being reported
+    for job, _ in waiting:
+        if job.done() and _jobs.get(job.number) is job:
+            del _jobs[job.number]
+    return status
+
+def signal_number(name):
+    '''
+    Get the number of a signal from its number or name (TERM or SIGTERM), raising ValueError if invalid.
+    '''
+    if name.isdigit():
+        return int(name)
+    name = name.upper()
+    if not name.startswith('SIG'):
+        name = 'SIG' + name
+    # _signal has the SIG* numbers as plain ints (and SIG_DFL and such, which aren't signals)
+    number = getattr(_signal, name, None) if name[3:].isalnum() else None
+    if number.__class__ is not int:
+        raise ValueError(f'{name}: invalid signal specification')
+    return number
+
+def kill_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the kill built-in command (kill [-SIGNAL] %n|pid ...).
+    '''
+    arguments = parsed_line[1:]
+    number = _signal.SIGTERM
+    if arguments and arguments[0] == '-s' and len(arguments) > 1:
+        name = arguments[1]
+        arguments = arguments[2:]
+    elif arguments and arguments[0].startswith('-') and len(arguments[0]) > 1:
+        name = arguments[0][1:]
+        arguments = arguments[1:]
+    else:
+        name = None
+    if name is not None:
+        try:
+            number = signal_number(name)
+        except ValueError as e:
+            sys.stderr.write(f'kill: {e}\n')
+            return 1
+    if not arguments:
+        sys.stderr.write('usage: kill [-s signal | -signal] %job | pid ...\n')
+        return 1
+
+    status = 0
+    for spec in arguments:
+        try:
+            if spec.startswith('%'):
+                job = _find_job(spec, 'kill')
+                if job is None:
+                    status = 1
+                    continue
+                os.killpg(job.pgid, number)
+                if number == _signal.SIGCONT:
+                    job.stopped = False
+            else:
+                os.kill(int(spec), number)
+        except ValueError:
+            sys.stderr.write(f'kill: {spec}: arguments must be process or job IDs\n')
+            status = 1
+        except ProcessLookupError:
+            sys.stderr.write(f'kill: ({spec}) - No such process\n')
+            status = 1
+        except PermissionError:
+            sys.stderr.write(f'kill: ({spec}) - Operation not permitted\n')
+            status = 1
+    return status
@@ -1,111 +1,302 @@
 '''
 Module to run the shell.
 '''
-import signal
-import re
+import time
+_startup_marks = [('start', time.perf_counter())]
+
+def _mark(label: str) -> None:
+    '''
+    Helper function to record a point in startup, for --startup-profile.
+    '''
+    _startup_marks.append((label, time.perf_counter()))
+
 import sys
-import json
 import os
-from parsing import (
-    split_by_pipe_op, splitting_arguments
-)
-from built_in_commands import (
-    cd, pwd, which, 
-    valid_var_name, exit
-)
-from executing_commands import (
-    executing_commands_with_escape_variable, 
-    executing_commands_with_no_escape_variables,
-    executing_piped_commands, var
-)
+import marshal
+import _signal
+_mark('import os, sys, marshal, _signal')
+if __name__ == '__main__' and sys.argv[1:2] == ['--client']:
+    # The client only talks to a server, so none of the rest of the shell is imported
+    import serving
+    sys.exit(serving.client_main(sys.argv[2:]))
+from parsing import parse_line, ParseError, Command
+_mark('import parsing')
+from built_in_commands import valid_var_name
+_mark('import built_in_commands, expansion, command_hash, copying')
+from executing_commands import run_commands
+import executing_commands
+import jobs
+import tracing
+_mark('import executing_commands and the built-in modules')
+
+# Validated .myshrc contents are cached next to it in this file
+MYSHRC_CACHE = '.myshrc.cache'
+_MYSHRC_CACHE_VERSION = 1
+
+def _parse_myshrc(path: str):
+    '''
+    Helper function to read and validate .myshrc.
+
+    Returns (warnings, variables), or None if the file isn't valid JSON.
+    '''
+    import json
+    warnings = []
+    variables = []
+    try:
+        with open(path, 'r') as f:
+            config = json.load(f)
+    except json.JSONDecodeError:
+        sys.stderr.write("mysh: invalid JSON format for .myshrc\n")
+        return None
+    for key, value in config.items():
+        # Validating variable names and types from .myshrc
+        if not valid_var_name(key):
+            warnings.append(f"mysh: .myshrc: {key}: invalid characters for variable name\n")
+            continue
+        elif not isinstance(value, str):
+            warnings.append(f"mysh: .myshrc: {key}: not a string\n")
+            continue
+        variables.append((key, value))
+    return warnings, variables
 
 def myshrc() -> None:
     """
     Parsing the .myshrc file.
+
+    The validated result is cached (keyed on the file's path, mtime and size), so
+    an unchanged .myshrc isn't parsed again on the next start.
     """
-    path = os.getenv("MYSHDOTDIR", os.path.expanduser("~")) + "/.myshrc"
-    if not os.path.exists(path):
+    directory = os.getenv("MYSHDOTDIR", os.path.expanduser("~"))
+    path = directory + "/.myshrc"
+    try:
+        stat = os.stat(path)
+    except OSError:
         return
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    cache_path = os.path.join(directory, MYSHRC_CACHE)
+
+    config = None
     try:
-        with open(path, 'r') as f:
-            config = json.load(f)
-            for key, value in config.items():
-                # Validating variable names and types from .myshrc
-                if not valid_var_name(key):
-                    sys.stderr.write(f"mysh: .myshrc: {key}: invalid characters for variable name\n")
-                    continue
-                elif not isinstance(value, str):
-                    sys.stderr.write(f"mysh: .myshrc: {key}: not a string\n")
-                    continue
-                os.environ[key] = os.path.expanduser(value)
-    except json.JSONDecodeError:
-        sys.stderr.write("mysh: invalid JSON format for .myshrc\n")
+        with open(cache_path, 'rb') as f:
+            version, cached_key, cached_config = marshal.load(f)
+        if version == _MYSHRC_CACHE_VERSION and tuple(cached_key) == key:
+            config = cached_config
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    if config is None:
+        config = _parse_myshrc(path)
+        if config is None:
+            return
+        try:
+            # Writing to a temporary file first so other shells never read half a cache
+            temporary_path = f'{cache_path}.{os.getpid()}'
+            with open(temporary_path, 'wb') as f:
+                marshal.dump((_MYSHRC_CACHE_VERSION, key, config), f)
+            os.replace(temporary_path, cache_path)
+        except OSError:
+            pass
+
+    warnings, variables = config
+    for warning in warnings:
+        sys.stderr.write(warning)
+    for key, value in variables:
+        os.environ[key] = os.path.expanduser(value)
+
+def setup_environment() -> None:
+    """
+    Load .myshrc and set the default environment variables, which every run starts with.
+    """
+    myshrc()
+    # Setting default environment variables if not already set
+    os.environ.setdefault("PROMPT", ">> ")
+    os.environ.setdefault("MYSH_VERSION", "1.0")
 
 def setup_signals() -> None:
     """
     Setup signals required by this program.
     """
-    signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    # The signal module builds enums when imported, which costs more than the rest
+    # of startup put together; the C module underneath it has the same functions
+    _signal.signal(_signal.SIGTTOU, _signal.SIG_IGN)
 
-def missing_commands(parsed_line: list) -> bool:
+def setup_interrupt() -> None:
     """
-    Testing for missing commands in piping.
+    Setup Ctrl-C for the interactive shell.
+
+    The handler stops the shell's whole process group, so it is only installed
+    when the shell has a terminal of its own: a script or -c run shares the
+    process group of whatever started it, which must not get SIGTERM too.
     """
-    num_commands = len(parsed_line)
-    for i in range(num_commands):
-        if parsed_line[i].strip() == "":
-            sys.stderr.write('mysh: syntax error: expected command after pipe\n')
-            return False
-    return True
+    _signal.signal(_signal.SIGINT, executing_commands.handle_interrupt)
+
+def run_line(command: str) -> int:
+    '''
+    Run one line of input and return its exit status.
+    '''
+    if tracing.enabled:
+        return tracing.call('line', command, _run_line, command)
+    return _run_line(command)
+
+def _run_line(command: str) -> int:
+    '''
+    Helper function that does the actual work of run_line.
+    '''
+    # globbing is only imported by the first line with wildcards
+    globbing = sys.modules.get('globbing')
+    if globbing is not None:
+        globbing.clear_cache()
+    try:
+        pipeline = parse_line(command)
+    except ParseError as e:
+        sys.stderr.write(f'mysh: syntax error: {e}\n')
+        return 2
+
+    commands = pipeline.commands
+    first = commands[0].words
+    if first and first[0].text == 'time' and not first[0].quoted:
+        # time before a line times all of it (with a line for each pipeline stage),
+        # and reports on the shell's stderr whatever the command's redirections are
+        from accounting import Timer
+        commands = [Command(first[1:], commands[0].source, commands[0].redirects)] + commands[1:]
+        with Timer():
+            return run_commands(commands, pipeline.background)
+    return run_commands(commands, pipeline.background)
+
+# Scripts are read this many bytes at a time
+SCRIPT_BUFFER_SIZE = 1 << 20
+
+def run_script(lines, errexit: bool = False) -> int:
+    '''
+    Run lines without prompting and return the exit status of the last one.
+
+    With errexit, stop at the first line that fails.
+    '''
+    status = 0
+    for line in lines:
+        status = run_line(line.rstrip('\n'))
+        # Finished background jobs are reaped, but kept for jobs and wait to report
+        jobs.poll()
+        if errexit and status != 0:
+            break
+    return status
+
+def script_lines(path: str):
+    '''
+    Read a script (or stdin for '-') in large buffered chunks, one line at a time.
+    '''
+    if path == '-':
+        f = open(sys.stdin.fileno(), 'r', buffering=SCRIPT_BUFFER_SIZE, closefd=False)
+    else:
+        f = open(path, 'r', buffering=SCRIPT_BUFFER_SIZE)
+    with f:
+        yield from f
+
+USAGE = ('usage: mysh.py [--startup-profile] [-e] [-c command | -s | script]\n'
+         '       mysh.py --serve socket [--workers N]\n'
+         '       mysh.py --client socket [-e] (-c command | script | -)\n')
+
+def print_startup_profile() -> None:
+    '''
+    Print how long each import and initialisation step of startup took.
+    '''
+    _mark('environment defaults')
+    previous = _startup_marks[0][1]
+    for label, when in _startup_marks[1:]:
+        sys.stderr.write(f'{(when - previous) * 1000:8.3f} ms  {label}\n')
+        previous = when
+    total = _startup_marks[-1][1] - _startup_marks[0][1]
+    sys.stderr.write(f'{total * 1000:8.3f} ms  total (after interpreter startup)\n')
 
 def main() -> None:
     '''
     Main loop for the shell.
+
+    With -c or a script path (or -s / '-' for stdin) the shell runs non-interactively
+    and exits with the status of the last command. -e stops at the first failure.
+    With --serve it runs command lines sent by mysh.py --client (see serving.py).
     '''
     setup_signals()
-    myshrc() 
-
-    # Setting default environment variables if not already set
-    os.environ.setdefault("PROMPT", ">> ")
-    os.environ.setdefault("MYSH_VERSION", "1.0")
+    _mark('setup_signals')
+    setup_environment()
+    _mark('myshrc')
     prompt = os.environ['PROMPT']
+    if os.environ.get('MYSH_TRACE'):
+        try:
+            tracing.start(os.environ['MYSH_TRACE'])
+        except OSError as e:
+            sys.stderr.write(f"mysh: MYSH_TRACE: {os.environ['MYSH_TRACE']}: {e.strerror}\n")
+
+    errexit = False
+    lines = None
+    serve_path = None
+    workers = os.cpu_count() or 1
+    args = sys.argv[1:]
+    if '--startup-profile' in args:
+        args.remove('--startup-profile')
+        print_startup_profile()
+    while args:
+        arg = args.pop(0)
+        if arg == '-e':
+            errexit = True
+        elif arg == '-c':
+            if not args:
+                sys.stderr.write('mysh: -c: option requires an argument\n')
+                sys.exit(2)
+            lines = args.pop(0).split('\n')
+            break
+        elif arg == '--serve' or arg == '--workers':
+            if not args:
+                sys.stderr.write(f'mysh: {arg}: option requires an argument\n')
+                sys.exit(2)
+            value = args.pop(0)
+            if arg == '--serve':
+                serve_path = value
+            elif value.isdigit() and int(value) > 0:
+                workers = int(value)
+            else:
+                sys.stderr.write(f'mysh: --workers: invalid number: {value}\n')
+                sys.exit(2)
+        elif arg == '-s' or arg == '-':
+            lines = script_lines('-')
+            break
+        elif arg.startswith('-'):
+            sys.stderr.write(f'mysh: {arg}: invalid option\n' + USAGE)
+            sys.exit(2)
+        else:
+            if not os.path.isfile(arg):
+                sys.stderr.write(f'mysh: {arg}: No such file or directory\n')
+                sys.exit(127)
+            lines = script_lines(arg)
+            break
 
+    if serve_path is not None:
+        import serving
+        sys.exit(serving.serve(serve_path, workers, run_script, setup_environment))
+
+    if lines is not None:
+        jobs.interactive = False
+        # Ctrl-C stops a script like any other program, with no traceback
+        _signal.signal(_signal.SIGINT, _signal.SIG_DFL)
+        sys.exit(run_script(lines, errexit))
+
+    setup_interrupt()
+    keep_history = os.isatty(0)
+    if keep_history:
+        # Only an interactive shell needs these, so scripts and -c don't import them
+        import history
+        import completing
+        history.setup_readline()
+        completing.setup_completion()
     while True:
         try:
+            jobs.notify_finished()
             command = input(prompt) # Reading the user input
-
-            if '|' in command:
-                # Handling piped commands
-                parsed_line = split_by_pipe_op(command)
-                if not missing_commands(parsed_line):
-                    continue
-                executing_piped_commands(parsed_line)
-            else:
-                # Handling single commands
-                parsed_line = splitting_arguments(command)
-                if len(parsed_line) != 0:
-                    cmd = parsed_line[0].lower()
-                    if cmd == 'exit':
-                        exit(parsed_line)
-                    elif cmd == 'cd':
-                        cd(parsed_line)
-                    elif cmd == 'pwd':
-                        pwd(parsed_line)
-                    elif cmd == 'which':
-                        if len(parsed_line) != 1:
-                            commands = parsed_line[1:]
-                            which(commands)
-                        else:
-                            sys.stderr.write('usage: which command ...\n')
-                    elif cmd == 'var':
-                        var(parsed_line)
-                    elif len(parsed_line) == 2:
-                        if re.search(r'\\\$', command):
-                            executing_commands_with_escape_variable(parsed_line)
-                        else:
-                            executing_commands_with_no_escape_variables(parsed_line)
-                    else:
-                        executing_commands_with_no_escape_variables(parsed_line)
+            if keep_history:
+                history.add(command)
+            status = run_line(command)
+            if errexit and status != 0:
+                sys.exit(status)
         except EOFError:
             print('')  # Handling end-of-file (EOF) for input
             break
@@ -0,0 +1,217 @@
+'''
+Module to implement the parallel built-in command.
+
+parallel [-j N] [--keep-order] command ... ::: arg1 arg2 ...
+parallel [-j N] [--keep-order] command ...        (one argument per line of stdin)
+
+The command is run once per argument, which replaces every '{}' in the command
+or is appended to it. At most N of them run at once (the number of CPUs by
+default) and a new one starts as soon as one finishes.
+
+The running jobs share a process group of their own, which is what parallel
+waits on, so it never reaps the children of other pipeline stages. Run from
+the shell's main thread, that group also gets the terminal, so Ctrl-C stops
+the jobs (and no new ones are started) rather than reaching the shell.
+'''
+import os
+import sys
+import time
+import _signal
+from command_hash import find_command
+from spawning import spawn, fork_function
+from jobs import exit_code, give_terminal, restore_terminal
+import accounting
+
+USAGE = 'usage: parallel [-j N] [--keep-order] command ... [::: argument ...]\n'
+
+# Like GNU parallel, the status is the number of failed jobs, up to this many
+MAX_FAILED_STATUS = 101
+
+def _parse_options(parsed_line):
+    '''
+    Helper function to split the arguments into (jobs, keep_order, command, arguments).
+
+    arguments is None when they should be read from stdin.
+    '''
+    jobs = 0
+    keep_order = False
+    i = 1
+    while i < len(parsed_line) and parsed_line[i].startswith('-'):
+        option = parsed_line[i]
+        if option in ('-k', '--keep-order'):
+            keep_order = True
+        elif option in ('-j', '--jobs'):
+            i += 1
+            if i == len(parsed_line):
+                raise ValueError(f'{option}: option requires an argument')
+            jobs = int(parsed_line[i])
+        elif option.startswith('-j'):
+            jobs = int(option[2:])
+        elif option == '--':
+            i += 1
+            break
+        else:
+            raise ValueError(f'{option}: invalid option')
+        i += 1
+
+    words = parsed_line[i:]
+    if ':::' in words:
+        separator = words.index(':::')
+        command, arguments = words[:separator], words[separator + 1:]
+    else:
+        command, arguments = words, None
+    if not command:
+        raise ValueError('no command given')
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    return jobs, keep_order, command, arguments
+
+def _stdin_arguments():
+    '''
+    Helper function to read the arguments from stdin, one per non-empty line.
+    '''
+    with open(0, 'r', errors='surrogateescape', closefd=False) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+def _job_argv(command, argument):
+    '''
+    Helper function to build the arguments of the job for one input argument.
+    '''
+    if any('{}' in word for word in command):
+        return [word.replace('{}', argument) for word in command]
+    return command + [argument]
+
+def _copy_output(f, fd):
+    '''
+    Helper function to write a buffered job output file to fd.
+    '''
+    f.seek(0)
+    while True:
+        data = f.read(1 << 16)
+        if not data:
+            break
+        while data:
+            data = data[os.write(fd, data):]
+    f.close()
+
+def parallel_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the parallel built-in command.
+
+    Returns the number of jobs that failed (at most 101), 0 if they all succeeded.
+    '''
+    if stdout is None:
+        stdout = sys.stdout
+    try:
+        max_jobs, keep_order, command, arguments = _parse_options(parsed_line)
+    except ValueError as e:
+        sys.stderr.write(f'parallel: {e}\n' + USAGE)
+        return 2
+    if arguments is None:
+        arguments = _stdin_arguments()
+
+    name = command[0]
+    builtin = None
+    path = name
+    if '/' not in name:
+        # Imported here since executing_commands imports this module
+        from executing_commands import is_builtin, run_builtin
+        if is_builtin(command):
+            builtin = run_builtin
+        else:
+            path = find_command(name)
+            if path is None:
+                sys.stderr.write(f'mysh: command not found: {name}\n')
+                return 127
+
+    stdout.flush()
+    out_fd = stdout.fileno()
+    if keep_order:
+        import tempfile
+    import threading
+    foreground = threading.current_thread() is threading.main_thread()
+
+    running = {}
+    outputs = {}
+    statuses = []
+    next_to_flush = 0
+    failed = 0
+    started = 0
+    # The process group of the running jobs, led by the first of them; once they have
+    # all been reaped the group is gone and the next job starts a new one
+    pgid = None
+    try:
+        while started < len(arguments) or running:
+            while started < len(arguments) and len(running) < max_jobs:
+                argv = _job_argv(command, arguments[started])
+                output = tempfile.TemporaryFile() if keep_order else None
+                fd = output.fileno() if keep_order else out_fd
+                try:
+                    if builtin is not None:
+                        pid = fork_function(builtin, argv, stdout=fd, pgroup=pgid or 0)
+                    else:
+                        pid = spawn(path, argv, stdout=fd, pgroup=pgid or 0)
+                except OSError as e:
+                    sys.stderr.write(f'parallel: {name}: {e}\n')
+                    statuses.append(127)
+                    failed += 1
+                    if output is not None:
+                        outputs[started] = output
+                else:
+                    if pgid is None:
+                        pgid = pid
+                        if foreground:
+                            give_terminal(pgid)
+                    running[pid] = (started, argv, time.perf_counter())
+                    outputs[started] = output
+                    statuses.append(None)
+                started += 1
+
+            if running:
+                try:
+                    pid, status, rusage = os.wait4(-pgid, 0)
+                except ChildProcessError:
+                    break
+                job = running.pop(pid, None)
+                if not running:
+                    pgid = None
+                if job is None:
+                    continue
+                index, argv, job_started = job
+                statuses[index] = exit_code(status)
+                if statuses[index] != 0:
+                    failed += 1
+                if os.WIFSIGNALED(status) and os.WTERMSIG(status) == _signal.SIGINT:
+                    # Interrupted from the terminal: let the running jobs finish but start no more
+                    del arguments[started:]
+                accounting.record(' '.join(argv), pid, statuses[index], rusage,
+                                  time.perf_counter() - job_started, ' '.join(parsed_line))
+
+            if keep_order:
+                # Flush every finished job whose predecessors have all been flushed
+                while next_to_flush < started and statuses[next_to_flush] is not None:
+                    output = outputs.pop(next_to_flush, None)
+                    if output is not None:
+                        try:
+                            _copy_output(output, out_fd)
+                        except BrokenPipeError:
+                            keep_order = False
+                    next_to_flush += 1
+    finally:
+        if running:
+            # Stopped by an exception; the jobs left must not outlive the command
+            try:
+                os.killpg(pgid, _signal.SIGTERM)
+            except OSError:
+                pass
+            for pid in running:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+        if foreground:
+            restore_terminal()
+        for output in outputs.values():
+            if output is not None:
+                output.close()
+    return min(failed, MAX_FAILED_STATUS)
@@ -1,58 +1,425 @@
 """
 Module to handle parsing for the shell.
+
+A line is parsed once, in a single pass, into a small tree:
+a Pipeline holds Commands, and each Command holds Words. Parsed lines are kept
+in an LRU cache keyed on the raw line, so lines repeated in loops and scripts
+are only ever parsed once.
 """
-import re
-import shlex
 import sys
+import tracing
+
+class ParseError(ValueError):
+    '''
+    Raised when a line can't be parsed (e.g. an unterminated quote).
+    '''
+
+class Word:
+    '''
+    One argument of a command, after quote and escape removal.
+
+    text is the argument itself, quoted tells if any of it was quoted, escaped
+    tells if it contains a backslash-escaped '$', and dollars holds the
+    positions in text of every '$' that was not escaped (the only ones that
+    can start a variable expansion). substitutions holds the (start, end)
+    positions in text of each $(...) command substitution, kept there as it
+    was typed, and globs the positions of the unquoted '*', '?' and '[' (the
+    only ones that are wildcards, see globbing.py). segments caches the word
+    once it has been compiled for expansion (see expansion.compile_word).
+    '''
+    __slots__ = ('text', 'quoted', 'escaped', 'dollars', 'substitutions', 'globs', 'segments')
+
+    def __init__(self, text, quoted=False, escaped=False, dollars=(), substitutions=(), globs=()):
+        self.text = text
+        self.quoted = quoted
+        self.escaped = escaped
+        self.dollars = dollars
+        self.substitutions = substitutions
+        self.globs = globs
+        self.segments = None
+
+    def __repr__(self):
+        return f'Word({self.text!r})'
+
+class Redirect:
+    '''
+    A redirection of file descriptor fd.
+
+    mode is '<', '>' or '>>' with target the Word naming the file, or '>&' with
+    target the Word naming the descriptor to duplicate (as in 2>&1).
+    '''
+    __slots__ = ('fd', 'mode', 'target')
+
+    def __init__(self, fd, mode, target):
+        self.fd = fd
+        self.mode = mode
+        self.target = target
+
+    def __repr__(self):
+        return f'Redirect({self.fd}, {self.mode!r}, {self.target.text!r})'
+
+class Command:
+    '''
+    A simple command: its words, their texts (argv), its redirections and the source it came from.
+    '''
+    __slots__ = ('words', 'argv', 'redirects', 'source')
+
+    def __init__(self, words, source, redirects=()):
+        self.words = words
+        self.argv = [word.text for word in words]
+        self.redirects = redirects
+        self.source = source
+
+    def __repr__(self):
+        return f'Command({self.argv!r})'
+
+class Pipeline:
+    '''
+    One or more commands connected by pipes; background is set by a trailing '&'.
+    '''
+    __slots__ = ('commands', 'source', 'background')
+
+    def __init__(self, commands, source, background=False):
+        self.commands = commands
+        self.source = source
+        self.background = background
+
+    def __repr__(self):
+        return f'Pipeline({self.commands!r})'
+
+_WHITESPACE = ' \t\r\n'
+
+_GLOB_CHARACTERS = '*?['
+
+# Characters that need the full lexer; lines without any are just split on whitespace
+_SPECIAL_CHARACTERS = '|&<>\\\'"$#*?['
+
+# Regexes matching runs of characters with no special meaning in each lexer state,
+# so they can be copied in one step. They are compiled on first use, since plain
+# lines (and so shell startup) don't need the re module at all.
+_PLAIN_RUN = _DOUBLE_QUOTED_RUN = _SINGLE_QUOTED_RUN = None
+
+def _compile_runs():
+    '''
+    Helper function to compile the lexer's run regexes.
+    '''
+    global _PLAIN_RUN, _DOUBLE_QUOTED_RUN, _SINGLE_QUOTED_RUN
+    import re
+    _PLAIN_RUN = re.compile(r'[^\s|&<>\\\'"$#]+')
+    _DOUBLE_QUOTED_RUN = re.compile(r'[^"\\$]+')
+    _SINGLE_QUOTED_RUN = re.compile(r"[^'\\$]+")
+
+def _make_word(chars, quoted, escaped, dollar_pieces, substitution_pieces=(), glob_pieces=()):
+    '''
+    Helper function to build a Word from the pieces the lexer collected.
+
+    dollar_pieces holds the indexes in chars of unescaped '$' pieces, which are
+    turned into positions in the joined text here. substitution_pieces holds
+    the indexes of the pieces that are a whole $(...) (and are in dollar_pieces
+    too), and glob_pieces those of unquoted pieces with wildcard characters.
+    '''
+    dollars = ()
+    substitutions = ()
+    if dollar_pieces:
+        positions = []
+        spans = []
+        offset = 0
+        wanted = iter(dollar_pieces)
+        next_piece = next(wanted)
+        for index, piece in enumerate(chars):
+            if index == next_piece:
+                positions.append(offset)
+                if index in substitution_pieces:
+                    spans.append((offset, offset + len(piece)))
+                next_piece = next(wanted, None)
+                if next_piece is None:
+                    break
+            offset += len(piece)
+        dollars = tuple(positions)
+        substitutions = tuple(spans)
+    globs = ()
+    if glob_pieces:
+        positions = []
+        offset = 0
+        for index, piece in enumerate(chars):
+            if index in glob_pieces:
+                positions.extend(offset + i for i, c in enumerate(piece) if c in _GLOB_CHARACTERS)
+            offset += len(piece)
+        globs = tuple(positions)
+    return Word(''.join(chars), quoted, escaped, dollars, substitutions, globs)
+
+def _substitution_end(line, start):
+    '''
+    Helper function to find the end of the $(...) starting at line[start], past its ')'.
+
+    Quotes, escapes and nested parentheses (and so nested substitutions) inside it are skipped.
+    '''
+    depth = 0
+    i = start + 1
+    n = len(line)
+    while i < n:
+        c = line[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == "'" or c == '"':
+            i += 1
+            while i < n and line[i] != c:
+                i += 2 if c == '"' and line[i] == '\\' else 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    raise ParseError('unterminated command substitution')
+
+def _make_command(words, source, targets):
+    '''
+    Helper function to build a Command, taking the redirection targets out of its words.
+
+    targets holds [fd, mode, target] for each redirection operator, in order, where
+    target is the index in words of the file name that followed the operator
+    (or already a Word, for '>&').
+    '''
+    if not targets:
+        return Command(words, source)
+    if targets[-1][2].__class__ is int and targets[-1][2] >= len(words):
+        raise ParseError('expected file name after redirection')
+    redirects = []
+    taken = set()
+    for fd, mode, target in targets:
+        if target.__class__ is int:
+            taken.add(target)
+            target = words[target]
+        redirects.append(Redirect(fd, mode, target))
+    words = [word for index, word in enumerate(words) if index not in taken]
+    return Command(words, source, redirects)
+
+# Parsed lines, least recently used first
+_parse_cache = {}
+PARSE_CACHE_SIZE = 1024
+
+def parse_line(line: str) -> Pipeline:
+    '''
+    Parse a line into a Pipeline, raising ParseError if it is malformed.
+
+    Results are kept in an LRU cache, so the returned tree must not be modified.
+
+    >>> parse_line("ls -l | grep 'a b'")
+    Pipeline([Command(['ls', '-l']), Command(['grep', 'a b'])])
+    >>> parse_line(r'echo \\${HOME} "${HOME}"').commands[0].words[1].dollars
+    ()
+    >>> parse_line(r'echo \\${HOME} "${HOME}"').commands[0].words[2].dollars
+    (0,)
+    >>> parse_line('sleep 10 | cat &').background
+    True
+    >>> parse_line('sort -u <in >> "out file" 2>&1').commands[0].redirects
+    [Redirect(0, '<', 'in'), Redirect(1, '>>', 'out file'), Redirect(2, '>&', '1')]
+    '''
+    pipeline = _parse_cache.pop(line, None)
+    if pipeline is None:
+        pipeline = tracing.call('parse', line, _parse, line) if tracing.enabled else _parse(line)
+        if len(_parse_cache) >= PARSE_CACHE_SIZE:
+            del _parse_cache[next(iter(_parse_cache))]
+    # Re-inserting moves the line to the most recently used end
+    _parse_cache[line] = pipeline
+    return pipeline
+
+def _parse(line: str) -> Pipeline:
+    '''
+    Helper function that does the actual parsing for parse_line.
+    '''
+    for c in _SPECIAL_CHARACTERS:
+        if c in line:
+            break
+    else:
+        # Nothing but words separated by whitespace
+        spaced = line.replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+        words = [Word(text) for text in spaced.split(' ') if text]
+        return Pipeline([Command(words, line)], line)
+
+    if _PLAIN_RUN is None:
+        _compile_runs()
+
+    commands = []
+    words = []
+    targets = []
+    chars = []
+    dollars = []
+    substitutions = []
+    globbed = []
+    in_word = quoted = escaped = background = False
+    segment_start = 0
+    i = 0
+    n = len(line)
+
+    while i < n:
+        c = line[i]
+
+        if c in _WHITESPACE or c == '|' or c == '&' or (c == '#' and not in_word):
+            if in_word:
+                if chars:
+                    words.append(_make_word(chars, quoted, escaped, dollars, substitutions, globbed))
+                chars = []
+                dollars = []
+                substitutions = []
+                globbed = []
+                in_word = quoted = escaped = False
+            if c == '|':
+                commands.append(_make_command(words, line[segment_start:i], targets))
+                words = []
+                targets = []
+                segment_start = i + 1
+            elif c == '#':
+                # A comment runs to the end of the line
+                n = i
+                break
+            elif c == '&':
+                # Only a trailing '&' (running the line in the background) is supported
+                rest = line[i + 1:].lstrip(_WHITESPACE)
+                if rest and rest[0] != '#':
+                    raise ParseError("unexpected '&'")
+                background = True
+                n = i
+                break
+            i += 1
+
+        elif c == '<' or c == '>':
+            fd = 0 if c == '<' else 1
+            if in_word:
+                text = ''.join(chars)
+                if text.isdigit() and not quoted and not escaped:
+                    # A number right before the operator is the descriptor, as in 2>
+                    fd = int(text)
+                elif chars:
+                    words.append(_make_word(chars, quoted, escaped, dollars, substitutions, globbed))
+                chars = []
+                dollars = []
+                substitutions = []
+                globbed = []
+                in_word = quoted = escaped = False
+            if targets and targets[-1][2].__class__ is int and targets[-1][2] >= len(words):
+                raise ParseError('expected file name after redirection')
+            i += 1
+            mode = c
+            if c == '>' and i < n and line[i] == '>':
+                mode = '>>'
+                i += 1
+            elif i < n and line[i] == '&':
+                start = i = i + 1
+                while i < n and line[i].isdigit():
+                    i += 1
+                if i == start:
+                    raise ParseError(f"expected file descriptor after '{c}&'")
+                targets.append([fd, '>&', Word(line[start:i])])
+                continue
+            targets.append([fd, mode, len(words)])
+
+        elif c == '\\':
+            if i + 1 >= n:
+                raise ParseError('unterminated quote')
+            if line[i + 1] == '$':
+                escaped = True
+            chars.append(line[i + 1])
+            in_word = True
+            i += 2
+
+        elif c == '"' or c == "'":
+            run_pattern = _DOUBLE_QUOTED_RUN if c == '"' else _SINGLE_QUOTED_RUN
+            in_word = quoted = True
+            i += 1
+            while True:
+                if i >= n:
+                    raise ParseError('unterminated quote')
+                run = run_pattern.match(line, i)
+                if run is not None:
+                    chars.append(run.group())
+                    i = run.end()
+                    continue
+                q = line[i]
+                if q == c:
+                    i += 1
+                    break
+                if q == '\\':
+                    if i + 1 >= n:
+                        raise ParseError('unterminated quote')
+                    following = line[i + 1]
+                    if following == c or following == '\\' or following == '$':
+                        # Only the quote itself, a backslash or '$' can be escaped in quotes
+                        if following == '$':
+                            escaped = True
+                        chars.append(following)
+                        i += 2
+                        continue
+                elif q == '$':
+                    dollars.append(len(chars))
+                    if c == '"' and line[i + 1:i + 2] == '(':
+                        end = _substitution_end(line, i)
+                        substitutions.append(len(chars))
+                        chars.append(line[i:end])
+                        i = end
+                        continue
+                chars.append(q)
+                i += 1
+
+        elif c == '$':
+            dollars.append(len(chars))
+            in_word = True
+            if line[i + 1:i + 2] == '(':
+                end = _substitution_end(line, i)
+                substitutions.append(len(chars))
+                chars.append(line[i:end])
+                i = end
+            else:
+                chars.append(c)
+                i += 1
+
+        else:
+            run = _PLAIN_RUN.match(line, i)
+            if run is None:
+                # A '#' in the middle of a word is just a character
+                chars.append(c)
+                i += 1
+            else:
+                piece = run.group()
+                if '*' in piece or '?' in piece or '[' in piece:
+                    globbed.append(len(chars))
+                chars.append(piece)
+                i = run.end()
+            in_word = True
+
+    if in_word and chars:
+        words.append(_make_word(chars, quoted, escaped, dollars, substitutions, globbed))
+    commands.append(_make_command(words, line[segment_start:n], targets))
+    return Pipeline(commands, line, background)
 
 def splitting_arguments(cmd_str: str) -> list[str]:
     '''
     Helper function used to split a line into arguments.
     '''
-    parsed = []
-    lexer = shlex.shlex(cmd_str, posix=True)
-    lexer.whitespace_split = True  
-    lexer.quotes = "'\""
-    lexer.escape = '\\'
-    lexer.escapedquotes = "'\""
-
     try:
-        for token in lexer:
-            if token:
-                parsed.append(token)
-    except ValueError:
-        sys.stderr.write('mysh: syntax error: unterminated quote\n')
+        pipeline = parse_line(cmd_str)
+    except ParseError as e:
+        sys.stderr.write(f'mysh: syntax error: {e}\n')
         return []
-    
-    return parsed
 
-_PIPE_REGEX_PATTERN = re.compile(
-    # Match escaped double quotes
-    r"\\\""
-    # OR match escaped single quotes
-    r"|\\'"
-    # OR match strings in double quotes (escaped double quotes inside other quotes are OK)
-    r"|\"(?:\\\"|[^\"])*\""
-    # OR match strings in single quotes (escaped single quotes inside other quotes are OK)
-    r"|'(?:\\'|[^'])*'"
-    # OTHERWISE: match the pipe operator, and make a capture group for this
-    r"|(\|)"
-)
-
-"""
-Regex pattern which will perform multiple matches for escaped quotes or quoted strings,
-but only contain a capture group for an unquoted pipe operator ('|').
+    if len(pipeline.commands) == 1:
+        return list(pipeline.commands[0].argv)
 
-Original regex credit to zx81 on Stack Overflow (https://stackoverflow.com/a/23667311).
-"""
+    # Callers that don't handle pipes get the pipe operator as an argument
+    parsed = []
+    for command in pipeline.commands:
+        if parsed:
+            parsed.append('|')
+        parsed.extend(command.argv)
+    return parsed
 
 def split_by_pipe_op(cmd_str: str) -> list[str]:
     """
     Split a string by an unquoted pipe operator ('|').
 
-    The logic for this function was derived from 
-    https://www.rexegg.com/regex-best-trick.php#notarzan.
-
     >>> split_by_pipe_op("a | b")
     ['a ', ' b']
     >>> split_by_pipe_op("a | b|c")
@@ -72,34 +439,9 @@ def split_by_pipe_op(cmd_str: str) -> list[str]:
     Returns:
         A list of strings that was split on the unquoted pipe operator.
     """
-    # Indexes which we will split the string by
-    split_str_indexes = []
-
-    for match in _PIPE_REGEX_PATTERN.finditer(cmd_str):
-        if match.group(1) is not None:
-            # A group exists - which is only for the last alternative
-            # All other alternatives have non-capture groups, meaning they will have
-            # `group(1)` return `None`
-            split_str_indexes.append(match.start())
-
-    if not split_str_indexes:
-        # Nothing to split
+    try:
+        pipeline = parse_line(cmd_str)
+    except ParseError:
+        # Let the caller report the error when it splits the arguments
         return [cmd_str]
-
-    # Now, we actually split the string by the pipe operator (identified at indexes in
-    # `split_str_indexes`)
-    split_str = []
-    prev_index = 0
-    for next_index in split_str_indexes:
-        # Slice string
-        cmd_str_slice = cmd_str[prev_index:next_index]
-        split_str.append(cmd_str_slice)
-
-        # Update index
-        prev_index = next_index + 1
-
-    cmd_str_slice = cmd_str[prev_index:]
-    split_str.append(cmd_str_slice)
-
-    # Return str
-    return split_str
+    return [command.source for command in pipeline.commands]
@@ -0,0 +1,135 @@
+'''
+Module to set up the file descriptors of commands: redirections and pipes.
+
+Redirection files are opened in the shell with O_CLOEXEC, so the only copies a
+command gets are the ones dup2'd onto its 0, 1 and 2. Pipes can be grown with
+MYSH_PIPE_SIZE, which means fewer context switches between pipeline stages.
+'''
+import errno
+import os
+import sys
+from expansion import compile_word, evaluate
+from capturing import size_setting
+
+_OPEN_FLAGS = {
+    '<': os.O_RDONLY | os.O_CLOEXEC,
+    '>': os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+    '>>': os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC,
+}
+
+PIPE_MAX_SIZE_FILE = '/proc/sys/fs/pipe-max-size'
+
+# The largest pipe an unprivileged process may ask for, read once
+_pipe_max_size = None
+
+def redirect_target(redirect):
+    '''
+    Helper function to get the file name of a redirection, with ${VAR} and ~ expanded.
+    '''
+    target = evaluate(compile_word(redirect.target))
+    if target.startswith('~') and not redirect.target.quoted:
+        target = os.path.expanduser(target)
+    return target
+
+def open_redirects(redirects, stdin=None, stdout=None, stderr=None):
+    '''
+    Open the redirections of a command and return (stdin, stdout, stderr, opened).
+
+    stdin, stdout and stderr are what the command gets without redirections
+    (e.g. pipe ends; None means the shell's own). opened holds the descriptors
+    opened here, which the caller closes once the command has started.
+    Raises OSError (or ExpansionError) if a redirection fails, after closing
+    anything it opened.
+    '''
+    fds = [stdin, stdout, stderr]
+    opened = []
+    try:
+        for redirect in redirects:
+            if redirect.fd > 2:
+                raise OSError(errno.EBADF, 'redirecting this file descriptor is not supported', str(redirect.fd))
+            if redirect.mode == '>&':
+                source = int(redirect.target.text)
+                if source > 2:
+                    raise OSError(errno.EBADF, 'Bad file descriptor', redirect.target.text)
+                fd = fds[source]
+                if fd is None:
+                    # A copy, so it still means the shell's descriptor after 0-2 are rearranged
+                    fd = os.dup(source)
+                    opened.append(fd)
+            else:
+                fd = os.open(redirect_target(redirect), _OPEN_FLAGS[redirect.mode], 0o666)
+                opened.append(fd)
+            fds[redirect.fd] = fd
+    except BaseException:
+        for fd in opened:
+            os.close(fd)
+        raise
+    return fds[0], fds[1], fds[2], opened
+
+def redirect_error(error):
+    '''
+    Helper function to report a redirection that failed.
+    '''
+    if isinstance(error, OSError):
+        sys.stderr.write(f'mysh: {error.filename}: {error.strerror}\n')
+    else:
+        sys.stderr.write(f'mysh: syntax error: {error}\n')
+
+class redirected:
+    '''
+    Context manager pointing the shell's own 0, 1 and 2 at fds while a built-in runs.
+    '''
+    def __init__(self, fds):
+        self.fds = fds
+        self.saved = []
+
+    def __enter__(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for target, fd in enumerate(self.fds):
+            if fd is not None and fd != target:
+                self.saved.append((target, os.dup(target)))
+                os.dup2(fd, target)
+        return self
+
+    def __exit__(self, *exc):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for target, saved in reversed(self.saved):
+            os.dup2(saved, target)
+            os.close(saved)
+        return False
+
+def pipe_size():
+    '''
+    Helper function to get the pipe size asked for with MYSH_PIPE_SIZE (None if unset).
+
+    It is capped at /proc/sys/fs/pipe-max-size, the most the kernel allows.
+    '''
+    global _pipe_max_size
+    size = size_setting('MYSH_PIPE_SIZE')
+    if size is None:
+        return None
+    if _pipe_max_size is None:
+        try:
+            with open(PIPE_MAX_SIZE_FILE) as f:
+                _pipe_max_size = int(f.read())
+        except (OSError, ValueError):
+            _pipe_max_size = 1 << 20
+    return min(size, _pipe_max_size)
+
+def make_pipe(size=None):
+    '''
+    Create a close-on-exec pipe, grown to size bytes with F_SETPIPE_SZ if size is given.
+
+    Commands only get the ends that are dup2'd onto their 0 and 1.
+    '''
+    rfd, wfd = os.pipe2(os.O_CLOEXEC)
+    if size is not None:
+        import fcntl
+        try:
+            fcntl.fcntl(wfd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), size)
+        except OSError:
+            # Over the per-user limit on pipe memory; the default size still works
+            pass
+    return rfd, wfd
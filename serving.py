@@ -0,0 +1,329 @@
+'''
+Module to serve command lines over a Unix socket (mysh.py --serve) and send them (mysh.py --client).
+
+The server loads .myshrc and imports the shell once, then keeps a pool of
+pre-forked workers accepting connections on the socket. Each worker serves a
+single session and exits, and the server forks a fresh copy to replace it, so
+no session sees the cd or var of another one and no request waits for a fork.
+
+A session is one request and its reply:
+
+    request: !BIII header (errexit, length of cwd, length of the environment,
+             length of the lines), cwd, environment ('NAME=value\\0' each), lines
+    reply:   !iQQ header (exit status, length of stdout, length of stderr), stdout, stderr
+
+The lines run like a script in cwd, with the client's environment (and
+.myshrc on top of it, as in a direct run), stdin at /dev/null and their
+stdout and stderr captured in memory files, which are sent back with sendfile.
+
+The client side only uses the _socket and _struct C modules: importing socket
+(and the enum and selectors modules it brings) would take about as long as
+the rest of a client run. A client still starts a Python interpreter, which
+is most of what it costs.
+'''
+import os
+import _signal
+import _socket
+import _struct
+import sys
+
+_REQUEST = _struct.Struct('!BIII')
+_REPLY = _struct.Struct('!iQQ')
+
+# Modules the shell only imports when a command needs them; importing them before
+# forking means no worker has to import them again
+PRELOAD_MODULES = ('selectors', 'threading', 'resource', 'fcntl', 'json', 'tempfile')
+
+# Signals that stop the server
+_STOP_SIGNALS = (_signal.SIGTERM, _signal.SIGINT)
+
+USAGE = 'usage: mysh.py --client socket [-e] (-c command | script | -)\n'
+
+def _receive(sock, count):
+    '''
+    Helper function to read exactly count bytes from sock (fewer only at EOF).
+    '''
+    buffer = bytearray(count)
+    size = 0
+    with memoryview(buffer) as view:
+        while size < count:
+            received = sock.recv_into(view[size:])
+            if not received:
+                break
+            size += received
+    del buffer[size:]
+    return buffer
+
+def _forward(sock, count, fd):
+    '''
+    Helper function to copy count bytes from sock to the file descriptor fd.
+    '''
+    while count:
+        data = sock.recv(min(count, 1 << 20))
+        if not data:
+            raise ConnectionError('server closed the connection')
+        count -= len(data)
+        while data:
+            data = data[os.write(fd, data):]
+
+def _encode_environment(environment):
+    '''
+    Helper function to pack an environment as 'NAME=value\\0' strings.
+    '''
+    return b''.join([key + b'=' + value + b'\0' for key, value in environment.items()])
+
+def _decode_environment(data):
+    '''
+    Helper function to unpack an environment packed by _encode_environment.
+    '''
+    environment = {}
+    for item in data.split(b'\0'):
+        if item:
+            key, _, value = item.partition(b'=')
+            environment[key] = value
+    return environment
+
+def run_remote(path, lines, errexit=False, cwd=None, environment=None, out_fd=1, err_fd=2):
+    '''
+    Run lines on the server listening at path and return their exit status.
+
+    They run in cwd with environment (this process's by default, as bytes).
+    Their output is written to out_fd and err_fd as it is received. Raises
+    OSError if the server can't be reached.
+    '''
+    cwd = os.fsencode(os.getcwd() if cwd is None else cwd)
+    env = _encode_environment(os.environb if environment is None else environment)
+    data = lines.encode(errors='surrogateescape')
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(_REQUEST.pack(errexit, len(cwd), len(env), len(data)) + cwd + env + data)
+        header = _receive(sock, _REPLY.size)
+        if len(header) < _REPLY.size:
+            raise ConnectionError('server closed the connection')
+        status, out_size, err_size = _REPLY.unpack(header)
+        _forward(sock, out_size, out_fd)
+        _forward(sock, err_size, err_fd)
+    finally:
+        sock.close()
+    return status
+
+def client_main(args):
+    '''
+    Run mysh.py --client: send a command (or a script) to a server and exit with its status.
+    '''
+    if not args:
+        sys.stderr.write(USAGE)
+        return 2
+    path = args.pop(0)
+    errexit = False
+    lines = None
+    while args:
+        arg = args.pop(0)
+        if arg == '-e':
+            errexit = True
+        elif arg == '-c' and args:
+            lines = args.pop(0)
+            break
+        elif arg == '-' or not arg.startswith('-'):
+            try:
+                with open(0 if arg == '-' else arg, errors='surrogateescape', closefd=arg != '-') as f:
+                    lines = f.read()
+            except OSError as e:
+                sys.stderr.write(f'mysh: {arg}: {e.strerror}\n')
+                return 127
+            break
+        else:
+            break
+    if lines is None:
+        sys.stderr.write(USAGE)
+        return 2
+    try:
+        return run_remote(path, lines, errexit)
+    except OSError as e:
+        sys.stderr.write(f'mysh: {path}: {e.strerror or e}\n')
+        return 2
+
+def _memory_file(name):
+    '''
+    Helper function to open an anonymous file for captured output.
+    '''
+    try:
+        return os.memfd_create(name, os.MFD_CLOEXEC)
+    except (AttributeError, OSError):
+        import tempfile
+        f = tempfile.TemporaryFile()
+        fd = os.dup(f.fileno())
+        f.close()
+        return fd
+
+def _serve_session(conn, run_script, setup):
+    '''
+    Helper function to run the request read from conn and send back the reply.
+
+    setup loads .myshrc and the default variables once the client's environment is in place.
+    '''
+    header = _receive(conn, _REQUEST.size)
+    if len(header) < _REQUEST.size:
+        return
+    errexit, cwd_size, env_size, lines_size = _REQUEST.unpack(header)
+    cwd = os.fsdecode(bytes(_receive(conn, cwd_size)))
+    environment = _decode_environment(bytes(_receive(conn, env_size)))
+    lines = _receive(conn, lines_size).decode(errors='surrogateescape')
+
+    out_fd = _memory_file('mysh-stdout')
+    err_fd = _memory_file('mysh-stderr')
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.close(null)
+    os.dup2(out_fd, 1)
+    os.dup2(err_fd, 2)
+
+    os.environb.clear()
+    os.environb.update(environment)
+    status = 0
+    try:
+        os.chdir(cwd)
+        os.environ['PWD'] = cwd
+    except OSError as e:
+        sys.stderr.write(f'mysh: {cwd}: {e.strerror}\n')
+        status = 1
+    if status == 0:
+        try:
+            setup()
+            if lines.endswith('\n'):
+                lines = lines[:-1]
+            status = run_script(lines.split('\n'), bool(errexit))
+        except SystemExit as e:
+            # The exit built-in ends the session
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            # A bug in the shell: the client gets the traceback and a failure, like a direct run
+            import traceback
+            traceback.print_exc()
+            status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    sizes = [os.lseek(fd, 0, os.SEEK_END) for fd in (out_fd, err_fd)]
+    conn.sendall(_REPLY.pack(status, *sizes))
+    for fd, size in zip((out_fd, err_fd), sizes):
+        if size:
+            with open(fd, 'rb', closefd=False) as f:
+                conn.sendfile(f, 0, size)
+
+def _worker(listener, run_script, setup):
+    '''
+    Helper function run by each worker: serve one session, then exit.
+
+    Errors of the session itself (like a client that went away) are written
+    to the server's stderr; the worker always exits from here, so it never
+    returns into the server's loop.
+    '''
+    _signal.signal(_signal.SIGTERM, _signal.SIG_DFL)
+    _signal.signal(_signal.SIGINT, _signal.SIG_DFL)
+    _signal.pthread_sigmask(_signal.SIG_UNBLOCK, _STOP_SIGNALS)
+    server_stderr = os.dup(2)
+    status = 1
+    try:
+        conn, _ = listener.accept()
+        listener.close()
+        with conn:
+            _serve_session(conn, run_script, setup)
+        status = 0
+    except Exception as e:
+        sys.stderr.flush()
+        os.dup2(server_stderr, 2)
+        sys.stderr.write(f'mysh: --serve: worker {os.getpid()}: {e}\n')
+        sys.stderr.flush()
+    finally:
+        os._exit(status)
+
+def _start_worker(listener, run_script, setup):
+    '''
+    Helper function to fork a worker and return its pid.
+
+    SIGTERM and SIGINT are blocked until the worker has reset them, so a worker
+    never runs the server's handler for them.
+    '''
+    _signal.pthread_sigmask(_signal.SIG_BLOCK, _STOP_SIGNALS)
+    pid = os.fork()
+    if pid == 0:
+        _worker(listener, run_script, setup)
+    _signal.pthread_sigmask(_signal.SIG_UNBLOCK, _STOP_SIGNALS)
+    return pid
+
+def _listen(path):
+    '''
+    Helper function to bind the server socket, replacing a stale one left at path.
+    '''
+    import socket
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            probe.close()
+            listener.close()
+            raise OSError(f'{path}: a server is already listening')
+    # Only the user running the server may connect
+    old_umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    listener.listen(socket.SOMAXCONN)
+    return listener
+
+def _stop(signum, frame):
+    '''
+    Helper function to turn SIGTERM and SIGINT into a clean exit of the server.
+    '''
+    raise SystemExit(0)
+
+def serve(path, workers, run_script, setup):
+    '''
+    Serve sessions on the Unix socket at path with a pool of workers until SIGTERM or SIGINT.
+
+    run_script runs the lines of a request (see mysh.run_script), and setup
+    prepares the environment of each session (see mysh.setup_environment).
+    '''
+    import jobs
+    for name in PRELOAD_MODULES:
+        __import__(name)
+    jobs.interactive = False
+    try:
+        listener = _listen(path)
+    except OSError as e:
+        sys.stderr.write(f'mysh: --serve: {e.strerror or e}\n')
+        return 1
+
+    for signal_number in _STOP_SIGNALS:
+        _signal.signal(signal_number, _stop)
+    pool = set()
+    try:
+        while True:
+            while len(pool) < workers:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pool.add(_start_worker(listener, run_script, setup))
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                continue
+            pool.discard(pid)
+    finally:
+        for pid in pool:
+            try:
+                os.kill(pid, _signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        listener.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    return 0
@@ -0,0 +1,115 @@
+'''
+Module to launch programs with posix_spawn instead of forking the whole shell.
+'''
+import os
+import sys
+import time
+import _signal
+import tracing
+
+# Signals the shell ignores or handles itself, which every child gets back at their
+# defaults. An ignored SIGPIPE in particular survives exec, and would leave
+# `producer | head` producers running (and failing every write) after head exits.
+DEFAULT_SIGNALS = (_signal.SIGPIPE, _signal.SIGINT, _signal.SIGQUIT, _signal.SIGTTOU)
+
+# Linux refuses to exec a program if any single environment string is longer
+# than this (MAX_ARG_STRLEN), so larger shell variables are not exported
+MAX_ENV_STRLEN = 32 * 4096
+
+def child_environment():
+    '''
+    Helper function to get the environment to give a child.
+
+    Variables too large to be exported (e.g. big var -s captures) are left out
+    so they don't stop every other command from starting.
+    '''
+    environment = os.environb
+    for key, value in environment.items():
+        if len(key) + len(value) + 2 > MAX_ENV_STRLEN:
+            break
+    else:
+        return environment
+    return {
+        key: value for key, value in environment.items()
+        if len(key) + len(value) + 2 <= MAX_ENV_STRLEN
+    }
+
+def _file_actions(stdin, stdout, stderr, close_fds):
+    '''
+    Helper function to turn the redirections of a child into posix_spawn file actions.
+    '''
+    file_actions = []
+    for target, fd in ((0, stdin), (1, stdout), (2, stderr)):
+        if fd is not None and fd != target:
+            file_actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+    for fd in sorted(set(close_fds)):
+        if fd not in (0, 1, 2):
+            file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+    return file_actions
+
+def spawn(path, arguments, stdin=None, stdout=None, stderr=None, close_fds=(),
+          pgroup=0, search_path=False):
+    '''
+    Start a program and return its pid without copying the shell process.
+
+    stdin, stdout and stderr are file descriptors that get dup2'd onto 0, 1 and 2
+    in the child, and close_fds are closed in the child before the program runs.
+    The child joins process group pgroup (0 starts a new group led by the child,
+    None keeps the shell's group). With search_path, path is looked up on PATH
+    like execvp does. The signals in DEFAULT_SIGNALS are reset to their defaults.
+    '''
+    launcher = os.posix_spawnp if search_path else os.posix_spawn
+    file_actions = _file_actions(stdin, stdout, stderr, close_fds)
+    environment = child_environment()
+    options = {'file_actions': file_actions, 'setsigdef': DEFAULT_SIGNALS}
+    if pgroup is not None:
+        options['setpgroup'] = pgroup
+    if tracing.enabled:
+        return tracing.call('spawn', path, launcher, path, arguments, environment, **options)
+    return launcher(path, arguments, environment, **options)
+
+def fork_function(function, arguments, stdin=None, stdout=None, stderr=None, close_fds=(), pgroup=0):
+    '''
+    Run a Python function in a forked child, for built-ins that can't be exec'd.
+
+    Returns the pid of the child, which exits once the function returns.
+    '''
+    started = time.monotonic_ns()
+    pid = os.fork()
+    if pid != 0:
+        # Only the parent records the span, or each fork would show up twice
+        if tracing.enabled:
+            tracing.record('fork', arguments[0], started)
+        if pgroup is not None:
+            # Also set from the parent, so later stages can join the group straight away
+            try:
+                os.setpgid(pid, pgroup or pid)
+            except OSError:
+                pass
+        return pid
+
+    status = 0
+    try:
+        for signal_number in DEFAULT_SIGNALS:
+            _signal.signal(signal_number, _signal.SIG_DFL)
+        if pgroup is not None:
+            os.setpgid(0, pgroup)
+        if stdin is not None:
+            os.dup2(stdin, 0)
+        if stdout is not None:
+            os.dup2(stdout, 1)
+        if stderr is not None:
+            os.dup2(stderr, 2)
+        for fd in close_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        function(arguments)
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        status = 1
+    os._exit(status)
@@ -0,0 +1,83 @@
+'''
+Module to run $(...) command substitutions.
+
+The commands inside run like any other line, with the shell's stdout pointed
+at a pipe that a thread reads into a growing buffer (capturing.read_all, with
+no size limit), so they can be whole pipelines, and nested substitutions
+simply point stdout at a pipe of their own. Built-ins run in the shell itself
+and only external commands are started. Substitutions using a built-in that
+changes the shell (cd, var, exit...) run in a forked copy of the shell
+instead, like the subshell other shells run them in.
+
+The output replaces the $(...) with its trailing newlines removed. Like a
+${VAR} it stays within a single argument.
+'''
+import os
+import sys
+import time
+from parsing import parse_line, ParseError
+from expansion import SubstitutionError
+from capturing import read_all
+from redirecting import redirected
+from spawning import fork_function
+from jobs import Job
+import awaiting
+
+def _changes_shell(pipeline):
+    '''
+    Helper function to test if a pipeline runs a built-in that changes the shell.
+    '''
+    from executing_commands import STATEFUL_BUILTINS
+    for command in pipeline.commands:
+        if command.words and command.words[0].text.lower() in STATEFUL_BUILTINS:
+            return True
+    return False
+
+def _run(pipeline):
+    '''
+    Helper function to run the commands of a substitution in a forked copy of the shell.
+    '''
+    from executing_commands import run_commands
+    sys.exit(run_commands(pipeline.commands, pipeline.background))
+
+def substitute(source):
+    '''
+    Run the commands in source and return their output, without trailing newlines.
+
+    Raises SubstitutionError if source can't be parsed.
+    '''
+    from executing_commands import run_commands
+    import threading
+    try:
+        pipeline = parse_line(source)
+    except ParseError as e:
+        raise SubstitutionError(f'$({source}): {e}')
+    if not pipeline.commands[0].words and len(pipeline.commands) == 1:
+        return ''
+
+    rfd, wfd = os.pipe2(os.O_CLOEXEC)
+    output = []
+
+    def read():
+        output.append(read_all(rfd)[0])
+
+    reader = threading.Thread(target=read)
+    try:
+        if _changes_shell(pipeline):
+            started = time.perf_counter()
+            pid = fork_function(_run, pipeline, stdout=wfd, close_fds=(rfd,))
+            os.close(wfd)
+            wfd = None
+            reader.start()
+            awaiting.wait(Job(pid, [pid], source, started=started))
+        else:
+            reader.start()
+            with redirected((None, wfd, None)):
+                run_commands(pipeline.commands, pipeline.background)
+    finally:
+        if wfd is not None:
+            os.close(wfd)
+        if reader.ident is not None:
+            reader.join()
+        os.close(rfd)
+    return output[0].decode(errors='surrogateescape').rstrip('\n') if output else ''
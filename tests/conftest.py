@@ -0,0 +1,19 @@
+'''
+Shared setup for the tests: the shell's modules live at the top of the repository.
+'''
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, ROOT)
+
+import jobs
+
+@pytest.fixture(autouse=True)
+def non_interactive(monkeypatch):
+    '''
+    Run every test like a script, so no test tries to hand the terminal to a job.
+    '''
+    monkeypatch.setattr(jobs, 'interactive', False)
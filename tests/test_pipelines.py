@@ -0,0 +1,116 @@
+'''
+Tests for running commands and pipelines.
+'''
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import pytest
+
+from parsing import parse_line
+from executing_commands import executing_piped_commands, var
+
+MYSH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mysh.py')
+
+def open_descriptors():
+    '''
+    Helper function to get the descriptors open in this process.
+    '''
+    return sorted(os.listdir('/proc/self/fd'))
+
+def run_shell(line):
+    '''
+    Helper function to run line with mysh.py -c, for built-ins writing to the shell's own stdout.
+    '''
+    return subprocess.run([sys.executable, MYSH, '-c', line], capture_output=True, text=True, timeout=10)
+
+def run_pipeline(line):
+    '''
+    Helper function to run a pipeline line and return its exit status.
+    '''
+    return executing_piped_commands(parse_line(line).commands)
+
+def test_long_pipeline_under_low_descriptor_limit(tmp_path):
+    '''
+    500 stages need far more than 128 descriptors at once unless each pipe is
+    closed as soon as the stages using it have started.
+    '''
+    stages = 500
+    output = tmp_path / 'out'
+    line = ' | '.join(['head -c 100000 /dev/zero'] + ['cat'] * (stages - 2) + [f'wc -c > {output}'])
+    before = open_descriptors()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(128, soft), hard))
+    try:
+        status = run_pipeline(line)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    assert status == 0
+    assert output.read_text().strip() == '100000'
+    assert open_descriptors() == before
+
+@pytest.mark.parametrize('producer', ['yes', 'yes | cat | cat'])
+def test_producer_stops_when_consumer_exits(tmp_path, producer):
+    '''
+    yes never stops writing by itself, so the pipeline only ends if it is
+    stopped (by SIGPIPE) as soon as head has exited.
+    '''
+    output = tmp_path / 'out'
+    start = time.perf_counter()
+    status = run_pipeline(f'{producer} | head -1 > {output}')
+    elapsed = time.perf_counter() - start
+    assert status == 0
+    assert output.read_text() == 'y\n'
+    assert elapsed < 1.0
+    # Every stage has been reaped, none is left writing in the background
+    with pytest.raises(ChildProcessError):
+        os.waitpid(-1, os.WNOHANG)
+
+@pytest.mark.parametrize('engine', ['0', '1'])
+def test_var_capture_of_killed_command(monkeypatch, engine):
+    '''
+    A command killed by a signal gives 128+N with either wait engine (MYSH_ASYNC).
+    '''
+    monkeypatch.setenv('MYSH_ASYNC', engine)
+    monkeypatch.delenv('CAPTURED', raising=False)
+    assert var(['var', '-s', 'CAPTURED', "sh -c 'kill -9 $$'"]) == 137
+
+def test_var_capture_with_null_byte(monkeypatch, capsys):
+    '''
+    The environment can't hold a NUL, so the capture fails with an error rather than a traceback.
+    '''
+    monkeypatch.delenv('CAPTURED', raising=False)
+    assert var(['var', '-s', 'CAPTURED', 'head -c 300000 /dev/zero']) == 1
+    assert capsys.readouterr().err == 'mysh: var: CAPTURED: output contains a null byte\n'
+    assert 'CAPTURED' not in os.environ
+
+def test_cat_refuses_to_append_a_file_to_itself(tmp_path):
+    '''
+    Copying a file onto its own end would never reach the end of it.
+    '''
+    path = tmp_path / 'f'
+    path.write_text('abc\n')
+    result = run_shell(f'cat {path} >> {path}')
+    assert result.returncode == 1
+    assert result.stderr == f'mysh: cat: {path}: input file is output file\n'
+    assert path.read_text() == 'abc\n'
+
+def test_builtin_write_error():
+    '''
+    A built-in that can't write its output fails like any other command, and the shell carries on.
+    '''
+    result = run_shell('pwd > /dev/full\necho after')
+    assert result.returncode == 0
+    assert result.stdout == 'after\n'
+    assert result.stderr == 'mysh: pwd: No space left on device\n'
+
+def test_cache_hit_write_error(tmp_path, monkeypatch):
+    '''
+    Replaying a cached output that can't be written fails like running the command would.
+    '''
+    monkeypatch.setenv('MYSHDOTDIR', str(tmp_path))
+    result = run_shell('cache echo hi > /dev/null\ncache echo hi > /dev/full')
+    assert result.returncode == 1
+    assert result.stderr == 'mysh: cache: No space left on device\n'
@@ -0,0 +1,129 @@
+'''
+Module to trace where the shell spends its time, in Chrome trace-event JSON.
+
+Tracing is turned on by MYSH_TRACE=file when the shell starts, or with the
+trace built-in. Each traced phase (a whole line, parsing, expansion, PATH
+scans, spawning and forking, waiting) is written as a complete ("X") event
+with monotonic-clock timestamps, so the file opens in Perfetto or
+chrome://tracing with one track per process and thread.
+
+The file is a JSON array that is only ever appended to: each event is one
+O_APPEND write followed by a comma, and the closing bracket is left out,
+which the trace-event format allows. Forked built-ins (and every shell sharing
+the file) add their events to the same array.
+
+When tracing is off, a traced call costs a single check of the enabled flag:
+
+    result = tracing.call('parse', line, _parse, line) if tracing.enabled else _parse(line)
+'''
+import os
+import sys
+import time
+import _thread
+
+# Checked at every traced call; only start() and stop() change it
+enabled = False
+
+DEFAULT_TRACE_FILE = 'mysh.trace.json'
+
+_fd = None
+_path = None
+
+def start(path):
+    '''
+    Start appending trace events to the file at path, raising OSError if it can't be opened.
+    '''
+    global enabled, _fd, _path
+    stop()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o644)
+    if os.fstat(fd).st_size == 0:
+        os.write(fd, b'[\n')
+    _fd = fd
+    _path = path
+    enabled = True
+    _write({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 0, 'args': {'name': 'mysh'}})
+
+def stop():
+    '''
+    Stop tracing and close the trace file.
+    '''
+    global enabled, _fd, _path
+    enabled = False
+    if _fd is not None:
+        os.close(_fd)
+    _fd = None
+    _path = None
+
+def _write(event):
+    '''
+    Helper function to append one event to the trace file.
+    '''
+    import json
+    line = json.dumps(event, separators=(',', ':')) + ',\n'
+    try:
+        os.write(_fd, line.encode(errors='surrogateescape'))
+    except OSError as e:
+        sys.stderr.write(f'mysh: trace: {_path}: {e.strerror}\n')
+        stop()
+
+def call(name, detail, function, *args, **kwargs):
+    '''
+    Call function(*args, **kwargs) and record how long it took as the span name.
+
+    detail (e.g. the command) is shown with the span; the result of the call is returned.
+    '''
+    started = time.monotonic_ns()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        record(name, detail, started)
+
+def record(name, detail, started):
+    '''
+    Record the span name from started (a time.monotonic_ns() value) until now.
+
+    For spans call can't wrap, like a fork, which returns in two processes.
+    '''
+    ended = time.monotonic_ns()
+    if enabled:
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': started / 1000,
+            'dur': (ended - started) / 1000,
+            'pid': os.getpid(),
+            'tid': _thread.get_native_id(),
+        }
+        if detail is not None:
+            event['args'] = {'detail': detail}
+        _write(event)
+
+def trace_command(parsed_line, stdout=None):
+    '''
+    Implementing functionality for the trace built-in command.
+
+    trace on [FILE] starts tracing to FILE ($MYSH_TRACE or mysh.trace.json by
+    default), trace off stops it and trace alone tells where it is going.
+    '''
+    if stdout is None:
+        stdout = sys.stdout
+    if len(parsed_line) == 1:
+        stdout.write(f'trace: on, writing to {_path}\n' if enabled else 'trace: off\n')
+        return 0
+    action = parsed_line[1]
+    if action == 'off' and len(parsed_line) == 2:
+        stop()
+        return 0
+    if action == 'on' and len(parsed_line) <= 3:
+        if len(parsed_line) == 3:
+            path = parsed_line[2]
+        else:
+            path = os.environ.get('MYSH_TRACE') or DEFAULT_TRACE_FILE
+        try:
+            start(os.path.expanduser(path))
+        except OSError as e:
+            sys.stderr.write(f'trace: {path}: {e.strerror}\n')
+            return 1
+        return 0
+    sys.stderr.write('usage: trace [on [file] | off]\n')
+    return 2